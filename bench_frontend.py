@@ -0,0 +1,262 @@
+import argparse
+import ast
+import gc
+import math
+import time
+import tracemalloc
+
+import hr
+from compiler import compile
+from symbols import Symbols
+
+# Scaling benchmarks for the compile pipeline.
+#
+# Synthetic programs of increasing size are put through each stage of the front end (ast.parse, hr.ast_to_hr, Symbols,
+# compile) and the time and tracemalloc peak of each stage is reported. Each stage is timed in a separate pass without
+# tracemalloc running, since tracing allocations slows Python code down several times over.
+#
+# For every pair of consecutive sizes, the growth of the time and memory of a stage is compared with the growth of the
+# program. A stage that grows faster than the program by more than the tolerance is flagged as superlinear.
+#
+#   python bench_frontend.py --max-lines 1000000
+#   python bench_frontend.py --shape nested --sizes 1000 10000 100000
+
+BUILT_IN_INSTRUCTIONS = {"finish": 0, "print": 1}
+
+# Deeper nesting runs into the recursion limit of the parser and the HR walkers
+MAX_NESTING = 30
+
+
+# Each generator returns the source of a program with roughly the given number of lines
+
+# Many small functions, each calling the one before
+def many_functions(lines: int) -> str:
+    out = ["total: int = 0"]
+
+    for i in range(max(1, lines // 12)):
+        out += [
+            f"def f{i}(a: int, b: int) -> int:",
+            f"    x: int = a + b",
+            f"    y: int = x * 2",
+            f"    for j in range(0, 10):",
+            f"        if x > y:",
+            f"            x = x - 1",
+            f"        else:",
+            f"            y = y + j",
+            f"    while x < 100:",
+            f"        x = x + {f'f{i - 1}(x, 1)' if i else '1'}",
+            f"    return x + y",
+            f"",
+        ]
+
+    return "\n".join(out) + "\n"
+
+
+# A single function with a long body
+def long_function(lines: int) -> str:
+    out = ["def main(a: int) -> int:", "    x: int = a", "    y: int = 0"]
+
+    for i in range(max(1, lines // 4)):
+        out += [
+            f"    v{i}: int = x + {i}",
+            f"    if v{i} > y:",
+            f"        y = y + v{i}",
+            f"    x = x - 1",
+        ]
+
+    out.append("    return y")
+
+    return "\n".join(out) + "\n"
+
+
+# Blocks of nested if and while statements, as deep as the nesting allows, inside functions
+def nested(lines: int, depth: int = MAX_NESTING) -> str:
+    out = []
+    block_lines = 2 * depth + 3
+    blocks = max(1, lines // block_lines)
+
+    for i in range(blocks):
+        out += [f"def n{i}(a: int) -> int:", "    x: int = a"]
+
+        for d in range(depth):
+            indent = "    " * (d + 1)
+            out.append(f"{indent}{'if' if d % 2 == 0 else 'while'} x > {d}:")
+            out.append(f"{indent}    x = x - 1")
+
+        out.append("    return x")
+
+    return "\n".join(out) + "\n"
+
+
+# Top level statements only
+def statements(lines: int) -> str:
+    out = ["x: int = 0", "y: int = 1"]
+
+    for i in range(max(1, lines // 3)):
+        out += [
+            f"if x < {i}:",
+            f"    x = x + y * {i % 7}",
+            f"y = y + 1",
+        ]
+
+    out.append("finish()")
+
+    return "\n".join(out) + "\n"
+
+
+shapes = {
+    "functions": many_functions,
+    "long": long_function,
+    "nested": nested,
+    "statements": statements,
+}
+
+
+class _NodeCounter(hr.Walker):
+    def __init__(self):
+        self.count = 0
+
+    def walk(self, node):
+        self.count += 1
+        return self.generic_walk(node)
+
+
+# The stages of the pipeline, each taking the output of the one before
+def _stages(source: str):
+    def parse():
+        return ast.parse(source)
+
+    def to_hr(tree):
+        return hr.ast_to_hr(tree)
+
+    def symbols(module):
+        return module, Symbols(module)
+
+    def count_locals(state):
+        module, table = state
+        for node in module.body:
+            if type(node) == hr.FunctionDef:
+                table.count_locals(node.name)
+        return state
+
+    def compile_module(state):
+        module, table = state
+        return compile(module, table, BUILT_IN_INSTRUCTIONS, {})
+
+    return [
+        ("parse", parse),
+        ("ast_to_hr", to_hr),
+        ("symbols", symbols),
+        ("count_locals", count_locals),
+        ("compile", compile_module),
+    ]
+
+
+def _run_stages(source: str, memory: bool) -> tuple[dict, int]:
+    results = {}
+    value = None
+    nodes = 0
+
+    for name, stage in _stages(source):
+        args = () if value is None else (value,)
+
+        gc.collect()
+
+        if memory:
+            tracemalloc.start()
+            value = stage(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = peak
+        else:
+            start = time.perf_counter()
+            value = stage(*args)
+            results[name] = time.perf_counter() - start
+
+        if name == "ast_to_hr":
+            counter = _NodeCounter()
+            counter.walk(value)
+            nodes = counter.count
+
+    return results, nodes
+
+
+# Benchmark one program shape at each size, returns a list of (lines, nodes, times, peaks)
+def benchmark(shape: str, sizes: list[int], memory: bool = True) -> list[tuple]:
+    rows = []
+
+    for size in sizes:
+        source = shapes[shape](size)
+        lines = source.count("\n")
+
+        times, nodes = _run_stages(source, False)
+        peaks = _run_stages(source, True)[0] if memory else {}
+
+        rows.append((lines, nodes, times, peaks))
+
+    return rows
+
+
+# Growth exponent of value against lines between two rows: 1 is linear, 2 quadratic
+def _exponent(lines_a: int, value_a: float, lines_b: int, value_b: float) -> float | None:
+    if value_a <= 0 or value_b <= 0 or lines_a == lines_b:
+        return None
+    return math.log(value_b / value_a) / math.log(lines_b / lines_a)
+
+
+# (stage, metric, lines, exponent) of every stage that grows faster than linearly by more than tolerance. Timings below
+# min_time are too noisy to judge
+def superlinear(rows: list[tuple], tolerance: float = 0.2, min_time: float = 0.05) -> list[tuple]:
+    flagged = []
+
+    for (lines_a, _, times_a, peaks_a), (lines_b, _, times_b, peaks_b) in zip(rows, rows[1:]):
+        for stage in times_b:
+            if times_b[stage] >= min_time:
+                e = _exponent(lines_a, times_a[stage], lines_b, times_b[stage])
+                if e is not None and e > 1 + tolerance:
+                    flagged.append((stage, "time", lines_b, e))
+
+            if stage in peaks_b:
+                e = _exponent(lines_a, peaks_a[stage], lines_b, peaks_b[stage])
+                if e is not None and e > 1 + tolerance:
+                    flagged.append((stage, "memory", lines_b, e))
+
+    return flagged
+
+
+def report(shape: str, rows: list[tuple], tolerance: float):
+    stages = list(rows[0][2])
+
+    print(f"\n{shape}")
+    print(f"{'lines':>9} {'nodes':>9}  " + "  ".join(f"{stage:>22}" for stage in stages))
+
+    for lines, nodes, times, peaks in rows:
+        cells = []
+        for stage in stages:
+            cell = f"{times[stage] * 1000:9.1f}ms"
+            if stage in peaks:
+                cell += f" {peaks[stage] / 2 ** 20:8.1f}MiB"
+            cells.append(f"{cell:>22}")
+        print(f"{lines:>9} {nodes:>9}  " + "  ".join(cells))
+
+    for stage, metric, lines, e in superlinear(rows, tolerance):
+        print(f"  superlinear: {stage} {metric} grows as lines^{e:.2f} up to {lines} lines")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks for the compile pipeline")
+    parser.add_argument("--shape", choices=list(shapes), action="append", help="Program shapes to benchmark (default all)")
+    parser.add_argument("--sizes", type=int, nargs="+", help="Program sizes in lines")
+    parser.add_argument("--max-lines", type=int, default=100_000, help="Largest size when --sizes is not given, sizes go up in powers of 10 from 1000")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How far above linear the growth exponent may be before a stage is flagged")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc pass")
+    args = parser.parse_args()
+
+    sizes = args.sizes or [10 ** k for k in range(3, int(math.log10(args.max_lines)) + 1)]
+
+    for shape in args.shape or list(shapes):
+        report(shape, benchmark(shape, sizes, not args.no_memory), args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
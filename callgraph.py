@@ -0,0 +1,174 @@
+from collections import Counter
+
+import hr
+
+# Whole program call graph, dead function elimination and hot/cold function layout.
+#
+# The call graph is built from the hr.Call nodes of the top level statements (keyed None, as in stack_depths) and of
+# every FunctionDef. Calls to names that are not user functions (built ins) are left out. Each edge is weighted by an
+# estimate of how often the call runs: a call inside n nested loops counts LOOP_WEIGHT ** n.
+#
+# The roots are the top level code and main, if the module defines one. Functions that cannot be reached from a root are
+# dead and are dropped from the module.
+#
+# The remaining functions are laid out so that each function is followed by its callees, hottest first, and cold
+# functions go last. A function's heat is taken from profile (name -> number of calls, i.e. from a previous run)
+# when given, otherwise it is estimated by propagating the edge weights down from the roots. With a profile, functions
+# that were never called are cold.
+#
+# Both passes work on the HR, between hr.ast_to_hr and Symbols, so the compiler, the linker and program images only see
+# the functions that are kept, in their new order. compile(..., layout=True) runs reorder_functions.
+
+LOOP_WEIGHT = 10
+
+
+class _CallCollector(hr.Walker):
+    def __init__(self, functions: dict):
+        self.functions = functions
+        self.calls = Counter()
+        self.weight = 1
+
+    def visit_Call(self, node):
+        if node.func in self.functions:
+            self.calls[node.func] += self.weight
+        self.generic_walk(node)
+
+    def visit_While(self, node):
+        self.walk(node.condition)
+        self.loop(node.body)
+        if node.orelse:
+            self.traverse(node.orelse)
+
+    def visit_For(self, node):
+        self.loop(node.body)
+
+    def loop(self, body: list):
+        self.weight *= LOOP_WEIGHT
+        self.traverse(body)
+        self.weight //= LOOP_WEIGHT
+
+    # Nested FunctionDefs are not part of the graph
+    def visit_FunctionDef(self, node):
+        pass
+
+
+class CallGraph:
+    def __init__(self, module: hr.Module):
+        self.functions = {node.name: node for node in module.body if type(node) == hr.FunctionDef}
+        statements = [node for node in module.body if type(node) != hr.FunctionDef]
+
+        # Caller (None for the top level code) -> Counter of callee -> weight
+        self.calls = {None: self.collect(statements)}
+
+        for name, node in self.functions.items():
+            self.calls[name] = self.collect(node.body)
+
+        self.roots = [None] + (["main"] if "main" in self.functions else [])
+
+    def collect(self, statements: list) -> Counter:
+        collector = _CallCollector(self.functions)
+        collector.traverse(statements)
+        return collector.calls
+
+    # Names of the functions reachable from the roots
+    def reachable(self) -> set[str]:
+        seen = set()
+        pending = list(self.roots)
+
+        while pending:
+            caller = pending.pop()
+            for callee in self.calls[caller]:
+                if callee not in seen:
+                    seen.add(callee)
+                    pending.append(callee)
+
+        return seen | (set(self.roots) - {None})
+
+    # Estimated number of calls to each reachable function. Functions are visited in reverse post order from the roots, so
+    # every caller is done before its callees except along recursive (back) edges, which are ignored
+    def heat(self, profile: dict | None = None) -> dict[str, float]:
+        if profile is not None:
+            heat = {name: profile.get(name, 0) for name in self.reachable()}
+            if "main" in heat:
+                heat["main"] = max(heat["main"], 1)
+            return heat
+
+        order = []
+        visited = set()
+
+        for root in self.roots:
+            if root in visited:
+                continue
+
+            visited.add(root)
+            stack = [(root, iter(self.calls[root]))]
+
+            while stack:
+                caller, callees = stack[-1]
+                callee = next(callees, None)
+
+                if callee is None:
+                    order.append(caller)
+                    stack.pop()
+                elif callee not in visited:
+                    visited.add(callee)
+                    stack.append((callee, iter(self.calls[callee])))
+
+        order.reverse()
+        position = {name: i for i, name in enumerate(order)}
+
+        heat = Counter({root: 1 for root in self.roots})
+
+        for caller in order:
+            for callee, weight in self.calls[caller].items():
+                if position[callee] > position[caller]:
+                    heat[callee] += heat[caller] * weight
+
+        return {name: heat[name] for name in order if name is not None}
+
+    # Order of the reachable functions: depth first from the roots, placing the hottest callee (then the heaviest edge)
+    # first after each function, with functions of no heat after the rest
+    def layout(self, profile: dict | None = None) -> list[str]:
+        heat = self.heat(profile)
+        order = []
+
+        for hot in (True, False):
+            visited = set()
+            stack = list(reversed(self.roots))
+
+            while stack:
+                name = stack.pop()
+
+                if name in visited:
+                    continue
+
+                visited.add(name)
+
+                if name is not None and (heat[name] > 0) == hot:
+                    order.append(name)
+
+                callees = sorted(self.calls[name].items(), key=lambda item: (heat[item[0]], item[1]), reverse=True)
+                stack += [callee for callee, _ in reversed(callees) if callee not in visited]
+
+        return order
+
+
+# Drop the functions that cannot be reached from the top level code or main, in place. Returns the names dropped
+def eliminate_dead_functions(module: hr.Module) -> list[str]:
+    live = CallGraph(module).reachable()
+    dead = [node.name for node in module.body if type(node) == hr.FunctionDef and node.name not in live]
+
+    module.body = [node for node in module.body if type(node) != hr.FunctionDef or node.name in live]
+
+    return dead
+
+
+# Drop dead functions and lay out the rest (see CallGraph.layout) after the top level statements, in place. Returns the
+# module
+def reorder_functions(module: hr.Module, profile: dict | None = None) -> hr.Module:
+    graph = CallGraph(module)
+
+    statements = [node for node in module.body if type(node) != hr.FunctionDef]
+    module.body = statements + [graph.functions[name] for name in graph.layout(profile)]
+
+    return module
@@ -9,19 +9,37 @@ from itertools import count
 import ir
 import hr
 import ast
-from symbols import Symbols
+from symbols import Symbols, hidden_counter
+from stream import InstructionStream
+import slots
+import stackdepth
+import purity
+import memory
+import optimise as optimiser
+import callgraph
 
 class _Compiler(hr.Walker):
-    def __init__(self, table: Symbols, built_in_instructions: dict, built_in_functions: dict):
+    def __init__(self, table: Symbols, built_in_instructions: dict, built_in_functions: dict, reuse_slots: bool = False):
         self.table = table
-        self.instructions = []
+        # Share frame slots between locals with disjoint live ranges (see slots.py)
+        self.reuse_slots = reuse_slots
+        self.instructions = InstructionStream()
         self.context = None
         self.bi_instructions = built_in_instructions
         self.bi_functions = built_in_functions
         self.function_locations = {}
+        # Location of the first instruction in self.instructions, non-zero when code is emitted in chunks
+        self.base = 0
+        # (index, name) of every Call instruction, the locations are filled in once all functions have been placed
+        self.calls = []
+        # [start, end) indices of each function in self.instructions
+        self.function_ranges = {}
+        # Maximum op stack depth of each function (None for top level code) and the (depth, callee) of each of its calls
+        self.stack_depths = {}
+        self.call_depths = {}
+        # Whether each function is free of side effects, apart from its calls (see purity.py)
+        self.local_purity = {}
         #todo: Make sure there are no conflicts between built in instructions, functions and user defined functions
-        print(self.table.top_level)
-        print(self.table.functions)
 
         self.breaks = []
         self.continues = []
@@ -31,6 +49,10 @@ class _Compiler(hr.Walker):
     def generic_walk(self, node):
         raise Exception(f"Node {type(node).__name__} not implemented for compiler")
 
+    # Location of the next instruction to be emitted
+    def location(self):
+        return self.base + len(self.instructions)
+
     def is_name_global(self, id):
         return id in self.table.top_level
 
@@ -39,19 +61,35 @@ class _Compiler(hr.Walker):
         global_var_count = len(self.table.top_level)
 
         if global_var_count != 0:
-            self.instructions.append(ir.GlobalAlloc(global_var_count))
+            self.instructions.emit(ir.GlobalAlloc, global_var_count)
 
         self.traverse(node.body)
 
     def visit_FunctionDef(self, node):
         self.context = self.table.functions[node.name]
 
-        self.function_locations[node.name] = len(self.instructions)
+        self.function_locations[node.name] = self.location()
 
-        self.instructions.append(ir.LocalAlloc(self.table.count_locals(node.name)))
+        start = self.instructions.emit(ir.LocalAlloc, self.table.count_locals(node.name))
+        calls_start = len(self.calls)
 
         self.traverse(node.body)
 
+        # Functions that fall off the end return as if they ended with a bare return
+        if len(node.body) == 0 or type(node.body[-1]) != hr.Return:
+            self.visit_Return(hr.Return(node.lineno, None))
+
+        end = len(self.instructions)
+
+        self.function_ranges[node.name] = (start, end)
+
+        if self.reuse_slots:
+            slots.allocate_slots(self.instructions, start, end, self.base)
+
+        self.analyse_stack(start, end, node.name, dict(self.calls[calls_start:]))
+
+        self.local_purity[node.name] = purity.region_is_pure(self.instructions, start, end)
+
         self.context = None
 
     def visit_Return(self, node):
@@ -59,114 +97,258 @@ class _Compiler(hr.Walker):
 
         if node.value is not None:
             self.traverse(node.value)
+        else:
+            self.instructions.emit(ir.OpStackPushLiteral, 0)
 
-        self.instructions.append(ir.Return(len(self.context[1].args)))
+        self.instructions.emit(ir.Return, len(self.context[1].args))
 
     def visit_Expr(self, node):
         self.traverse(node.expr)
 
-    def visit_Assign(self, node):
-        if isinstance(node.lhs, hr.Subscript):
-            raise Exception(f"Subscript assignment not supported yet")
+        # Built in instructions leave nothing behind, anything else (including every user call) leaves an unused value
+        if not (isinstance(node.expr, hr.Call) and node.expr.func in self.bi_instructions):
+            self.instructions.emit(ir.OpStackPop)
+
+    # Work out the maximum op stack depth of [start, end), rejecting unbalanced code (see stackdepth.py)
+    def analyse_stack(self, start, end, name, calls: dict):
+        depth, sites = stackdepth.analyse_region(self.instructions, start, end, self.base)
+
+        self.stack_depths[name] = max(self.stack_depths.get(name, 0), depth)
+        self.call_depths.setdefault(name, []).extend((d, calls[index]) for d, index in sites)
+
+    # Analyse the top level code, i.e. everything in self.instructions outside of a function
+    def analyse_top_level(self):
+        calls = dict(self.calls)
+        position = 0
+
+        for start, end in sorted(self.function_ranges.values()):
+            if position < start:
+                self.analyse_stack(position, start, None, calls)
+            position = end
+
+        if position < len(self.instructions):
+            self.analyse_stack(position, len(self.instructions), None, calls)
+
+        self.stack_depths.setdefault(None, 0)
+
+    # Record the stack analysis in the compiled output
+    def record_stack_depths(self, program: InstructionStream):
+        program.stack_depths = self.stack_depths
+        program.max_stack_depth = stackdepth.program_bound(self.stack_depths, self.call_depths)
+
+    # Record the location and arg count of every pure function in the compiled output, and mark the pure FunctionDefs of
+    # module if given
+    def record_purity(self, program: InstructionStream, module: hr.Module | None = None):
+        pure = purity.pure_functions(self.local_purity, self.call_depths)
+
+        program.pure_functions = {self.function_locations[name]: self.table.count_args(name) for name in pure}
 
+        if module is not None:
+            for node in module.body:
+                if type(node) == hr.FunctionDef:
+                    node.pure = node.name in pure
+
+    # Annotation of each global variable by offset, so the interpreter can lay out a typed global segment
+    def global_types(self):
+        return [symbol.annotation for symbol in sorted(self.table.top_level.values(), key=lambda x : x.stack_offset)]
+
+    def visit_Assign(self, node):
         self.traverse(node.rhs)
 
+        if isinstance(node.lhs, hr.Subscript):
+            self.traverse(node.lhs.index)
+            self.instructions.emit(ir.MemoryStore, self.memory_block(node.lhs))
+            return
+
         if self.is_name_global(node.lhs.id):
-            self.instructions.append(ir.OpStackPopGlobal(self.table.top_level[node.lhs.id].stack_offset))
+            self.instructions.emit(ir.OpStackPopGlobal, self.table.top_level[node.lhs.id].stack_offset)
         else:
             symbol = self.context[0][node.lhs.id]
             if symbol.is_arg:
-                self.instructions.append(ir.OpStackPopArg(symbol.stack_offset))
+                self.instructions.emit(ir.OpStackPopArg, symbol.stack_offset)
             else:
-                self.instructions.append(ir.OpStackPopLocal(symbol.stack_offset))
+                self.instructions.emit(ir.OpStackPopLocal, symbol.stack_offset)
 
     def visit_Break(self, node):
-        b = ir.Jump(None)
-        self.instructions.append(b)
+        b = self.instructions.emit(ir.Jump, None)
         self.breaks.append(b)
 
     def visit_Continue(self, node):
-        b = ir.Jump(None)
-        self.instructions.append(b)
+        b = self.instructions.emit(ir.Jump, None)
         self.continues.append(b)
 
     def visit_Pass(self, node):
         pass
 
     def visit_Call(self, node):
-        if node.func in self.table.functions:
+        if node.func in self.table.arg_counts:
 
             #todo: make sure that the number of args in self.table.functions[node.func] matches len(node.args)
             if self.table.count_args(node.func) != len(node.args):
                 raise Exception(f"User defined function '{node.func}' expects {self.table.count_args(node.func)} args, found {len(node.args)}. (lineno: {node.lineno})")
 
-            for a in reversed(node.args):
-                self.traverse(a)
-                self.instructions.append(ir.OpStackPopToCallStack())
-            #Call contains a string identifying the caller which is later replaced by an address-like index
-            self.instructions.append(ir.Call(node.func))
+            self.emit_user_call(node)
         elif node.func in self.bi_instructions:
             expected_arg_count = self.bi_instructions[node.func]
 
             if expected_arg_count != len(node.args):
                 raise Exception(f"Built in instruction '{node.func}' expects {expected_arg_count} args, found {len(node.args)}. (lineno: {node.lineno})")
 
-            self.instructions.append(ir.BuiltInInstruction(node.func, self.traverse(node.args)))
+            self.traverse(node.args)
+            self.instructions.emit(ir.BuiltInInstruction, node.func, len(node.args))
+        elif node.func in self.bi_functions:
+            expected_arg_count = self.bi_functions[node.func]
+
+            if expected_arg_count != len(node.args):
+                raise Exception(f"Built in function '{node.func}' expects {expected_arg_count} args, found {len(node.args)}. (lineno: {node.lineno})")
+
+            self.traverse(node.args)
+            self.instructions.emit(ir.BuiltInFunction, node.func, len(node.args))
+        elif node.func in memory.operations:
+            self.emit_bulk_memory(node)
+        else:
+            raise Exception(f"Function '{node.func}' is not defined. (lineno: {node.lineno})")
+
+    def emit_user_call(self, node):
+        for a in reversed(node.args):
+            self.traverse(a)
+            self.instructions.emit(ir.OpStackPopToCallStack)
+        #Call location is filled in with an address-like index once every function has been placed
+        self.calls.append((self.instructions.emit(ir.Call, None), node.func))
+
+    # Emit code that jumps if the truth of node is sense and falls through otherwise, without leaving anything on the op
+    # stack. The jumps are added to jumps for the caller to patch. and/or/not are compiled to chains of conditional jumps
+    # straight to the target, so the remaining operands of and/or are skipped as soon as the outcome is known
+    def branch(self, node, sense: bool, jumps: list):
+        if isinstance(node, hr.BinOp) and type(node.operator) in (ast.And, ast.Or):
+            # a and b is false as soon as a is false, a or b is true as soon as a is true
+            short_circuit = type(node.operator) == ast.Or
+
+            if sense == short_circuit:
+                self.branch(node.left, sense, jumps)
+                self.branch(node.right, sense, jumps)
+            else:
+                skip = []
+                self.branch(node.left, short_circuit, skip)
+                self.branch(node.right, sense, jumps)
+                for jump in skip:
+                    self.instructions.patch(jump, "location", self.location())
+        elif isinstance(node, hr.UnaryOp) and type(node.operator) == ast.Not:
+            self.branch(node.operand, not sense, jumps)
         else:
-            #todo: implement the built in functions and instructions
-            raise Exception(f"Built in functions and instructions not currently supported")
+            self.traverse(node)
+            jumps.append(self.instructions.emit(ir.JumpIfTrue if sense else ir.JumpIfFalse, None))
 
     def visit_If(self, node):
-        end = ir.JumpIfFalse(None)
-
-        self.traverse(node.condition)
+        false_jumps = []
 
-        self.instructions.append(end)
+        self.branch(node.condition, False, false_jumps)
 
         self.traverse(node.body)
 
-        end.location = len(self.instructions)
+        end_location = self.location()
 
         if len(node.orelse) != 0 and node.orelse is not None:
-            else_jump = ir.Jump(None)
-            end.location += 1
+            end_location += 1
 
-            self.instructions.append(else_jump)
+            else_jump = self.instructions.emit(ir.Jump, None)
 
             self.traverse(node.orelse)
 
-            else_jump.location = len(self.instructions)
+            self.instructions.patch(else_jump, "location", self.location())
+
+        for jump in false_jumps:
+            self.instructions.patch(jump, "location", end_location)
 
 
     def visit_While(self, node):
-        condition_jump = ir.JumpIfFalse(None)
+        # Breaks and continues of an enclosing loop are set aside until this loop is done
+        outer_breaks, outer_continues = self.breaks, self.continues
+        self.breaks, self.continues = [], []
 
-        start_location = len(self.instructions)
+        start_location = self.location()
 
-        self.traverse(node.condition)
+        condition_jumps = []
 
-        self.instructions.append(condition_jump)
+        self.branch(node.condition, False, condition_jumps)
 
         self.traverse(node.body)
 
-        self.instructions.append(ir.Jump(start_location))
+        self.instructions.emit(ir.Jump, start_location)
 
-        condition_jump.location = len(self.instructions)
+        for jump in condition_jumps:
+            self.instructions.patch(jump, "location", self.location())
 
         if len(node.orelse) != 0 and node.orelse is not None:
             self.traverse(node.orelse)
 
-        break_location = len(self.instructions)
+        break_location = self.location()
 
         for breaker in self.breaks:
-            breaker.location = break_location
+            self.instructions.patch(breaker, "location", break_location)
 
         self.breaks = []
 
         for continuer in self.continues:
-            continuer.location = start_location
+            self.instructions.patch(continuer, "location", start_location)
+
+        self.breaks, self.continues = outer_breaks, outer_continues
+
+    # range() loops compile to a ForRangeInit before the body and a single ForRangeNext after it, which steps the counter,
+    # tests it and branches back in one instruction
+    def visit_For(self, node):
+        if isinstance(node.assignable, hr.Subscript):
+            raise Exception(f"Subscript loop counters not supported yet")
+
+        for bound in (node.start, node.end, node.step):
+            if type(bound) is not int:
+                raise Exception(f"range() bounds must be int constants (line: {node.lineno})")
+
+        if node.step == 0:
+            raise Exception(f"range() step must not be zero (line: {node.lineno})")
+
+        outer_breaks, outer_continues = self.breaks, self.continues
+        self.breaks, self.continues = [], []
+
+        # See symbols.hidden_counter
+        counter = hidden_counter(node, self.is_name_global(node.assignable.id))
+
+        scope, offset = self.variable(counter or node.assignable.id)
+
+        init = self.instructions.emit(ir.ForRangeInit, scope, offset, node.start, node.end, node.step, None)
+
+        body_location = self.location()
+
+        if counter is not None:
+            self.visit_Assign(hr.Assign(node.lineno, node.assignable, hr.Name(node.lineno, counter)))
+
+        self.traverse(node.body)
+
+        next_location = self.location()
+
+        self.instructions.emit(ir.ForRangeNext, scope, offset, node.end, node.step, body_location)
+
+        break_location = self.location()
+
+        self.instructions.patch(init, "location", break_location)
+
+        for breaker in self.breaks:
+            self.instructions.patch(breaker, "location", break_location)
+
+        for continuer in self.continues:
+            self.instructions.patch(continuer, "location", next_location)
+
+        self.breaks, self.continues = outer_breaks, outer_continues
+
+    # Scope (see ir.SCOPE_LOCAL etc.) and offset of a variable
+    def variable(self, id):
+        if self.is_name_global(id):
+            return ir.SCOPE_GLOBAL, self.table.top_level[id].stack_offset
+
+        symbol = self.context[0][id]
+
+        return (ir.SCOPE_ARG if symbol.is_arg else ir.SCOPE_LOCAL), symbol.stack_offset
 
-        self.continues = []
 
 
 
@@ -174,44 +356,102 @@ class _Compiler(hr.Walker):
 
 
 
+    # Block number of a subscripted memory block (see memory.py)
+    def memory_block(self, node):
+        block = memory.block_number(node.name)
+
+        if block is None:
+            raise Exception(f"'{node.name}' is not a memory block, memory blocks are named mem, mem1, mem2, ... (lineno: {node.lineno})")
+
+        return block
+
+    def visit_Subscript(self, node):
+        self.traverse(node.index)
+        self.instructions.emit(ir.MemoryLoad, self.memory_block(node))
+
+    # Ranges are passed as the block number followed by the index of the first word
+    def emit_bulk_memory(self, node):
+        kinds = memory.operations[node.func]
+
+        if len(kinds) != len(node.args):
+            raise Exception(f"Bulk memory operation '{node.func}' expects {len(kinds)} args, found {len(node.args)}. (lineno: {node.lineno})")
+
+        for kind, arg in zip(kinds, node.args):
+            if kind == "range":
+                if not isinstance(arg, hr.Subscript):
+                    raise Exception(f"Bulk memory operation '{node.func}' expects a memory range such as mem[0], found {type(arg).__name__}. (lineno: {node.lineno})")
+
+                self.instructions.emit(ir.OpStackPushLiteral, self.memory_block(arg))
+                self.traverse(arg.index)
+            else:
+                self.traverse(arg)
+
+        self.instructions.emit(ir.MemoryBulk, node.func, len(kinds) + kinds.count("range"))
 
     def visit_Name(self, node):
         if self.is_name_global(node.id):
-            self.instructions.append(ir.OpStackPushGlobal(self.table.top_level[node.id].stack_offset))
+            self.instructions.emit(ir.OpStackPushGlobal, self.table.top_level[node.id].stack_offset)
         else:
             symbol = self.context[0][node.id]
             if symbol.is_arg:
-                self.instructions.append(ir.OpStackPushArg(symbol.stack_offset))
+                self.instructions.emit(ir.OpStackPushArg, symbol.stack_offset)
             else:
-                self.instructions.append(ir.OpStackPushLocal(symbol.stack_offset))
+                self.instructions.emit(ir.OpStackPushLocal, symbol.stack_offset)
 
     def visit_Constant(self, node):
-        self.instructions.append(ir.OpStackPushLiteral(node.value))
+        self.instructions.emit(ir.OpStackPushLiteral, node.value)
+
+    # Operands of a chain of the same boolean operator, i.e. [a, b, c] for a and b and c
+    def bool_operands(self, node, operator):
+        if isinstance(node, hr.BinOp) and type(node.operator) == operator:
+            return self.bool_operands(node.left, operator) + self.bool_operands(node.right, operator)
+        return [node]
+
+    # a and b and c leaves the first false operand (or c) on the op stack, a or b or c the first true one (or c). Every
+    # operand but the last is kept with a duplicate that the conditional jump consumes, then dropped if evaluation goes on
+    def visit_BoolOp(self, node):
+        operator = type(node.operator)
+        operands = self.bool_operands(node, operator)
+        end_jumps = []
+
+        for operand in operands[:-1]:
+            self.traverse(operand)
+            self.instructions.emit(ir.OpStackDuplicate)
+            end_jumps.append(self.instructions.emit(ir.JumpIfFalse if operator == ast.And else ir.JumpIfTrue, None))
+            self.instructions.emit(ir.OpStackPop)
+
+        self.traverse(operands[-1])
+
+        for jump in end_jumps:
+            self.instructions.patch(jump, "location", self.location())
 
     def visit_BinOp(self, node):
 
+        if type(node.operator) in (ast.And, ast.Or):
+            return self.visit_BoolOp(node)
+
         self.traverse(node.left)
         self.traverse(node.right)
 
         op = type(node.operator)
         if op == ast.Add:
-            self.instructions.append(ir.Add())
+            self.instructions.emit(ir.Add)
         elif op == ast.Mult:
-            self.instructions.append(ir.Multiply())
+            self.instructions.emit(ir.Multiply)
         elif op == ast.Sub:
-            self.instructions.append(ir.Sub())
+            self.instructions.emit(ir.Sub)
         elif op == ast.Eq:
-            self.instructions.append(ir.Equal())
+            self.instructions.emit(ir.Equal)
         elif op == ast.NotEq:
-            self.instructions.append(ir.NotEqual())
+            self.instructions.emit(ir.NotEqual)
         elif op == ast.Lt:
-            self.instructions.append(ir.LessThan())
+            self.instructions.emit(ir.LessThan)
         elif op == ast.Gt:
-            self.instructions.append(ir.GreaterThan())
+            self.instructions.emit(ir.GreaterThan)
         elif op == ast.LtE:
-            self.instructions.append(ir.LessThanEqualTo())
+            self.instructions.emit(ir.LessThanEqualTo)
         elif op == ast.GtE:
-            self.instructions.append(ir.GreaterThanEqualTo())
+            self.instructions.emit(ir.GreaterThanEqualTo)
         else:
             #todo: Add support for remaining binops
             raise Exception(f"Bin op {op.__name__} is not supported yet")
@@ -222,25 +462,46 @@ class _Compiler(hr.Walker):
 
         op = type(node.operator)
         if op == ast.Invert:
-            self.instructions.append(ir.OnesComplement())
+            self.instructions.emit(ir.OnesComplement)
         elif op == ast.Not:
-            self.instructions.append(ir.LogicalNot())
+            self.instructions.emit(ir.LogicalNot)
         elif op == ast.UAdd:
-            self.instructions.append(ir.UnaryPositive())
+            self.instructions.emit(ir.UnaryPositive)
         elif op == ast.USub:
-            self.instructions.append(ir.UnaryNegative())
+            self.instructions.emit(ir.UnaryNegative)
         else:
             raise Exception(f"Invalid unary op {op.__name__}")
 
 
 
-def compile(ast: hr.Module, table: Symbols, extra_instructions: dict, extra_functions: dict):
-    c = _Compiler(table, extra_instructions, extra_functions)
+# If features (see features.py) is given, the output is checked to only use the instructions of those features.
+#
+# If optimise is set the HR passes of optimise.py run over ast first, and if layout is set dead functions are dropped and
+# the rest laid out hot first by callgraph.py (using profile, see callgraph.reorder_functions). Both change ast in place
+# and add or drop symbols, so the table is rebuilt from the changed module.
+def compile(ast: hr.Module, table: Symbols, extra_instructions: dict, extra_functions: dict, reuse_slots: bool = False, features=None,
+            optimise: bool = False, layout: bool = False, profile: dict | None = None):
+    if optimise:
+        optimiser.optimise(ast)
+    if layout:
+        callgraph.reorder_functions(ast, profile)
+    if optimise or layout:
+        table = Symbols(ast)
+
+    c = _Compiler(table, extra_instructions, extra_functions, reuse_slots)
     c.walk(ast)
 
     # Loop over all calls replace the functions names with function indices
-    for instruction in c.instructions:
-        if type(instruction) == ir.Call:
-            instruction.location = c.function_locations[instruction.location]
+    for index, name in c.calls:
+        c.instructions.patch(index, "location", c.function_locations[name])
+
+    c.analyse_top_level()
+    c.record_stack_depths(c.instructions)
+    c.record_purity(c.instructions, ast)
+    c.instructions.global_types = c.global_types()
+    c.instructions.function_locations = dict(c.function_locations)
+
+    if features is not None:
+        features.validate(c.instructions)
 
     return c.instructions
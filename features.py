@@ -0,0 +1,374 @@
+import ir
+import interpreter
+import memory
+import tracing
+from stream import InstructionStream
+
+# Feature configurations (see the readme) and interpreters specialised to them.
+#
+# A Features object is the set of features a VM supports. The compiler can check that its output only uses the
+# instructions of those features, and build_interpreter generates an interpreter class that only has handlers (and
+# state, e.g. the call stack and base pointer) for those instructions.
+#
+# The generated interpreter is a single run loop whose if/elif dispatch chain only contains the enabled opcodes, most
+# frequent first. Arithmetic and comparisons use the same code templates as the trace JIT (see tracing.py). Generated
+# classes are cached by feature set, so building the same configuration twice is free.
+#
+# Ternary and Assert are not emitted by the compiler or run by the interpreter yet, so belong to no feature.
+#
+# Finish is part of every configuration (CORE): the linker, lazy compilation, program images and the verifier all end
+# code with one, whatever the features.
+
+FEATURES = {
+    # Values on the op stack, needed by everything that computes a value
+    "operand_stack": {ir.OpStackPushLiteral, ir.OpStackPop, ir.OpStackDuplicate},
+    "arithmetic": {ir.Add, ir.Sub, ir.Multiply, ir.UnaryNegative, ir.UnaryPositive, ir.OnesComplement},
+    "comparisons": {ir.Equal, ir.NotEqual, ir.LessThan, ir.GreaterThan, ir.LessThanEqualTo, ir.GreaterThanEqualTo, ir.LogicalNot},
+    "conversions": {ir.ConvertIntToFloat, ir.ConvertFloatToInt},
+    "jumps": {ir.Jump},
+    "conditional_jumps": {ir.JumpIfTrue, ir.JumpIfFalse},
+    "counted_loops": {ir.ForRangeInit, ir.ForRangeNext},
+    "subroutines": {ir.Call, ir.Return, ir.LocalAlloc, ir.OpStackPushLocal, ir.OpStackPopLocal, ir.OpStackPushArg, ir.OpStackPopArg, ir.OpStackPopToCallStack},
+    "globals": {ir.GlobalAlloc, ir.OpStackPushGlobal, ir.OpStackPopGlobal},
+    "built_ins": {ir.BuiltInInstruction, ir.BuiltInFunction},
+    # Memory blocks, mem[x], and the bulk operations over them (see memory.py)
+    "memory": {ir.MemoryLoad, ir.MemoryStore, ir.MemoryBulk},
+}
+
+# Instructions every feature set allows
+CORE = {ir.Finish}
+
+# Each feature needs every feature in each of its sets of alternatives, e.g. conditional jumps need the operand stack,
+# and arithmetic or comparisons to produce something to test
+REQUIREMENTS = {
+    "arithmetic": [{"operand_stack"}],
+    "comparisons": [{"operand_stack"}],
+    "conversions": [{"operand_stack"}, {"arithmetic"}],
+    "conditional_jumps": [{"operand_stack"}, {"arithmetic", "comparisons"}],
+    "subroutines": [{"operand_stack"}],
+    "globals": [{"operand_stack"}],
+    "memory": [{"operand_stack"}],
+}
+
+
+class Features:
+    def __init__(self, *names: str):
+        for name in names:
+            if name not in FEATURES:
+                raise Exception(f"Unknown feature '{name}', expected one of {list(FEATURES)}")
+
+        self.names = frozenset(names)
+
+        for name in self.names:
+            for alternatives in REQUIREMENTS.get(name, []):
+                if not alternatives & self.names:
+                    raise Exception(f"Feature '{name}' requires {' or '.join(repr(a) for a in sorted(alternatives))}")
+
+        self.instructions = CORE | {cls for name in self.names for cls in FEATURES[name]}
+        self.opcodes = frozenset(cls.opcode for cls in self.instructions)
+
+    # Raise if the instructions [start, end) (by default all) of the program use an instruction outside the features.
+    # base is the location of the stream in the program, for programs compiled a chunk at a time (see streaming.py)
+    def validate(self, stream: InstructionStream, start: int = 0, end: int | None = None, base: int = 0):
+        end = len(stream) if end is None else end
+
+        if set(stream.opcodes[start:end]) <= self.opcodes:
+            return
+
+        for index in range(start, end):
+            if stream.opcodes[index] not in self.opcodes:
+                cls = stream.type(index)
+                raise Exception(f"{cls.__name__} at location {base + index} needs feature '{feature_of(cls)}', which is not enabled in {self}")
+
+    @classmethod
+    def all(cls) -> "Features":
+        return cls(*FEATURES)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def __eq__(self, other):
+        return isinstance(other, Features) and self.names == other.names
+
+    def __hash__(self):
+        return hash(self.names)
+
+    def __repr__(self):
+        return f"Features({', '.join(repr(name) for name in sorted(self.names))})"
+
+
+# Feature that provides an instruction
+def feature_of(instruction: type) -> str | None:
+    for name, instructions in FEATURES.items():
+        if instruction in instructions:
+            return name
+    return None
+
+
+
+# Code of the branch handling each instruction in the run loop. Handlers that change pc end with continue
+_handlers = {
+    ir.Call: """
+        call_stack.append(LinkAddress(pc + 1))
+        pc = operands[starts[pc]]
+        continue""",
+    ir.LocalAlloc: """
+        call_stack.append(BasePointer(bp))
+        bp = len(call_stack) - 1
+        call_stack.extend([LocalVariable(None) for _ in range(operands[starts[pc]])])""",
+    ir.Return: """
+        arg_count = operands[starts[pc]]
+        del call_stack[bp+1:]
+        bp = call_stack.pop().inner
+        pc = call_stack.pop().inner
+        if arg_count != 0:
+            del call_stack[-arg_count:]
+        continue""",
+    ir.GlobalAlloc: """
+        if self.shared_globals is None:
+            count = operands[starts[pc]]
+            layout = instructions.global_types if len(instructions.global_types) == count else ["int"] * count
+            self.globals = GlobalSegment(layout)
+            global_views = self.globals.views""",
+    ir.OpStackPushLocal: """
+        op_stack.append(call_stack[bp+operands[starts[pc]]+1])""",
+    ir.OpStackPopLocal: """
+        call_stack[bp+operands[starts[pc]]+1] = op_stack.pop()""",
+    ir.OpStackPushArg: """
+        op_stack.append(call_stack[bp-2 - operands[starts[pc]]].inner)""",
+    ir.OpStackPopArg: """
+        call_stack[bp-2 - operands[starts[pc]]].inner = op_stack.pop()""",
+    ir.OpStackPushGlobal: """
+        offset = operands[starts[pc]]
+        op_stack.append(global_views[offset][offset])""",
+    ir.OpStackPopGlobal: """
+        offset = operands[starts[pc]]
+        value = op_stack.pop()
+        if type(value) is float:
+            check_global_store(global_views, offset, value)
+        global_views[offset][offset] = value""",
+    ir.OpStackPopToCallStack: """
+        call_stack.append(Argument(op_stack.pop()))""",
+    ir.OpStackPop: """
+        op_stack.pop()""",
+    ir.OpStackDuplicate: """
+        op_stack.append(op_stack[-1])""",
+    ir.OpStackPushLiteral: """
+        op_stack.append(constants[operands[starts[pc]]])""",
+    ir.BuiltInInstruction: """
+        start = starts[pc]
+        name = constants[operands[start]]
+        if name == "finish":
+            break
+        arg_count = operands[start + 1]
+        args = op_stack[len(op_stack) - arg_count:]
+        del op_stack[len(op_stack) - arg_count:]
+        built_ins[name](*args)""",
+    ir.BuiltInFunction: """
+        start = starts[pc]
+        arg_count = operands[start + 1]
+        args = op_stack[len(op_stack) - arg_count:]
+        del op_stack[len(op_stack) - arg_count:]
+        op_stack.append(built_ins[constants[operands[start]]](*args))""",
+    ir.Finish: """
+        break""",
+    ir.Jump: """
+        pc = operands[starts[pc]]
+        continue""",
+    ir.JumpIfTrue: """
+        if op_stack.pop() != 0:
+            pc = operands[starts[pc]]
+            continue""",
+    ir.JumpIfFalse: """
+        if op_stack.pop() == 0:
+            pc = operands[starts[pc]]
+            continue""",
+    ir.ConvertIntToFloat: """
+        op_stack.append(float(op_stack.pop()))""",
+    ir.ConvertFloatToInt: """
+        op_stack.append(int(op_stack.pop()))""",
+    ir.MemoryLoad: """
+        block = operands[starts[pc]]
+        index = op_stack.pop()
+        if not 0 <= index < len(blocks[block]):
+            raise Exception(f"Memory access {block_name(block)}[{index}] is outside the block, which holds {len(blocks[block])} words")
+        op_stack.append(blocks[block][index])""",
+    ir.MemoryStore: """
+        block = operands[starts[pc]]
+        index = op_stack.pop()
+        if not 0 <= index < len(blocks[block]):
+            raise Exception(f"Memory access {block_name(block)}[{index}] is outside the block, which holds {len(blocks[block])} words")
+        value = op_stack.pop()
+        if type(value) is float:
+            check_store(blocks[block], value, f"Assignment to {block_name(block)}[{index}]")
+        blocks[block][index] = value""",
+    ir.MemoryBulk: """
+        start = starts[pc]
+        arg_count = operands[start + 1]
+        args = op_stack[len(op_stack) - arg_count:]
+        del op_stack[len(op_stack) - arg_count:]
+        op_stack.append(bulk(constants[operands[start]], args))""",
+}
+
+for _opcode, _template in tracing.templates.items():
+    if "{b}" in _template:
+        _handlers[ir.opcodes[_opcode]] = f"""
+        b = op_stack.pop()
+        a = op_stack.pop()
+        op_stack.append({_template.format(a="a", b="b")})"""
+    else:
+        _handlers[ir.opcodes[_opcode]] = f"""
+        op_stack.append({_template.format(a="op_stack.pop()")})"""
+
+
+# ForRange instructions only handle the scopes the features can produce, locals and args need subroutines
+def _counter(scope: int) -> str:
+    if scope == ir.SCOPE_LOCAL:
+        return "call_stack[bp+offset+1]"
+    if scope == ir.SCOPE_ARG:
+        return "call_stack[bp-2 - offset].inner"
+    return "global_views[offset][offset]"
+
+
+def _scoped(features: Features, line: str) -> list[str]:
+    scopes = []
+
+    if "subroutines" in features:
+        scopes += [ir.SCOPE_LOCAL, ir.SCOPE_ARG]
+    if "globals" in features:
+        scopes.append(ir.SCOPE_GLOBAL)
+
+    code = []
+
+    for i, scope in enumerate(scopes):
+        keyword = "if" if i == 0 else "elif"
+        code.append(f"{keyword} scope == {scope}:")
+        code.append("    " + line.format(counter=_counter(scope)))
+
+    return code
+
+
+def _for_range_handlers(features: Features) -> dict:
+    init = [
+        "start = starts[pc]",
+        "scope, offset, value, stop, step, location = operands[start:start + 6]",
+        "if (value >= stop) if step > 0 else (value <= stop):",
+        "    pc = location",
+        "    continue",
+    ] + _scoped(features, "{counter} = value")
+
+    next = [
+        "start = starts[pc]",
+        "scope, offset, stop, step, location = operands[start:start + 5]",
+    ] + _scoped(features, "value = {counter} + step") + [
+        "if (value < stop) if step > 0 else (value > stop):",
+    ] + ["    " + line for line in _scoped(features, "{counter} = value")] + [
+        "    pc = location",
+        "    continue",
+    ]
+
+    return {
+        ir.ForRangeInit: "".join("\n        " + line for line in init),
+        ir.ForRangeNext: "".join("\n        " + line for line in next),
+    }
+
+
+# Rough order of how often each instruction runs, so the common ones are tested first in the dispatch chain
+_frequency = [
+    ir.OpStackPushLocal, ir.OpStackPushLiteral, ir.OpStackPushGlobal, ir.OpStackPopLocal, ir.OpStackPopGlobal,
+    ir.Add, ir.JumpIfFalse, ir.Jump, ir.ForRangeNext, ir.LessThan, ir.Sub, ir.Multiply, ir.OpStackPushArg, ir.Call,
+    ir.LocalAlloc, ir.Return, ir.OpStackPopToCallStack,
+]
+
+_built = {}
+
+
+def generate_source(features: Features) -> str:
+    handlers = dict(_handlers)
+    handlers.update(_for_range_handlers(features))
+
+    order = [cls for cls in _frequency if cls in features.instructions]
+    order += sorted(features.instructions - set(order), key=lambda cls: cls.opcode)
+
+    subroutines = "subroutines" in features
+
+    lines = [
+        "class SpecialisedInterpreter:",
+        "    def __init__(self, globals=None, built_ins=None, memory=None):",
+        "        self.globals = globals",
+        "        self.shared_globals = globals",
+        "        self.memory = memory if isinstance(memory, Memory) else Memory(memory or [])",
+        "        self.built_ins = {'print': lambda value: print(f'Print function: {value}')}",
+        "        if built_ins is not None:",
+        "            self.built_ins.update(built_ins)",
+        "",
+        "    def run(self, instructions):",
+        "        if not isinstance(instructions, InstructionStream):",
+        "            instructions = InstructionStream.from_instructions(instructions)",
+        "        FEATURES.validate(instructions)",
+        "        opcodes = instructions.opcodes",
+        "        starts = instructions.starts",
+        "        operands = instructions.operands",
+        "        constants = instructions.constants",
+        "        built_ins = self.built_ins",
+        "        global_views = self.shared_globals.views if self.shared_globals is not None else []",
+        "        op_stack = []",
+    ]
+
+    if "memory" in features:
+        lines += ["        blocks = self.memory.blocks", "        bulk = self.memory.bulk", "        check_store = self.memory.check_store"]
+
+    if subroutines:
+        lines += ["        call_stack = []", "        bp = 0"]
+
+    lines += [
+        "        pc = 0",
+        "        end = len(opcodes)",
+        "        while pc < end:",
+        "            op = opcodes[pc]",
+    ]
+
+    for i, cls in enumerate(order):
+        keyword = "if" if i == 0 else "elif"
+        lines.append(f"            {keyword} op == {cls.opcode}:  # {cls.__name__}")
+        lines += ["        " + line for line in handlers[cls].strip("\n").split("\n")]
+
+    lines += [
+        "            else:",
+        "                raise Exception(f'Opcode {op} at location {pc} is not supported by this interpreter')",
+        "            pc += 1",
+    ]
+
+    return "\n".join(lines) + "\n"
+
+
+# An interpreter class that runs programs using only the given features. Instances take the same globals, built_ins and
+# memory as interpreter.Interpreter
+def build_interpreter(features: Features) -> type:
+    if features in _built:
+        return _built[features]
+
+    source = generate_source(features)
+
+    namespace = {
+        "InstructionStream": InstructionStream,
+        "GlobalSegment": interpreter.GlobalSegment,
+        "check_global_store": interpreter.check_global_store,
+        "LinkAddress": interpreter.LinkAddress,
+        "BasePointer": interpreter.BasePointer,
+        "LocalVariable": interpreter.LocalVariable,
+        "Argument": interpreter.Argument,
+        "Memory": memory.Memory,
+        "block_name": memory.block_name,
+        "FEATURES": features,
+    }
+
+    exec(compile(source, f"<interpreter {sorted(features.names)}>", "exec"), namespace)
+
+    cls = namespace["SpecialisedInterpreter"]
+    cls.features = features
+    cls.source = source
+
+    _built[features] = cls
+
+    return cls
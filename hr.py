@@ -115,25 +115,35 @@ class HRConstructor(ast.NodeVisitor):
         if type(node.iter) is not ast.Call:
             raise Exception(f"Loop iterator MUST be range(stop) or range(start, stop[, step])")
 
-        args = node.iter.args
+        args = [self.range_bound(a) for a in node.iter.args]
 
         start = 0
         stop = None
         step = 1
 
         if len(args) == 1:
-            stop = args[0].value
+            stop = args[0]
         elif len(args) == 2:
-            start = args[0].value
-            stop = args[1].value
+            start = args[0]
+            stop = args[1]
         elif len(args) == 3:
-            start = args[0].value
-            stop = args[1].value
-            step = args[2].value
+            start = args[0]
+            stop = args[1]
+            step = args[2]
 
         return For(node.lineno, self.traverse(node.target), start, stop, step, self.traverse(node.body))
 
 
+    # range() bounds must be constants, possibly negated
+    def range_bound(self, node):
+        if type(node) is ast.UnaryOp and type(node.op) is ast.USub and type(node.operand) is ast.Constant:
+            return -node.operand.value
+
+        if type(node) is not ast.Constant:
+            raise Exception(f"range() bounds must be constants (line: {node.lineno})")
+
+        return node.value
+
     def visit_While(self, node):
         return While(node.lineno, self.traverse(node.test), self.traverse(node.body), self.traverse(node.orelse))
 
@@ -233,6 +243,8 @@ class FunctionDef(HRNode):
         self.args = args
         self.body = body
         self.return_type = return_type
+        # Set by the compiler if calls to the function can be memoized (see purity.py)
+        self.pure = False
 
 # Includes ast.BinOp, ast.BoolOp and ast.Compare
 class BinOp(Expression):
@@ -0,0 +1,211 @@
+import json
+import mmap
+import struct
+from array import array
+
+import ir
+import verifier
+from stream import InstructionStream
+
+# On-disk executable images.
+#
+# An image holds a compiled program in a form that can be memory mapped and run without unpickling it:
+#
+#   magic | version | header length | header (JSON) | padding | opcodes | starts | operands | functions | names (JSON)
+#
+# The header holds the constant pool (literals and built in names), the metadata of the stream (stack_depths,
+# pure_functions, ...) and the file offset of each section. The code sections are the packed arrays of the
+# InstructionStream, written as they are in memory. The function table holds the location, end, arg count and local count
+# of each function as 64 bit integers, and its names are kept apart since they are only needed to look functions up by
+# name.
+#
+# write_image ends the code with a Finish if the program does not already end with one, so the image can be verified
+# (see verifier.py) without being changed.
+#
+# load_image maps the file and returns an ImageStream whose opcodes, starts and operands are memoryviews of the mapping,
+# so nothing is copied out of it: the code is only read in, a page at a time, as it runs, and every process running the
+# same image shares its pages. Only the header is decoded on load. Images are read only.
+#
+# load_image(path, verify=True) verifies the whole program (see verifier.py) before it runs, which reads all of its
+# code, so it is opt in. Otherwise the image is run as any other unverified program, checking pc on every instruction.
+
+MAGIC = b"GVMI"
+VERSION = 2
+
+# magic, version, header length
+_PREFIX = struct.Struct("<4sII")
+
+
+class FunctionEntry:
+    def __init__(self, name: str, location: int, end: int, arg_count: int, local_count: int):
+        self.name = name
+        self.location = location
+        # Location after the last instruction of the function
+        self.end = end
+        self.arg_count = arg_count
+        self.local_count = local_count
+
+    def __repr__(self):
+        return f"FunctionEntry({self.name!r}, location={self.location}, end={self.end}, arg_count={self.arg_count}, local_count={self.local_count})"
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+# Function table of a stream. Every LocalAlloc starts a function, which runs until the next one (or the end of the
+# program). Functions are named from names (name -> location), by default the function_locations the compiler recorded
+# on the stream, and functions without a name are called function_<location>
+def function_table(stream: InstructionStream, names: dict | None = None) -> list[FunctionEntry]:
+    by_location = {location: name for name, location in (stream.function_locations if names is None else names).items()}
+    entries = [i for i in range(len(stream)) if stream.opcodes[i] == ir.LocalAlloc.opcode]
+    table = []
+
+    for location, end in zip(entries, entries[1:] + [len(stream)]):
+        arg_count = 0
+
+        for i in range(location, end):
+            if stream.opcodes[i] == ir.Return.opcode:
+                arg_count = stream.operand(i, "arg_count")
+                break
+
+        name = by_location.get(location, f"function_{location}")
+        table.append(FunctionEntry(name, location, end, arg_count, stream.operand(location, "variable_count")))
+
+    return table
+
+
+def _metadata(stream: InstructionStream) -> dict:
+    return {
+        "stack_depths": list(stream.stack_depths.items()),
+        "max_stack_depth": stream.max_stack_depth,
+        "global_types": stream.global_types,
+        "pure_functions": list(stream.pure_functions.items()),
+    }
+
+
+def write_image(stream: InstructionStream, path: str, names: dict | None = None):
+    table = function_table(stream, names)
+
+    for value in stream.constants:
+        if type(value) not in (int, float, str):
+            raise Exception(f"Constant {value!r} can not be written to an image")
+
+    functions = array("q", [field for f in table for field in (f.location, f.end, f.arg_count, f.local_count)])
+    names = json.dumps([f.name for f in table]).encode()
+
+    opcodes = stream.opcodes.tobytes()
+    starts = stream.starts.tobytes()
+
+    if len(stream) == 0 or stream.opcodes[-1] != ir.Finish.opcode:
+        opcodes += bytes([ir.Finish.opcode])
+        starts += array("I", [len(stream.operands)]).tobytes()
+
+    sections = [opcodes, starts, stream.operands.tobytes(), functions.tobytes(), names]
+
+    # Offsets of the sections are only known once the header is encoded, so they are relative to the end of the header
+    offsets = [0]
+    for section in sections[:-1]:
+        offsets.append(_align(offsets[-1] + len(section)))
+
+    header = {
+        "length": len(opcodes),
+        "operand_count": len(stream.operands),
+        "function_count": len(table),
+        "constants": stream.constants,
+        "metadata": _metadata(stream),
+        "sections": offsets + [offsets[-1] + len(names)],
+    }
+
+    encoded = json.dumps(header).encode()
+    base = _align(_PREFIX.size + len(encoded))
+
+    with open(path, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(encoded)))
+        f.write(encoded)
+
+        for offset, section in zip(offsets, sections):
+            f.write(b"\0" * (base + offset - f.tell()))
+            f.write(section)
+
+
+# A stream backed by a memory mapped image, see load_image
+class ImageStream(InstructionStream):
+    def __init__(self, path: str):
+        super().__init__()
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, length = _PREFIX.unpack_from(self.map)
+
+        if magic != MAGIC:
+            raise Exception(f"'{path}' is not a program image")
+        if version != VERSION:
+            raise Exception(f"'{path}' is a version {version} program image, expected version {VERSION}")
+
+        header = json.loads(self.map[_PREFIX.size:_PREFIX.size + length])
+        base = _align(_PREFIX.size + length)
+
+        self.length = header["length"]
+        self.sections = [base + offset for offset in header["sections"]]
+
+        self.constants = header["constants"]
+
+        metadata = header["metadata"]
+        self.stack_depths = dict(metadata["stack_depths"])
+        self.max_stack_depth = metadata["max_stack_depth"]
+        self.global_types = metadata["global_types"]
+        self.pure_functions = dict(metadata["pure_functions"])
+
+        view = memoryview(self.map)
+        opcodes, starts, operands, functions, names, end = self.sections
+
+        self.opcodes = view[opcodes:opcodes + self.length]
+        self.starts = view[starts:starts + self.length * self.starts.itemsize].cast(self.starts.typecode)
+        self.operands = view[operands:operands + header["operand_count"] * self.operands.itemsize].cast(self.operands.typecode)
+        self.table = view[functions:names].cast("q")
+        self._functions = None
+
+        if self.length == 0 or self.opcodes[-1] != ir.Finish.opcode:
+            raise Exception(f"'{path}' is not a complete program image, its code does not end with a Finish")
+
+    def entry(self, index: int, name: str | None = None) -> FunctionEntry:
+        location, end, arg_count, local_count = self.table[4 * index:4 * index + 4]
+        return FunctionEntry(name or f"function_{location}", location, end, arg_count, local_count)
+
+    # Name -> FunctionEntry of every function, the names are decoded on first use
+    @property
+    def functions(self) -> dict:
+        if self._functions is None:
+            _, _, _, _, names, end = self.sections
+            self._functions = {name: self.entry(i, name) for i, name in enumerate(json.loads(self.map[names:end]))}
+        return self._functions
+
+    def emit(self, instruction: type, *operands):
+        raise Exception("Program images are read only")
+
+    def extend(self, other: InstructionStream, shift: int = 0, start: int = 0, end: int | None = None):
+        raise Exception("Program images are read only")
+
+    def patch(self, index: int, field: str, value):
+        raise Exception("Program images are read only")
+
+    # The views have to be released before the mapping can be closed
+    def close(self):
+        for view in (self.opcodes, self.starts, self.operands, self.table):
+            view.release()
+        self.map.close()
+
+    def __repr__(self):
+        return f"ImageStream(size={self.length}, functions={len(self.table) // 4})"
+
+
+# Map an image. If verify is True the program is verified (see verifier.py), which reads all of its code
+def load_image(path: str, verify: bool = False) -> ImageStream:
+    stream = ImageStream(path)
+
+    if verify:
+        verifier.verify(stream)
+
+    return stream
@@ -1,4 +1,53 @@
+import inspect
+import weakref
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
 import ir
+from lazy import LazyStream
+from memory import Memory, block_name
+from stream import InstructionStream
+from tracing import TraceJIT
+import verifier
+
+CALL = ir.Call.opcode
+LOCAL_ALLOC = ir.LocalAlloc.opcode
+GLOBAL_ALLOC = ir.GlobalAlloc.opcode
+RETURN = ir.Return.opcode
+PUSH_LOCAL = ir.OpStackPushLocal.opcode
+POP_LOCAL = ir.OpStackPopLocal.opcode
+PUSH_ARG = ir.OpStackPushArg.opcode
+POP_ARG = ir.OpStackPopArg.opcode
+PUSH_GLOBAL = ir.OpStackPushGlobal.opcode
+POP_GLOBAL = ir.OpStackPopGlobal.opcode
+POP_TO_CALL_STACK = ir.OpStackPopToCallStack.opcode
+POP = ir.OpStackPop.opcode
+DUPLICATE = ir.OpStackDuplicate.opcode
+PUSH_LITERAL = ir.OpStackPushLiteral.opcode
+BUILT_IN_INSTRUCTION = ir.BuiltInInstruction.opcode
+BUILT_IN_FUNCTION = ir.BuiltInFunction.opcode
+JUMP = ir.Jump.opcode
+JUMP_IF_TRUE = ir.JumpIfTrue.opcode
+JUMP_IF_FALSE = ir.JumpIfFalse.opcode
+EQUAL = ir.Equal.opcode
+NOT_EQUAL = ir.NotEqual.opcode
+LESS_THAN = ir.LessThan.opcode
+GREATER_THAN = ir.GreaterThan.opcode
+LESS_THAN_EQUAL_TO = ir.LessThanEqualTo.opcode
+GREATER_THAN_EQUAL_TO = ir.GreaterThanEqualTo.opcode
+ADD = ir.Add.opcode
+SUB = ir.Sub.opcode
+MULTIPLY = ir.Multiply.opcode
+UNARY_NEGATIVE = ir.UnaryNegative.opcode
+UNARY_POSITIVE = ir.UnaryPositive.opcode
+ONES_COMPLEMENT = ir.OnesComplement.opcode
+LOGICAL_NOT = ir.LogicalNot.opcode
+FOR_RANGE_INIT = ir.ForRangeInit.opcode
+FOR_RANGE_NEXT = ir.ForRangeNext.opcode
+FINISH = ir.Finish.opcode
+MEMORY_LOAD = ir.MemoryLoad.opcode
+MEMORY_STORE = ir.MemoryStore.opcode
+MEMORY_BULK = ir.MemoryBulk.opcode
 
 class CallStackItem:
     def __repr__(self):
@@ -8,6 +57,12 @@ class LinkAddress(CallStackItem):
     def __init__(self, inner):
         self.inner = inner
 
+# Link address of a call to a pure function, the return value is stored in the memo cache under key on return
+class MemoLinkAddress(CallStackItem):
+    def __init__(self, inner, key):
+        self.inner = inner
+        self.key = key
+
 class BasePointer(CallStackItem):
     def __init__(self, inner):
         self.inner = inner
@@ -21,32 +76,345 @@ class Argument(CallStackItem):
         self.inner = inner
 
 
+# Memory views reject float values in an int global with a bare TypeError, so stores of floats are checked first
+def check_global_store(views: list, offset: int, value):
+    if views[offset].format == "q":
+        raise Exception(f"Assignment to global {offset} can not store {type(value).__name__} values in an int global")
+
+
+# Global variables, stored as one machine word each in a preallocated buffer and indexed by Symbol.stack_offset.
+#
+# int globals are read and written through a 'q' view of the buffer and float globals through a 'd' view. views[offset]
+# is the view to use for each global, so an access is views[offset][offset]. The buffer can be backed by
+# multiprocessing.shared_memory so that a pool of VMs shares one copy of (read mostly) globals.
+class GlobalSegment:
+    def __init__(self, layout: list[str], buffer=None):
+        self.layout = layout
+        self.shared = None
+
+        if buffer is None:
+            buffer = bytearray(8 * len(layout))
+
+        self.memory = memoryview(buffer)[:8 * len(layout)]
+        self.ints = self.memory.cast("q")
+        self.floats = self.memory.cast("d")
+
+        self.views = [self.floats if annotation == "float" else self.ints for annotation in layout]
+
+    # Create a segment in a new block of shared memory. Other processes attach to it by name
+    @classmethod
+    def create_shared(cls, layout: list[str], name: str | None = None) -> "GlobalSegment":
+        # Shared memory blocks cannot be empty
+        shared = shared_memory.SharedMemory(name, create=True, size=max(8, 8 * len(layout)))
+        segment = cls(layout, shared.buf)
+        segment.shared = shared
+        return segment
+
+    @classmethod
+    def attach(cls, layout: list[str], name: str) -> "GlobalSegment":
+        shared = shared_memory.SharedMemory(name)
+        segment = cls(layout, shared.buf)
+        segment.shared = shared
+        return segment
+
+    @property
+    def name(self) -> str | None:
+        return self.shared.name if self.shared is not None else None
+
+    def __len__(self):
+        return len(self.layout)
+
+    def __getitem__(self, offset: int):
+        return self.views[offset][offset]
+
+    def __setitem__(self, offset: int, value):
+        if type(value) is float:
+            check_global_store(self.views, offset, value)
+        self.views[offset][offset] = value
+
+    # Release the views (and the shared memory mapping, if any). unlink destroys the shared memory block itself
+    def close(self):
+        self.views = []
+        self.ints.release()
+        self.floats.release()
+        self.memory.release()
+        if self.shared is not None:
+            self.shared.close()
+
+    def unlink(self):
+        if self.shared is not None:
+            self.shared.unlink()
+
+    def __repr__(self):
+        return f"GlobalSegment({[self[i] for i in range(len(self))]})"
+
+
+# Results of calls to pure functions, keyed by (program, location, args, types of the args), so that 1 and 1.0 are kept
+# apart and one cache can be shared by interpreters running different programs. maxsize None means unbounded. When full,
+# the "lru" policy evicts the least recently used result and "fifo" evicts the oldest
+class MemoCache:
+    policies = ("lru", "fifo")
+
+    def __init__(self, maxsize: int | None = 1024, policy: str = "lru"):
+        if policy not in MemoCache.policies:
+            raise Exception(f"Unknown memo cache policy '{policy}', expected one of {MemoCache.policies}")
+
+        if maxsize is not None and maxsize <= 0:
+            raise Exception(f"Memo cache size must be positive, found {maxsize}")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # id -> (weak reference, number) of each program seen. Numbers are never reused, unlike the ids of programs that
+        # have been freed
+        self.programs = {}
+        self.program_count = 0
+
+    # Number identifying a program in the keys
+    def program(self, instructions: InstructionStream) -> int:
+        entry = self.programs.get(id(instructions))
+
+        if entry is None or entry[0]() is not instructions:
+            entry = (weakref.ref(instructions), self.program_count)
+            self.programs[id(instructions)] = entry
+            self.program_count += 1
+
+        return entry[1]
+
+    def get(self, key):
+        entries = self.entries
+
+        if key in entries:
+            self.hits += 1
+            if self.policy == "lru":
+                entries.move_to_end(key)
+            return True, entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def store(self, key, value):
+        entries = self.entries
+        entries[key] = value
+
+        if self.maxsize is not None and len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"MemoCache(size={len(self.entries)}, maxsize={self.maxsize}, policy={self.policy}, hits={self.hits}, misses={self.misses})"
+
+
+
 class Interpreter:
 
-    def run(self, instructions: list[ir.Instruction]):
+    # If globals is given, every program uses that (possibly shared) segment and GlobalAlloc does not allocate a new one.
+    # Otherwise each run allocates a fresh segment, which is left in self.globals once the program ends.
+    # built_ins maps the name of each built in instruction or function to a callable taking its arguments. "finish" stops
+    # the program. Built ins may be coroutine functions (or return awaitables) if the program is run with run_async.
+    # If tracing is enabled, hot loops are recorded and compiled to Python functions (see tracing.py).
+    # If memoize is given (a MemoCache, or True for the default one) calls to pure functions are looked up in the cache.
+    # memory is a Memory, or a list of the blocks to create one from (see memory.py)
+    def __init__(self, globals: GlobalSegment | None = None, built_ins: dict | None = None, tracing: bool = False, hot_loop_threshold: int = 50,
+                 memoize: MemoCache | bool = False, verify: bool = False, memory: Memory | list | None = None):
+        self.globals = globals
+        self.shared_globals = globals
+
+        self.memory = memory if isinstance(memory, Memory) else Memory(memory or [])
+
+        # Verify programs before running them (see verifier.py)
+        self.verify = verify
+
+        if memoize is True:
+            memoize = MemoCache()
+
+        self.memo = memoize if isinstance(memoize, MemoCache) else None
+
+        self.built_ins = {"print": lambda value: print(f"Print function: {value}")}
+
+        if built_ins is not None:
+            self.built_ins.update(built_ins)
+
+        self.jit = TraceJIT(self.built_ins, hot_loop_threshold) if tracing else None
+
+    # Add a built in instruction or function
+    def register(self, name: str, function):
+        self.built_ins[name] = function
+
+    def run(self, instructions: InstructionStream | list[ir.Instruction]):
+        for pending in self.execute(instructions):
+            if inspect.iscoroutine(pending):
+                pending.close()
+            raise Exception(f"A built in returned an awaitable, use run_async to run programs with asynchronous built ins")
+
+    # Run the program on the asyncio event loop. Whenever a built in returns an awaitable, the program is suspended until
+    # it completes, so other tasks run in the meantime
+    async def run_async(self, instructions: InstructionStream | list[ir.Instruction]):
+        core = self.execute(instructions)
+
+        try:
+            pending = next(core)
+
+            while True:
+                try:
+                    result = await pending
+                except Exception as e:
+                    pending = core.throw(e)
+                else:
+                    pending = core.send(result)
+        except StopIteration:
+            pass
+
+    # The core loop, shared by run and run_async. A generator that yields the awaitables returned by built ins and is
+    # sent their results
+    def execute(self, instructions: InstructionStream | list[ir.Instruction]):
+
+        if not isinstance(instructions, InstructionStream):
+            instructions = InstructionStream.from_instructions(instructions)
+
+        # Functions of a lazily compiled program are compiled on the first Call to them (see lazy.py)
+        undecoded = instructions.undecoded if isinstance(instructions, LazyStream) else {}
+
+        if self.verify and not instructions.verified:
+            if undecoded:
+                instructions.decode_all()
+            verifier.verify(instructions)
+
+        # Work directly on the packed arrays of the stream, operands are read with operands[starts[pc]]
+        opcodes = instructions.opcodes
+        starts = instructions.starts
+        operands = instructions.operands
+        constants = instructions.constants
 
         op_stack = []
         call_stack = []
-        globals = []
+
+        # Typed view of each global (see GlobalSegment)
+        global_views = self.shared_globals.views if self.shared_globals is not None else []
+
+        built_ins = self.built_ins
+
+        blocks = self.memory.blocks
+        bulk = self.memory.bulk
+        check_store = self.memory.check_store
+
+        # The blocks of MemoryLoad and MemoryStore are only checked as they run for unverified programs
+        if instructions.verified:
+            self.memory.check_blocks(instructions.memory_blocks)
+
+        memo = self.memo
+        pure_functions = instructions.pure_functions if memo is not None else {}
+        program = memo.program(instructions) if memo is not None else None
+
+        # A verified program ends with a Finish and never jumps past it (see verifier.py), so pc is only checked against
+        # the length of the program for unverified ones
+        checked = not instructions.verified
+        end = len(opcodes)
 
         pc = 0
         bp = 0
 
+        jit = self.jit
+        tracing = jit is not None
+        # Set by jumps that go backwards, i.e. to the start of a loop
+        backward = False
+        # Locations executed since recording of a trace started, None when not recording
+        recording = None
+        recording_start = 0
+        recording_depth = 0
+
         while True:
 
-            if pc >= len(instructions):
+            if checked and pc >= end:
                 break
 
-            op = instructions[pc]
+            op = opcodes[pc]
+
+            if tracing:
+                if backward and recording is None:
+                    backward = False
+
+                    trace = jit.traces.get(pc)
+
+                    if trace is not None:
+                        pc, bp, pending = trace(op_stack, call_stack, global_views, built_ins, bp)
+
+                        # The trace left after a built in that returned an awaitable
+                        if pending is not None:
+                            result = yield pending
+
+                            if opcodes[pc - 1] == BUILT_IN_FUNCTION:
+                                op_stack.append(result)
 
-            if isinstance(op, ir.Call):
-                call_stack.append(LinkAddress(pc + 1))
+                        continue
 
-                pc = op.location
+                    if jit.is_hot(pc):
+                        recording = []
+                        recording_start = pc
+                        recording_depth = 0
+
+                if recording is not None:
+                    if pc == recording_start and recording and recording_depth == 0:
+                        jit.compile(instructions, recording)
+                        recording = None
+                    elif len(recording) == jit.max_trace_length or not jit.traceable(instructions, pc, recording_depth):
+                        jit.abort(recording_start)
+                        recording = None
+                    else:
+                        if op == CALL:
+                            recording_depth += 1
+                        elif op == RETURN:
+                            recording_depth -= 1
+                        recording.append(pc)
+
+                backward = False
+
+            if op == CALL:
+                location = operands[starts[pc]]
+
+                if location in undecoded:
+                    function = instructions.decode_function(location)
+                    location = function.location
+
+                    # Compiled functions are appended to the program
+                    end = len(opcodes)
+
+                if location in pure_functions:
+                    arg_count = pure_functions[location]
+                    args = tuple(arg.inner for arg in call_stack[len(call_stack) - arg_count:])
+                    key = (program, location, args, tuple(map(type, args)))
+                    hit, value = memo.get(key)
+
+                    if hit:
+                        del call_stack[len(call_stack) - arg_count:]
+                        op_stack.append(value)
+
+                        # The trace would expect the callee to run
+                        if recording is not None:
+                            jit.abort(recording_start)
+                            recording = None
+
+                        pc += 1
+                        continue
+
+                    call_stack.append(MemoLinkAddress(pc + 1, key))
+                else:
+                    call_stack.append(LinkAddress(pc + 1))
+
+                pc = location
 
                 continue
-            elif isinstance(op, ir.LocalAlloc):
-                local_count = op.variable_count
+            elif op == LOCAL_ALLOC:
+                local_count = operands[starts[pc]]
 
                 call_stack.append(BasePointer(bp))
 
@@ -54,13 +422,16 @@ class Interpreter:
 
                 for i in range(local_count):
                     call_stack.append(LocalVariable(None))
-            elif isinstance(op, ir.GlobalAlloc):
-                for i in range(op.variable_count):
-                    globals.append(0)
-            elif isinstance(op, ir.Return):
-                arg_count = op.arg_count
+            elif op == GLOBAL_ALLOC:
+                if self.shared_globals is None:
+                    count = operands[starts[pc]]
+                    layout = instructions.global_types if len(instructions.global_types) == count else ["int"] * count
+                    self.globals = GlobalSegment(layout)
+                    global_views = self.globals.views
+            elif op == RETURN:
+                arg_count = operands[starts[pc]]
 
-                call_stack = call_stack[:bp+1]
+                del call_stack[bp+1:]
 
                 bp = call_stack.pop().inner
 
@@ -69,79 +440,201 @@ class Interpreter:
                 for i in range(arg_count):
                     call_stack.pop()
 
+                if type(link) is MemoLinkAddress:
+                    memo.store(link.key, op_stack[-1])
+
                 pc = link.inner
 
                 continue
-            elif isinstance(op, ir.OpStackPushLocal):
-                op_stack.append(call_stack[bp+op.offset+1])
-            elif isinstance(op, ir.OpStackPopLocal):
-                call_stack[bp+op.offset+1] = op_stack.pop()
-            elif isinstance(op, ir.OpStackPushArg):
-                op_stack.append(call_stack[bp-2 - op.offset].inner)
-            elif isinstance(op, ir.OpStackPopArg):
-                call_stack[bp-2 - op.offset].inner = op_stack.pop()
-            elif isinstance(op, ir.OpStackPushGlobal):
-                pass
-            elif isinstance(op, ir.OpStackPopGlobal):
-                pass
-            elif isinstance(op, ir.OpStackPopToCallStack):
+            elif op == PUSH_LOCAL:
+                op_stack.append(call_stack[bp+operands[starts[pc]]+1])
+            elif op == POP_LOCAL:
+                call_stack[bp+operands[starts[pc]]+1] = op_stack.pop()
+            elif op == PUSH_ARG:
+                op_stack.append(call_stack[bp-2 - operands[starts[pc]]].inner)
+            elif op == POP_ARG:
+                call_stack[bp-2 - operands[starts[pc]]].inner = op_stack.pop()
+            elif op == PUSH_GLOBAL:
+                offset = operands[starts[pc]]
+                op_stack.append(global_views[offset][offset])
+            elif op == POP_GLOBAL:
+                offset = operands[starts[pc]]
+                value = op_stack.pop()
+                if type(value) is float:
+                    check_global_store(global_views, offset, value)
+                global_views[offset][offset] = value
+            elif op == POP_TO_CALL_STACK:
                 call_stack.append(Argument(op_stack.pop()))
-            elif isinstance(op, ir.OpStackPushLiteral):
-                op_stack.append(op.value)
-            elif isinstance(op, ir.BuiltInInstruction):
-                name = op.name
+            elif op == POP:
+                op_stack.pop()
+            elif op == DUPLICATE:
+                op_stack.append(op_stack[-1])
+            elif op == PUSH_LITERAL:
+                op_stack.append(constants[operands[starts[pc]]])
+            elif op == BUILT_IN_INSTRUCTION:
+                start = starts[pc]
+                name = constants[operands[start]]
 
                 if name == "finish":
                     break
-                elif name == "print":
-                    print(f"Print function: {op_stack.pop()}")
-            elif isinstance(op, ir.Jump):
-                pc = op.location
+
+                arg_count = operands[start + 1]
+
+                if arg_count != 0:
+                    args = op_stack[-arg_count:]
+                    del op_stack[-arg_count:]
+                else:
+                    args = []
+
+                result = built_ins[name](*args)
+
+                if result is not None and inspect.isawaitable(result):
+                    yield result
+            elif op == BUILT_IN_FUNCTION:
+                start = starts[pc]
+                name = constants[operands[start]]
+                arg_count = operands[start + 1]
+
+                if arg_count != 0:
+                    args = op_stack[-arg_count:]
+                    del op_stack[-arg_count:]
+                else:
+                    args = []
+
+                result = built_ins[name](*args)
+
+                if inspect.isawaitable(result):
+                    result = yield result
+
+                op_stack.append(result)
+            elif op == MEMORY_LOAD:
+                block = operands[starts[pc]]
+                index = op_stack.pop()
+
+                if checked and block >= len(blocks):
+                    self.memory.check_blocks(block + 1)
+
+                if not 0 <= index < len(blocks[block]):
+                    raise Exception(f"Memory access {block_name(block)}[{index}] is outside the block, which holds {len(blocks[block])} words")
+
+                op_stack.append(blocks[block][index])
+            elif op == MEMORY_STORE:
+                block = operands[starts[pc]]
+                index = op_stack.pop()
+
+                if checked and block >= len(blocks):
+                    self.memory.check_blocks(block + 1)
+
+                if not 0 <= index < len(blocks[block]):
+                    raise Exception(f"Memory access {block_name(block)}[{index}] is outside the block, which holds {len(blocks[block])} words")
+
+                value = op_stack.pop()
+                if type(value) is float:
+                    check_store(blocks[block], value, f"Assignment to {block_name(block)}[{index}]")
+                blocks[block][index] = value
+            elif op == MEMORY_BULK:
+                start = starts[pc]
+                arg_count = operands[start + 1]
+
+                args = op_stack[-arg_count:]
+                del op_stack[-arg_count:]
+
+                op_stack.append(bulk(constants[operands[start]], args))
+            elif op == JUMP:
+                location = operands[starts[pc]]
+                backward = location <= pc
+                pc = location
                 continue
-            elif isinstance(op, ir.JumpIfTrue):
+            elif op == JUMP_IF_TRUE:
                 if op_stack.pop() != 0:
-                    pc = op.location
+                    pc = operands[starts[pc]]
                     continue
-            elif isinstance(op, ir.JumpIfFalse):
+            elif op == JUMP_IF_FALSE:
                 if op_stack.pop() == 0:
-                    pc = op.location
+                    pc = operands[starts[pc]]
                     continue
-            elif isinstance(op, ir.Equal):
+            elif op == EQUAL:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(int(a == b))
-            elif isinstance(op, ir.NotEqual):
+            elif op == NOT_EQUAL:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(int(a != b))
-            elif isinstance(op, ir.LessThan):
+            elif op == LESS_THAN:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(int(a < b))
-            elif isinstance(op, ir.GreaterThan):
+            elif op == GREATER_THAN:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(int(a > b))
-            elif isinstance(op, ir.LessThanEqualTo):
+            elif op == LESS_THAN_EQUAL_TO:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(int(a <= b))
-            elif isinstance(op, ir.GreaterThanEqualTo):
+            elif op == GREATER_THAN_EQUAL_TO:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(int(a >= b))
-            elif isinstance(op, ir.Add):
+            elif op == ADD:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(a + b)
-            elif isinstance(op, ir.Sub):
+            elif op == SUB:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(a - b)
-            elif isinstance(op, ir.Multiply):
+            elif op == MULTIPLY:
                 b = op_stack.pop()
                 a = op_stack.pop()
                 op_stack.append(a * b)
+            elif op == UNARY_NEGATIVE:
+                op_stack.append(-op_stack.pop())
+            elif op == UNARY_POSITIVE:
+                pass
+            elif op == ONES_COMPLEMENT:
+                op_stack.append(~op_stack.pop())
+            elif op == LOGICAL_NOT:
+                op_stack.append(int(op_stack.pop() == 0))
+            elif op == FOR_RANGE_INIT:
+                start = starts[pc]
+                scope, offset, value, stop, step, location = operands[start:start + 6]
+
+                if (value >= stop) if step > 0 else (value <= stop):
+                    pc = location
+                    continue
+
+                if scope == ir.SCOPE_LOCAL:
+                    call_stack[bp+offset+1] = value
+                elif scope == ir.SCOPE_ARG:
+                    call_stack[bp-2 - offset].inner = value
+                else:
+                    global_views[offset][offset] = value
+            elif op == FOR_RANGE_NEXT:
+                start = starts[pc]
+                scope, offset, stop, step, location = operands[start:start + 5]
+
+                if scope == ir.SCOPE_LOCAL:
+                    value = call_stack[bp+offset+1] + step
+                elif scope == ir.SCOPE_ARG:
+                    value = call_stack[bp-2 - offset].inner + step
+                else:
+                    value = global_views[offset][offset] + step
+
+                if (value < stop) if step > 0 else (value > stop):
+                    if scope == ir.SCOPE_LOCAL:
+                        call_stack[bp+offset+1] = value
+                    elif scope == ir.SCOPE_ARG:
+                        call_stack[bp-2 - offset].inner = value
+                    else:
+                        global_views[offset][offset] = value
+
+                    backward = True
+                    pc = location
+                    continue
+            elif op == FINISH:
+                break
 
 
 
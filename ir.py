@@ -1,5 +1,11 @@
+import inspect
 
 class Instruction:
+    # Operand fields that are not plain integers and live in the constant pool of a packed stream (see stream.py)
+    pooled = ()
+    # Operand fields holding the offset of a global variable, these are relocated when units are linked (see linker.py)
+    global_offsets = ()
+
     def __repr__(self):
         s = [type(self).__name__, "("]
         for i, (attr, value) in enumerate(vars(self).items()):
@@ -35,6 +41,8 @@ class OpStackPopArg(Instruction):
 
 # Push a literal onto the op stack
 class OpStackPushLiteral(Instruction):
+    pooled = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -42,13 +50,25 @@ class OpStackPushLiteral(Instruction):
 class OpStackPopToCallStack(Instruction):
     pass
 
+# Pop a value off the op stack and discard it
+class OpStackPop(Instruction):
+    pass
+
+# Push a copy of the value on top of the op stack
+class OpStackDuplicate(Instruction):
+    pass
+
 # Push the value of a global variable onto the op stack
 class OpStackPushGlobal(Instruction):
+    global_offsets = ("offset",)
+
     def __init__(self, offset: int):
         self.offset = offset
 
 # Pop the top of the op stack into the global variable
 class OpStackPopGlobal(Instruction):
+    global_offsets = ("offset",)
+
     def __init__(self, offset: int):
         self.offset = offset
 
@@ -85,6 +105,7 @@ class ConvertFloatToInt(Instruction):
 ###### Subroutines
 
 # Make a function call. Stores return address on call stack
+# Every function leaves exactly one value on the op stack when it returns (functions returning NoneType return 0)
 class Call(Instruction):
     def __init__(self, location):
         self.location = location
@@ -130,17 +151,22 @@ class GreaterThanEqualTo(Instruction):
 ###### Built ins
 
 # Allows built-in instructions that can be called in code but executed by VM.
-# Built-in instructions pass arguments as immediates and DO NOT use the op stack OR the call stack (as a result they must pass constants)
+# Built-in instructions DO NOT use the call stack. Their arguments are evaluated onto the op stack, args is the number of
+# them and the instruction pops all of them and pushes nothing
 class BuiltInInstruction(Instruction):
+    pooled = ("name",)
+
     def __init__(self, name, args):
         self.name = name
         self.args = args
 
 
 # Allows built-in functions that can be called in code but executed by VM.
-# Built-in functions pass arguments on the op stack and DO NOT use the call stack
-# It is down to the VM implementor to ensure they remove the correct number of items from the stack
+# Built-in functions pass arguments on the op stack and DO NOT use the call stack. The function pops its args arguments
+# and pushes its result
 class BuiltInFunction(Instruction):
+    pooled = ("name",)
+
     def __init__(self, name, args):
         self.name = name
         self.args = args
@@ -179,6 +205,60 @@ class LogicalNot(Instruction):
 class Ternary(Instruction):
     pass
 
+###### Counted loops
+
+# Kinds of variable that can be addressed directly by an instruction's scope operand
+SCOPE_LOCAL = 0
+SCOPE_ARG = 1
+SCOPE_GLOBAL = 2
+
+# If range(start, stop, step) is empty, jump to location (past the loop) leaving the counter variable as it is, as Python
+# does. Otherwise set the counter variable to start
+# offset is a global offset (see global_offsets) only when scope is SCOPE_GLOBAL
+class ForRangeInit(Instruction):
+    global_offsets = ("offset",)
+
+    def __init__(self, scope: int, offset: int, start: int, stop: int, step: int, location):
+        self.scope = scope
+        self.offset = offset
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.location = location
+
+# Add step to the counter variable. If the result is still inside the range, store it and jump to location (the start of
+# the loop body), otherwise fall through leaving the counter at its last value
+class ForRangeNext(Instruction):
+    global_offsets = ("offset",)
+
+    def __init__(self, scope: int, offset: int, stop: int, step: int, location):
+        self.scope = scope
+        self.offset = offset
+        self.stop = stop
+        self.step = step
+        self.location = location
+
+###### Memory blocks (see memory.py)
+
+# Pop an index and push the word at that index of memory block `block`
+class MemoryLoad(Instruction):
+    def __init__(self, block: int):
+        self.block = block
+
+# Pop an index, then a value, and store the value at that index of memory block `block`
+class MemoryStore(Instruction):
+    def __init__(self, block: int):
+        self.block = block
+
+# Bulk operation over ranges of memory blocks. Pops args values (each range is a block number then a start) and pushes
+# the result
+class MemoryBulk(Instruction):
+    pooled = ("operation",)
+
+    def __init__(self, operation, args):
+        self.operation = operation
+        self.args = args
+
 ###### Misc
 
 # If the top of the op stack is non-zero stop program
@@ -187,4 +267,37 @@ class Assert(Instruction):
 
 # Called to end program execution
 class Finish(Instruction):
-    pass
\ No newline at end of file
+    pass
+
+
+###### Opcodes
+
+# Each instruction class is given an opcode (its index in this list) and a tuple of operand fields taken from its constructor.
+# Fields named location hold code addresses and are listed in `locations` so they can be moved when code is relocated.
+# Packed representations store the opcode and operands instead of instruction objects.
+# New instructions must be appended to the end so that existing opcodes stay stable.
+opcodes = [
+    OpStackPushLocal, OpStackPopLocal, OpStackPushArg, OpStackPopArg, OpStackPushLiteral, OpStackPopToCallStack,
+    OpStackPushGlobal, OpStackPopGlobal,
+    Jump, JumpIfTrue, JumpIfFalse,
+    ConvertIntToFloat, ConvertFloatToInt,
+    Call, Return, LocalAlloc, GlobalAlloc,
+    Equal, NotEqual, LessThan, GreaterThan, LessThanEqualTo, GreaterThanEqualTo,
+    BuiltInInstruction, BuiltInFunction,
+    Add, Sub, Multiply,
+    UnaryNegative, UnaryPositive, OnesComplement, LogicalNot,
+    Ternary,
+    Assert, Finish,
+    ForRangeInit, ForRangeNext,
+    OpStackPop,
+    OpStackDuplicate,
+    MemoryLoad, MemoryStore, MemoryBulk,
+]
+
+for _opcode, _instruction in enumerate(opcodes):
+    _instruction.opcode = _opcode
+    if "__init__" in vars(_instruction):
+        _instruction.fields = tuple(inspect.signature(_instruction.__init__).parameters)[1:]
+    else:
+        _instruction.fields = ()
+    _instruction.locations = tuple(field for field in _instruction.fields if field == "location")
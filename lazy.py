@@ -0,0 +1,112 @@
+import hr
+import ir
+from compiler import _Compiler
+from image import FunctionEntry
+from stream import InstructionStream
+from symbols import Symbols
+
+# Lazy, on first call compilation.
+#
+# compile() processes the symbols of and generates code for every function in the module up front. compile_lazy only
+# compiles the top level code, followed by a stub for each function: a Finish instruction that every Call to the
+# function targets until it has been compiled. The interpreter compiles a function (Symbols.process and code generation)
+# when a Call first reaches its stub, appends the code to the end of the program and patches the Call instructions that
+# targeted the stub to the new location. Functions that are never called are never compiled.
+#
+# Since top level code ends with a Finish either way, programs that run off the end of the top level code still stop
+# there.
+#
+# Differences from compile():
+# - Functions are only checked (undefined names, arg counts of their calls, ...) when they are first called
+# - pure_functions is left empty, as purity depends on the whole call graph (see purity.py)
+# - max_stack_depth is only known once every function has been compiled
+# - If features is given, each function is checked against them when it is compiled
+
+class LazyStream(InstructionStream):
+    def __init__(self, module: hr.Module, extra_instructions: dict, extra_functions: dict, reuse_slots: bool = False, features=None):
+        super().__init__()
+
+        self.features = features
+
+        statements = [node for node in module.body if isinstance(node, hr.Statement)]
+        self.definitions = {node.name: node for node in module.body if type(node) == hr.FunctionDef}
+
+        # Arg counts are enough to compile calls, the symbols of each function are processed when it is compiled
+        self.table = Symbols()
+        self.table.add_statements(statements)
+
+        for name, node in self.definitions.items():
+            self.table.arg_counts[name] = len(node.args)
+
+        self.compiler = _Compiler(self.table, extra_instructions, extra_functions, reuse_slots)
+        self.compiler.instructions = self
+
+        # Filled in as functions are compiled
+        self.function_locations = self.compiler.function_locations
+
+        if len(self.table.top_level) != 0:
+            self.emit(ir.GlobalAlloc, len(self.table.top_level))
+
+        self.compiler.traverse(statements)
+        self.compiler.analyse_top_level()
+        self.global_types = self.compiler.global_types()
+
+        # Name -> location of the stub of every function, and the Calls that still target each stub
+        self.stubs = {name: self.emit(ir.Finish) for name in self.definitions}
+        self.call_sites = {name: [] for name in self.definitions}
+
+        # Stub location -> name of every function that has not been compiled yet
+        self.undecoded = {location: name for name, location in self.stubs.items()}
+
+        self.resolve_calls()
+
+        if features is not None:
+            features.validate(self)
+
+    # Point the Calls emitted since the last resolve at the compiled function, or its stub
+    def resolve_calls(self):
+        c = self.compiler
+
+        for index, name in c.calls:
+            if name in c.function_locations:
+                self.patch(index, "location", c.function_locations[name])
+            else:
+                self.patch(index, "location", self.stubs[name])
+                self.call_sites[name].append(index)
+
+        c.calls = []
+
+    # Compile the function whose stub is at location, returns its FunctionEntry
+    def decode_function(self, location: int) -> FunctionEntry:
+        name = self.undecoded.pop(location)
+        node = self.definitions[name]
+        c = self.compiler
+
+        self.table.add_function(node)
+        c.walk(node)
+
+        self.resolve_calls()
+
+        start, end = c.function_ranges[name]
+
+        for index in self.call_sites.pop(name):
+            self.patch(index, "location", start)
+
+        if self.features is not None:
+            self.features.validate(self, start, end)
+
+        if not self.undecoded:
+            c.record_stack_depths(self)
+
+        return FunctionEntry(name, start, end, len(node.args), self.operand(start, "variable_count"))
+
+    def decode_all(self):
+        while self.undecoded:
+            self.decode_function(next(iter(self.undecoded)))
+
+    def __repr__(self):
+        return f"LazyStream(size={len(self)}, functions={len(self.definitions)}, undecoded={len(self.undecoded)})"
+
+
+def compile_lazy(module: hr.Module, extra_instructions: dict, extra_functions: dict, reuse_slots: bool = False, features=None) -> LazyStream:
+    return LazyStream(module, extra_instructions, extra_functions, reuse_slots, features)
@@ -0,0 +1,232 @@
+import pickle
+from bisect import bisect_right
+
+import hr
+import ir
+import purity
+import stackdepth
+from compiler import _Compiler
+from stream import InstructionStream
+from symbols import Symbols
+
+# Separate compilation units and a linker.
+#
+# compile() resolves every Call by looking the name up in a single function_locations dict, so a program has to be
+# compiled as one module. Here a module is compiled into an ObjectUnit instead: position independent code starting at
+# location 0, the functions it exports, the calls it could not resolve and a relocation table for its global variables.
+# link() combines units into a single executable program.
+#
+# Global variables are private to the unit that declares them, each unit is given its own range of the global segment.
+# Top level code runs in the order the units are linked.
+#
+# A linked program holds the top level code of every unit, in link order, then a Finish, then the functions of every unit:
+#
+#   [GlobalAlloc] | top level code of unit 0 | ... | top level code of unit n | Finish | functions of unit 0 | ...
+#
+# so top level code runs from one unit into the next and never into a function body. Each unit is split into its top
+# level code and function ranges, and locations in the unit are moved to wherever their range was placed.
+#
+# If compile_unit and link are given features (see features.py), each unit and the linked program (which adds a
+# GlobalAlloc and a Finish) are checked to only use the instructions of those features.
+
+class ObjectUnit:
+    def __init__(self, code: InstructionStream, exports: dict, externals: list, imports: dict, globals: dict, global_relocations: list, stack_depths: dict, call_depths: dict,
+                 function_ranges: dict, local_purity: dict):
+        self.code = code
+        # name -> (location, arg count) of every function defined in the unit
+        self.exports = exports
+        # (index, name) of every Call to a function that is not defined in the unit
+        self.externals = externals
+        # name -> arg count of the external functions the unit was compiled against
+        self.imports = imports
+        # name -> Symbol of every global variable declared in the unit
+        self.globals = globals
+        # (index, field) of every operand holding a unit relative global offset
+        self.global_relocations = global_relocations
+        # Stack analysis of each function and the top level code (see stackdepth.py)
+        self.stack_depths = stack_depths
+        self.call_depths = call_depths
+        # name -> [start, end) of every function in code
+        self.function_ranges = function_ranges
+        # Whether each function is free of side effects, apart from its calls (see purity.py)
+        self.local_purity = local_purity
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: str) -> "ObjectUnit":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def __repr__(self):
+        return f"ObjectUnit(exports={list(self.exports)}, externals={sorted(set(name for _, name in self.externals))}, globals={list(self.globals)}, size={len(self.code)})"
+
+
+
+# Compile a module into an object unit. externals maps the name of every function defined in another unit that this
+# module calls to its argument count
+def compile_unit(module: hr.Module, extra_instructions: dict, extra_functions: dict, externals: dict = {}, reuse_slots: bool = False,
+                 features=None) -> ObjectUnit:
+    table = Symbols(module)
+
+    for name, arg_count in externals.items():
+        if name in table.arg_counts:
+            raise Exception(f"External function '{name}' is also defined in this unit")
+        table.arg_counts[name] = arg_count
+
+    c = _Compiler(table, extra_instructions, extra_functions, reuse_slots)
+
+    # Traverse the body rather than walking the module, the linker emits a single GlobalAlloc for the whole program
+    c.traverse(module.body)
+
+    external_calls = []
+
+    for index, name in c.calls:
+        if name in c.function_locations:
+            c.instructions.patch(index, "location", c.function_locations[name])
+        else:
+            external_calls.append((index, name))
+
+    global_relocations = []
+
+    for index in range(len(c.instructions)):
+        cls = c.instructions.type(index)
+
+        # Instructions with a scope operand only address a global when the scope says so
+        if "scope" in cls.fields and c.instructions.operand(index, "scope") != ir.SCOPE_GLOBAL:
+            continue
+
+        for field in cls.global_offsets:
+            global_relocations.append((index, field))
+
+    exports = {name: (location, table.count_args(name)) for name, location in c.function_locations.items()}
+
+    c.analyse_top_level()
+
+    if features is not None:
+        features.validate(c.instructions)
+
+    return ObjectUnit(c.instructions, exports, external_calls, dict(externals), dict(table.top_level), global_relocations, c.stack_depths, c.call_depths,
+                      c.function_ranges, c.local_purity)
+
+
+
+# [start, end) of each run of top level code in a unit, i.e. everything outside of its functions
+def _top_level_ranges(unit: ObjectUnit) -> list[tuple]:
+    ranges = []
+    position = 0
+
+    for start, end in sorted(unit.function_ranges.values()):
+        if position < start:
+            ranges.append((position, start))
+        position = end
+
+    if position < len(unit.code):
+        ranges.append((position, len(unit.code)))
+
+    return ranges
+
+
+# Where ranges of a unit were placed in the program, maps locations in the unit to locations in the program
+class _Layout:
+    def __init__(self):
+        # (start, end, new start) of each range, sorted by start
+        self.ranges = []
+
+    def add(self, start: int, end: int, location: int):
+        self.ranges.append((start, end, location))
+        self.ranges.sort()
+
+    def relocate(self, location: int) -> int:
+        start, end, new = self.ranges[bisect_right(self.ranges, (location, float("inf"))) - 1]
+        return new + location - start
+
+
+def link(units: list[ObjectUnit], features=None) -> InstructionStream:
+    global_var_count = sum(len(unit.globals) for unit in units)
+
+    program = InstructionStream()
+
+    if global_var_count != 0:
+        program.emit(ir.GlobalAlloc, global_var_count)
+
+    layouts = [_Layout() for _ in units]
+
+    # Locations inside a range move with it, including jumps to the end of a run of top level code, which now continue
+    # into the next run (or the Finish)
+    def place(unit: ObjectUnit, layout: _Layout, start: int, end: int):
+        layout.add(start, end, len(program))
+        program.extend(unit.code, len(program) - start, start, end)
+
+    for unit, layout in zip(units, layouts):
+        for start, end in _top_level_ranges(unit):
+            place(unit, layout, start, end)
+
+    program.emit(ir.Finish)
+
+    for unit, layout in zip(units, layouts):
+        for start, end in sorted(unit.function_ranges.values()):
+            place(unit, layout, start, end)
+
+    # Resolve exported symbols
+    function_locations = {}
+    arg_counts = {}
+
+    for unit, layout in zip(units, layouts):
+        for name, (location, arg_count) in unit.exports.items():
+            if name in function_locations:
+                raise Exception(f"Function '{name}' is defined in more than one unit")
+
+            function_locations[name] = layout.relocate(location)
+            arg_counts[name] = arg_count
+
+    for unit in units:
+        for name, arg_count in unit.imports.items():
+            if name not in function_locations:
+                raise Exception(f"Undefined reference to function '{name}'")
+            if arg_counts[name] != arg_count:
+                raise Exception(f"Function '{name}' takes {arg_counts[name]} args, but was imported with {arg_count}")
+
+    global_base = 0
+
+    for unit, layout in zip(units, layouts):
+        # Calls within the unit may target a function in another range
+        for index in range(len(unit.code)):
+            if unit.code.opcodes[index] == ir.Call.opcode:
+                location = unit.code.operand(index, "location")
+                if location is not None:
+                    program.patch(layout.relocate(index), "location", layout.relocate(location))
+
+        for index, name in unit.externals:
+            program.patch(layout.relocate(index), "location", function_locations[name])
+
+        for index, field in unit.global_relocations:
+            index = layout.relocate(index)
+            program.patch(index, field, program.operand(index, field) + global_base)
+
+        global_base += len(unit.globals)
+
+    # Top level code of every unit runs one unit after the other, so shares a single entry
+    stack_depths = {None: 0}
+    call_depths = {None: []}
+    local_purity = {}
+
+    for unit in units:
+        for name, depth in unit.stack_depths.items():
+            stack_depths[name] = max(stack_depths.get(name, 0), depth)
+        for name, sites in unit.call_depths.items():
+            call_depths.setdefault(name, []).extend(sites)
+        local_purity.update(unit.local_purity)
+
+    program.stack_depths = stack_depths
+    program.max_stack_depth = stackdepth.program_bound(stack_depths, call_depths)
+    program.global_types = [symbol.annotation for unit in units for symbol in sorted(unit.globals.values(), key=lambda x : x.stack_offset)]
+    program.pure_functions = {function_locations[name]: arg_counts[name] for name in purity.pure_functions(local_purity, call_depths)}
+    program.function_locations = function_locations
+
+    if features is not None:
+        features.validate(program)
+
+    return program
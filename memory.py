@@ -0,0 +1,172 @@
+import operator
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Memory blocks and bulk operations over them.
+#
+# A program addresses memory blocks by name: mem is block 0, mem1 block 1 and so on. mem[i] reads a word of a block
+# (MemoryLoad) and mem[i] = x writes one (MemoryStore). The blocks themselves are given to the interpreter, each one an
+# array.array ("q" for int words, "d" for float words, ...) or a size for a zeroed block of int words.
+#
+# Bulk operations work on ranges of words and are called like built in functions. A range is given as a subscript of a
+# block, the word it starts at, e.g. mem_sum(mem1[16], 64) adds up mem1[16] to mem1[79]:
+#   mem_copy(dst, src, count)      copy count words from src to dst, returns count
+#   mem_fill(dst, count, value)    set count words of dst to value, returns count
+#   mem_sum(src, count)            sum of count words of src
+#   mem_dot(a, b, count)           dot product of count words of a and b
+#   mem_axpy(y, a, x, count)       y = y + a * x over count words, returns count
+#   mem_find(src, count, value)    index of the first word equal to value from the start of src, or -1
+#
+# Each operation checks its ranges once and then works on whole slices of the blocks, with NumPy (through views that
+# share the blocks' buffers) when it is installed, otherwise with array slicing. NumPy sums floats pairwise, so float
+# results may differ in the last bits between the two. A float value is never written to an int block.
+
+# Kinds of the arguments of each bulk operation: a range of a memory block, or a value
+operations = {
+    "mem_copy": ("range", "range", "value"),
+    "mem_fill": ("range", "value", "value"),
+    "mem_sum": ("range", "value"),
+    "mem_dot": ("range", "range", "value"),
+    "mem_axpy": ("range", "value", "range", "value"),
+    "mem_find": ("range", "value", "value"),
+}
+
+
+# Block number of a memory block name, or None if name is not one
+def block_number(name: str) -> int | None:
+    if name == "mem":
+        return 0
+    if name.startswith("mem") and name[3:].isdigit() and name[3] != "0":
+        return int(name[3:])
+    return None
+
+
+def block_name(number: int) -> str:
+    return "mem" if number == 0 else f"mem{number}"
+
+
+def _is_float(block: array) -> bool:
+    return block.typecode in "fd"
+
+
+class Memory:
+    def __init__(self, blocks: list):
+        self.blocks = []
+
+        for block in blocks:
+            if type(block) is int:
+                block = array("q", bytes(block * array("q").itemsize))
+            elif not isinstance(block, array):
+                raise Exception(f"Memory blocks must be arrays or sizes, found {type(block).__name__}")
+            self.blocks.append(block)
+
+        # NumPy views sharing each block's buffer
+        self.views = [numpy.frombuffer(block, dtype=block.typecode) for block in self.blocks] if numpy is not None else None
+
+        self.operations = {
+            "mem_copy": self.copy,
+            "mem_fill": self.fill,
+            "mem_sum": self.sum,
+            "mem_dot": self.dot,
+            "mem_axpy": self.axpy,
+            "mem_find": self.find,
+        }
+
+    # Check that count words from start are inside a block, returns the block
+    def range(self, block: int, start: int, count: int) -> array:
+        if not 0 <= block < len(self.blocks):
+            raise Exception(f"Memory block {block_name(block)} does not exist, there are {len(self.blocks)} blocks")
+
+        words = self.blocks[block]
+
+        if count < 0 or start < 0 or start + count > len(words):
+            raise Exception(f"Range {block_name(block)}[{start}:{start + count}] is outside the block, which holds {len(words)} words")
+
+        return words
+
+    # Raise if a program that addresses count blocks can not run on this memory
+    def check_blocks(self, count: int):
+        if count > len(self.blocks):
+            raise Exception(f"Memory block {block_name(count - 1)} does not exist, there are {len(self.blocks)} blocks")
+
+    def check_store(self, block: array, value, operation: str):
+        if not _is_float(block) and (type(value) is float or (isinstance(value, array) and _is_float(value))):
+            raise Exception(f"{operation} can not store float values in an int memory block")
+
+    # Run the bulk operation name with the args popped off the op stack (each range is a block number and a start)
+    def bulk(self, name: str, args: list):
+        return self.operations[name](*args)
+
+    def copy(self, dst: int, d: int, src: int, s: int, count: int) -> int:
+        dst_words = self.range(dst, d, count)
+        src_words = self.range(src, s, count)
+        self.check_store(dst_words, src_words, "mem_copy")
+
+        if self.views is not None:
+            self.views[dst][d:d + count] = self.views[src][s:s + count]
+        elif dst_words.typecode == src_words.typecode:
+            dst_words[d:d + count] = src_words[s:s + count]
+        else:
+            dst_words[d:d + count] = array(dst_words.typecode, src_words[s:s + count])
+
+        return count
+
+    def fill(self, dst: int, d: int, count: int, value) -> int:
+        words = self.range(dst, d, count)
+        self.check_store(words, value, "mem_fill")
+
+        if self.views is not None:
+            self.views[dst][d:d + count] = value
+        else:
+            words[d:d + count] = array(words.typecode, [value]) * count
+
+        return count
+
+    def sum(self, src: int, s: int, count: int):
+        words = self.range(src, s, count)
+
+        if self.views is not None:
+            return self.views[src][s:s + count].sum().item()
+
+        return sum(words[s:s + count], 0.0 if _is_float(words) else 0)
+
+    def dot(self, a: int, i: int, b: int, j: int, count: int):
+        a_words = self.range(a, i, count)
+        b_words = self.range(b, j, count)
+
+        if self.views is not None:
+            return numpy.dot(self.views[a][i:i + count], self.views[b][j:j + count]).item()
+
+        return sum(map(operator.mul, a_words[i:i + count], b_words[j:j + count]), 0.0 if _is_float(a_words) or _is_float(b_words) else 0)
+
+    def axpy(self, y: int, i: int, a, x: int, j: int, count: int) -> int:
+        y_words = self.range(y, i, count)
+        x_words = self.range(x, j, count)
+        self.check_store(y_words, a, "mem_axpy")
+        self.check_store(y_words, x_words, "mem_axpy")
+
+        if self.views is not None:
+            self.views[y][i:i + count] += a * self.views[x][j:j + count]
+        else:
+            y_words[i:i + count] = array(y_words.typecode, map(lambda u, v: u + a * v, y_words[i:i + count], x_words[j:j + count]))
+
+        return count
+
+    def find(self, src: int, s: int, count: int, value) -> int:
+        words = self.range(src, s, count)
+
+        if self.views is not None:
+            hits = numpy.flatnonzero(self.views[src][s:s + count] == value)
+            return int(hits[0]) if len(hits) != 0 else -1
+
+        try:
+            return words.index(value, s, s + count) - s
+        except ValueError:
+            return -1
+
+    def __repr__(self):
+        return f"Memory({', '.join(f'{block_name(i)}={block.typecode}[{len(block)}]' for i, block in enumerate(self.blocks))})"
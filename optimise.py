@@ -0,0 +1,747 @@
+import ast
+from collections import Counter
+
+import hr
+
+# Optimisation passes over the HR, run between hr.ast_to_hr and Symbols. compile(..., optimise=True) runs them.
+#
+# simplify: constant folding and algebraic identities on non-constant operands
+#   x + 0, 0 + x, x - 0, x * 1, 1 * x -> x
+#   x * 0, 0 * x, x - x               -> 0 (int x only, for floats inf and nan make these unsafe)
+#   -(-x), ~(~x), +x                  -> x
+#   not not x                         -> x where only the truth of the value matters (conditions and the operands of
+#                                        not, and, or in conditions) or where x is already 0 or 1 (e.g. a comparison)
+# An identity with a float constant is only applied to a float x, since x + 0.0 turns an int x into a float.
+#
+# eliminate_common_subexpressions: within a basic block (a run of statements with no control flow), a pure expression
+# that is evaluated more than once with the same variable values is computed once into a new local (or global, at the top
+# level) and read from there. The annotation of the new variable is inferred from the expression. If the first evaluation
+# is already the whole value of an assignment to a variable that keeps its value up to the last, that variable is read
+# instead, rather than copying a new one into it.
+#
+# Pure expressions are made of names, constants and operators. Calls and subscripts are never removed, duplicated or
+# moved. Evaluating a pure expression cannot fail or have an effect, so it can be evaluated earlier or unconditionally.
+#
+# hoist_loop_invariants: a pure expression in a While or For loop that only reads variables the loop never assigns is
+# computed once into a new variable before the loop. If the loop makes any calls, expressions that read globals stay in
+# the loop, since the callee may assign them. Outer loops are done first, so an expression is hoisted out of as many
+# loops as it is invariant in. The smallest expressions are hoisted first, so an invariant that is also part of another
+# one is left for common subexpressions to read from its variable.
+#
+# Symbols rejects locals that are never read, so an identity that would drop the last read of a variable is not applied.
+
+COMPARISONS = (ast.Eq, ast.NotEq, ast.Lt, ast.Gt, ast.LtE, ast.GtE)
+BOOLEAN_OPERATORS = (ast.And, ast.Or)
+
+_folds = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Eq: lambda a, b: int(a == b),
+    ast.NotEq: lambda a, b: int(a != b),
+    ast.Lt: lambda a, b: int(a < b),
+    ast.Gt: lambda a, b: int(a > b),
+    ast.LtE: lambda a, b: int(a <= b),
+    ast.GtE: lambda a, b: int(a >= b),
+}
+
+_unary_folds = {
+    ast.USub: lambda a: -a,
+    ast.UAdd: lambda a: a,
+    ast.Invert: lambda a: ~a,
+    ast.Not: lambda a: int(a == 0),
+}
+
+SIMPLE_STATEMENTS = (hr.Assign, hr.Expr, hr.Return, hr.Assert)
+
+
+# Structural key of an expression, equal for expressions that compute the same thing from the same names
+def key(node) -> tuple:
+    t = type(node)
+
+    if t == hr.Name:
+        return ("Name", node.id)
+    if t == hr.Constant:
+        return ("Constant", type(node.value).__name__, node.value)
+    if t == hr.BinOp:
+        return ("BinOp", type(node.operator).__name__, key(node.left), key(node.right))
+    if t == hr.UnaryOp:
+        return ("UnaryOp", type(node.operator).__name__, key(node.operand))
+    if t == hr.IfExpr:
+        return ("IfExpr", key(node.condition), key(node.true_body), key(node.false_body))
+    if t == hr.Call:
+        return ("Call", node.func) + tuple(key(a) for a in node.args)
+    if t == hr.Subscript:
+        return ("Subscript", node.name, key(node.index))
+
+    raise Exception(f"Node {t.__name__} is not an expression")
+
+
+def is_pure(node) -> bool:
+    t = type(node)
+
+    if t == hr.Name or t == hr.Constant:
+        return True
+    if t == hr.BinOp:
+        return is_pure(node.left) and is_pure(node.right)
+    if t == hr.UnaryOp:
+        return is_pure(node.operand)
+    if t == hr.IfExpr:
+        return is_pure(node.condition) and is_pure(node.true_body) and is_pure(node.false_body)
+
+    return False
+
+
+def size(node) -> int:
+    t = type(node)
+
+    if t == hr.BinOp:
+        return 1 + size(node.left) + size(node.right)
+    if t == hr.UnaryOp:
+        return 1 + size(node.operand)
+    if t == hr.IfExpr:
+        return 1 + size(node.condition) + size(node.true_body) + size(node.false_body)
+    if t == hr.Call:
+        return 1 + sum(size(a) for a in node.args)
+    if t == hr.Subscript:
+        return 1 + size(node.index)
+
+    return 1
+
+
+# Names read by an expression, with repeats
+def reads(node) -> list[str]:
+    t = type(node)
+
+    if t == hr.Name:
+        return [node.id]
+    if t == hr.BinOp:
+        return reads(node.left) + reads(node.right)
+    if t == hr.UnaryOp:
+        return reads(node.operand)
+    if t == hr.IfExpr:
+        return reads(node.condition) + reads(node.true_body) + reads(node.false_body)
+    if t == hr.Call:
+        return [name for a in node.args for name in reads(a)]
+    if t == hr.Subscript:
+        return [node.name] + reads(node.index)
+
+    return []
+
+
+def contains_call(node) -> bool:
+    t = type(node)
+
+    if t == hr.Call:
+        return True
+    if t == hr.BinOp:
+        return contains_call(node.left) or contains_call(node.right)
+    if t == hr.UnaryOp:
+        return contains_call(node.operand)
+    if t == hr.IfExpr:
+        return contains_call(node.condition) or contains_call(node.true_body) or contains_call(node.false_body)
+    if t == hr.Subscript:
+        return contains_call(node.index)
+
+    return False
+
+
+# Whether an expression always evaluates to 0 or 1
+def is_boolean(node) -> bool:
+    t = type(node)
+
+    if t == hr.Constant:
+        return node.value == 0 or node.value == 1
+    if t == hr.UnaryOp:
+        return type(node.operator) == ast.Not
+    if t == hr.BinOp:
+        if type(node.operator) in COMPARISONS:
+            return True
+        if type(node.operator) in BOOLEAN_OPERATORS:
+            return is_boolean(node.left) and is_boolean(node.right)
+
+    return False
+
+
+# The expressions of a statement (not of the statements nested in it), as (holder, attribute, is_condition)
+def statement_expressions(statement) -> list[tuple]:
+    t = type(statement)
+
+    if t == hr.Assign:
+        result = [(statement, "rhs", False)]
+        if type(statement.lhs) == hr.Subscript:
+            result.append((statement.lhs, "index", False))
+        return result
+    if t == hr.Expr:
+        return [(statement, "expr", False)]
+    if t == hr.Return:
+        return [(statement, "value", False)] if statement.value is not None else []
+    if t == hr.Assert:
+        return [(statement, "test", True)]
+    if t == hr.If or t == hr.While:
+        return [(statement, "condition", True)]
+
+    return []
+
+
+# Statement lists nested in a statement
+def nested_bodies(statement) -> list[list]:
+    t = type(statement)
+
+    if t == hr.If or t == hr.While:
+        return [statement.body] + ([statement.orelse] if statement.orelse else [])
+    if t == hr.For:
+        return [statement.body]
+
+    return []
+
+
+# Every statement in a list of statements, including nested statements
+def all_statements(statements: list):
+    for statement in statements:
+        yield statement
+        for body in nested_bodies(statement):
+            yield from all_statements(body)
+
+
+# Names assigned anywhere in a list of statements, including nested statements and loop counters
+def assigned(statements: list) -> set[str]:
+    result = set()
+
+    for statement in all_statements(statements):
+        if type(statement) == hr.Assign and type(statement.lhs) == hr.Name:
+            result.add(statement.lhs.id)
+        elif type(statement) == hr.For and type(statement.assignable) == hr.Name:
+            result.add(statement.assignable.id)
+
+    return result
+
+
+# Annotations of the variables declared in a list of statements, including nested statements
+def declarations(statements: list) -> dict[str, str]:
+    result = {}
+
+    for statement in statements:
+        if type(statement) == hr.Assign and type(statement.lhs) == hr.Name and statement.annotation is not None:
+            result.setdefault(statement.lhs.id, statement.annotation)
+        elif type(statement) == hr.For and type(statement.assignable) == hr.Name:
+            result.setdefault(statement.assignable.id, "int")
+
+        for body in nested_bodies(statement):
+            for name, annotation in declarations(body).items():
+                result.setdefault(name, annotation)
+
+    return result
+
+
+def _names(node) -> set[str]:
+    result = set()
+
+    def visit(statements):
+        for statement in statements:
+            if type(statement) == hr.FunctionDef:
+                result.update(a.name for a in statement.args)
+                visit(statement.body)
+                continue
+
+            for holder, attribute, _ in statement_expressions(statement):
+                result.update(reads(getattr(holder, attribute)))
+
+            if type(statement) == hr.Assign and type(statement.lhs) == hr.Name:
+                result.add(statement.lhs.id)
+            elif type(statement) == hr.For and type(statement.assignable) == hr.Name:
+                result.add(statement.assignable.id)
+
+            for body in nested_bodies(statement):
+                visit(body)
+
+    visit(node.body)
+
+    return result
+
+
+# Fresh variable names that do not clash with any name in the module
+class Temporaries:
+    def __init__(self, module: hr.Module, prefix: str):
+        self.taken = _names(module)
+        self.prefix = prefix
+        self.count = 0
+
+    def new(self) -> str:
+        while True:
+            name = f"{self.prefix}{self.count}"
+            self.count += 1
+            if name not in self.taken:
+                self.taken.add(name)
+                return name
+
+
+# Variables visible in the top level code or a function, with their annotations
+class Scope:
+    def __init__(self, variables: dict[str, str], globals: set[str], return_types: dict[str, str]):
+        self.variables = variables
+        self.globals = globals
+        self.return_types = return_types
+        # Number of reads of each variable in the scope, kept up to date as expressions are dropped
+        self.read_counts = Counter()
+
+    # Annotation of the value of an expression, or None if it is not known
+    def type_of(self, node) -> str | None:
+        t = type(node)
+
+        if t == hr.Name:
+            return self.variables.get(node.id)
+        if t == hr.Constant:
+            return type(node.value).__name__
+        if t == hr.UnaryOp:
+            if type(node.operator) == ast.Not:
+                return "int"
+            operand = self.type_of(node.operand)
+            if type(node.operator) == ast.Invert:
+                return "int" if operand == "int" else None
+            return operand
+        if t == hr.BinOp:
+            if type(node.operator) in COMPARISONS:
+                return "int"
+            left = self.type_of(node.left)
+            right = self.type_of(node.right)
+            if type(node.operator) in BOOLEAN_OPERATORS:
+                return left if left == right else None
+            if left is None or right is None:
+                return None
+            return "float" if "float" in (left, right) else "int"
+        if t == hr.IfExpr:
+            true_type = self.type_of(node.true_body)
+            return true_type if true_type == self.type_of(node.false_body) else None
+        if t == hr.Call:
+            return self.return_types.get(node.func)
+
+        return None
+
+    def count_reads(self, statements: list):
+        for statement in statements:
+            for holder, attribute, _ in statement_expressions(statement):
+                self.read_counts.update(reads(getattr(holder, attribute)))
+            if type(statement) == hr.For and type(statement.assignable) == hr.Name:
+                self.read_counts[statement.assignable.id] += 1
+            for body in nested_bodies(statement):
+                self.count_reads(body)
+
+    # Whether an expression can be removed without leaving a local that is never read. If so, the reads are forgotten
+    def drop(self, node) -> bool:
+        if not is_pure(node):
+            return False
+
+        dropped = Counter(reads(node))
+
+        for name, count in dropped.items():
+            if name not in self.globals and self.read_counts[name] <= count:
+                return False
+
+        self.read_counts.subtract(dropped)
+
+        return True
+
+
+
+def _is_constant(node, value) -> bool:
+    return type(node) == hr.Constant and node.value == value
+
+
+def _is_int_constant(node, value) -> bool:
+    return type(node) == hr.Constant and type(node.value) == int and node.value == value
+
+
+# Whether x op constant can become x, i.e. the constant does not change the type of the result
+def _keeps_type(scope: Scope, x, constant) -> bool:
+    return type(constant.value) == int or scope.type_of(x) == "float"
+
+
+def simplify(node, scope: Scope, condition: bool = False):
+    t = type(node)
+
+    if t == hr.BinOp:
+        operator = type(node.operator)
+        # The operands of and, or are only tested for truth when the result is
+        operands_condition = condition and operator in BOOLEAN_OPERATORS
+
+        node.left = simplify(node.left, scope, operands_condition)
+        node.right = simplify(node.right, scope, operands_condition)
+
+        left, right = node.left, node.right
+
+        if type(left) == hr.Constant and type(right) == hr.Constant and operator in _folds:
+            return hr.Constant(node.lineno, _folds[operator](left.value, right.value))
+
+        if operator == ast.Add:
+            if _is_constant(right, 0) and _keeps_type(scope, left, right):
+                return left
+            if _is_constant(left, 0) and _keeps_type(scope, right, left):
+                return right
+        elif operator == ast.Sub:
+            if _is_constant(right, 0) and _keeps_type(scope, left, right):
+                return left
+            if key(left) == key(right) and scope.type_of(left) == "int" and scope.drop(node):
+                return hr.Constant(node.lineno, 0)
+        elif operator == ast.Mult:
+            if _is_constant(right, 1) and _keeps_type(scope, left, right):
+                return left
+            if _is_constant(left, 1) and _keeps_type(scope, right, left):
+                return right
+            if _is_int_constant(right, 0) and scope.type_of(left) == "int" and scope.drop(node):
+                return hr.Constant(node.lineno, 0)
+            if _is_int_constant(left, 0) and scope.type_of(right) == "int" and scope.drop(node):
+                return hr.Constant(node.lineno, 0)
+
+        return node
+
+    if t == hr.UnaryOp:
+        operator = type(node.operator)
+
+        node.operand = simplify(node.operand, scope, operator == ast.Not)
+        operand = node.operand
+
+        # ~ of a float constant is left for the program to fail on when it runs
+        if type(operand) == hr.Constant and (operator != ast.Invert or type(operand.value) == int):
+            return hr.Constant(node.lineno, _unary_folds[operator](operand.value))
+
+        if operator == ast.UAdd:
+            return operand
+
+        if type(operand) == hr.UnaryOp and type(operand.operator) == operator:
+            inner = operand.operand
+
+            if operator == ast.USub:
+                return inner
+            if operator == ast.Invert and scope.type_of(inner) == "int":
+                return inner
+            if operator == ast.Not and (condition or is_boolean(inner)):
+                return inner
+
+        return node
+
+    if t == hr.IfExpr:
+        node.condition = simplify(node.condition, scope, True)
+        node.true_body = simplify(node.true_body, scope, condition)
+        node.false_body = simplify(node.false_body, scope, condition)
+
+        if type(node.condition) == hr.Constant and scope.drop(node.false_body if node.condition.value != 0 else node.true_body):
+            return node.true_body if node.condition.value != 0 else node.false_body
+
+        return node
+
+    if t == hr.Call:
+        node.args = [simplify(a, scope) for a in node.args]
+        return node
+
+    if t == hr.Subscript:
+        node.index = simplify(node.index, scope)
+        return node
+
+    return node
+
+
+def simplify_statements(statements: list, scope: Scope):
+    for statement in statements:
+        for holder, attribute, is_condition in statement_expressions(statement):
+            setattr(holder, attribute, simplify(getattr(holder, attribute), scope, is_condition))
+
+        for body in nested_bodies(statement):
+            simplify_statements(body, scope)
+
+
+
+# Subexpressions of an expression that are worth computing once, as (node, holder, attribute) so they can be replaced
+def _candidates(node, holder, attribute, scope: Scope, exclude_globals: bool, out: list):
+    t = type(node)
+
+    if t in (hr.BinOp, hr.UnaryOp) and is_pure(node) and scope.type_of(node) is not None:
+        if not (exclude_globals and any(name in scope.globals for name in reads(node))):
+            out.append((node, holder, attribute))
+
+    if t == hr.BinOp:
+        _candidates(node.left, node, "left", scope, exclude_globals, out)
+        _candidates(node.right, node, "right", scope, exclude_globals, out)
+    elif t == hr.UnaryOp:
+        _candidates(node.operand, node, "operand", scope, exclude_globals, out)
+    elif t == hr.IfExpr:
+        _candidates(node.condition, node, "condition", scope, exclude_globals, out)
+        _candidates(node.true_body, node, "true_body", scope, exclude_globals, out)
+        _candidates(node.false_body, node, "false_body", scope, exclude_globals, out)
+    elif t == hr.Call:
+        for i in range(len(node.args)):
+            _candidates(node.args[i], node.args, i, scope, exclude_globals, out)
+    elif t == hr.Subscript:
+        _candidates(node.index, node, "index", scope, exclude_globals, out)
+
+
+def _replace(holder, attribute, value):
+    if isinstance(holder, list):
+        holder[attribute] = value
+    else:
+        setattr(holder, attribute, value)
+
+
+# Occurrences of each subexpression in a basic block, by key and the versions of the variables it reads. A version is
+# bumped on every assignment, and every global is bumped after a statement with a call since the callee may assign it
+def _occurrences(block: list, scope: Scope) -> dict:
+    versions = Counter()
+    global_version = 0
+    occurrences = {}
+
+    for index, statement in enumerate(block):
+        has_call = any(contains_call(getattr(holder, attribute)) for holder, attribute, _ in statement_expressions(statement))
+
+        for holder, attribute, _ in statement_expressions(statement):
+            found = []
+            _candidates(getattr(holder, attribute), holder, attribute, scope, has_call, found)
+
+            for node, parent, field in found:
+                state = tuple((name, versions[name], global_version if name in scope.globals else 0) for name in sorted(set(reads(node))))
+                occurrences.setdefault((key(node), state), []).append((index, node, parent, field))
+
+        if type(statement) == hr.Assign and type(statement.lhs) == hr.Name:
+            versions[statement.lhs.id] += 1
+
+        if has_call:
+            global_version += 1
+
+    return occurrences
+
+
+# Variable assigned the whole of the first occurrence of a subexpression, if it keeps its value until the last one
+def _holder_of(block: list, occurrences: list, scope: Scope) -> str | None:
+    first, node, parent, field = occurrences[0]
+    last = occurrences[-1][0]
+    statement = block[first]
+
+    if parent is not statement or field != "rhs" or type(statement.lhs) != hr.Name:
+        return None
+
+    name = statement.lhs.id
+
+    for index in range(first + 1, last + 1):
+        later = block[index]
+
+        if index < last and type(later) == hr.Assign and type(later.lhs) == hr.Name and later.lhs.id == name:
+            return None
+        if name in scope.globals and any(contains_call(getattr(holder, attribute)) for holder, attribute, _ in statement_expressions(later)):
+            return None
+
+    return name
+
+
+def _eliminate_block(block: list, scope: Scope, temporaries: Temporaries) -> list:
+    while True:
+        best = None
+
+        for occurrences in _occurrences(block, scope).values():
+            count = len(occurrences)
+            n = size(occurrences[0][1])
+
+            # n * count operations become n for the temporary, one store and count loads
+            if (n - 1) * (count - 1) < 2:
+                continue
+
+            if best is None or n > best[0]:
+                best = (n, occurrences)
+
+        if best is None:
+            return block
+
+        _, occurrences = best
+        first, node = occurrences[0][0], occurrences[0][1]
+
+        name = _holder_of(block, occurrences, scope)
+
+        if name is not None:
+            for _, occurrence, parent, field in occurrences[1:]:
+                _replace(parent, field, hr.Name(occurrence.lineno, name))
+            continue
+
+        name = temporaries.new()
+        annotation = scope.type_of(node)
+
+        scope.variables[name] = annotation
+
+        for _, occurrence, parent, field in occurrences:
+            _replace(parent, field, hr.Name(occurrence.lineno, name))
+
+        block.insert(first, hr.Assign(block[first].lineno, hr.Name(block[first].lineno, name), node, annotation))
+
+
+def eliminate_common_subexpressions(statements: list, scope: Scope, temporaries: Temporaries) -> list:
+    result = []
+    block = []
+
+    for statement in statements:
+        if isinstance(statement, SIMPLE_STATEMENTS):
+            block.append(statement)
+            continue
+
+        result += _eliminate_block(block, scope, temporaries)
+        block = []
+
+        if type(statement) == hr.If:
+            statement.body = eliminate_common_subexpressions(statement.body, scope, temporaries)
+            if statement.orelse:
+                statement.orelse = eliminate_common_subexpressions(statement.orelse, scope, temporaries)
+        elif type(statement) == hr.While:
+            statement.body = eliminate_common_subexpressions(statement.body, scope, temporaries)
+            if statement.orelse:
+                statement.orelse = eliminate_common_subexpressions(statement.orelse, scope, temporaries)
+        elif type(statement) == hr.For:
+            statement.body = eliminate_common_subexpressions(statement.body, scope, temporaries)
+
+        result.append(statement)
+
+    return result + _eliminate_block(block, scope, temporaries)
+
+
+
+# Largest invariant subexpressions of an expression that are worth hoisting, as (node, holder, attribute)
+def _invariants(node, holder, attribute, variant: set, scope: Scope, exclude_globals: bool, out: list):
+    t = type(node)
+
+    if t in (hr.BinOp, hr.UnaryOp) and is_pure(node) and scope.type_of(node) is not None:
+        names = reads(node)
+
+        if not any(name in variant or (exclude_globals and name in scope.globals) for name in names):
+            out.append((node, holder, attribute))
+            return
+
+    if t == hr.BinOp:
+        _invariants(node.left, node, "left", variant, scope, exclude_globals, out)
+        _invariants(node.right, node, "right", variant, scope, exclude_globals, out)
+    elif t == hr.UnaryOp:
+        _invariants(node.operand, node, "operand", variant, scope, exclude_globals, out)
+    elif t == hr.IfExpr:
+        _invariants(node.condition, node, "condition", variant, scope, exclude_globals, out)
+        _invariants(node.true_body, node, "true_body", variant, scope, exclude_globals, out)
+        _invariants(node.false_body, node, "false_body", variant, scope, exclude_globals, out)
+    elif t == hr.Call:
+        for i in range(len(node.args)):
+            _invariants(node.args[i], node.args, i, variant, scope, exclude_globals, out)
+    elif t == hr.Subscript:
+        _invariants(node.index, node, "index", variant, scope, exclude_globals, out)
+
+
+# Assignments of the invariant expressions of a loop to new variables, replacing the expressions in the loop
+def _hoist(loop, scope: Scope, temporaries: Temporaries) -> list:
+    # The else block of a While runs once, after the loop
+    expressions = [(loop, "condition", True)] if type(loop) == hr.While else []
+
+    for statement in all_statements(loop.body):
+        expressions += statement_expressions(statement)
+
+    variant = assigned(loop.body)
+    if type(loop) == hr.For and type(loop.assignable) == hr.Name:
+        variant.add(loop.assignable.id)
+
+    exclude_globals = any(contains_call(getattr(holder, attribute)) for holder, attribute, _ in expressions)
+
+    found = []
+
+    for holder, attribute, _ in expressions:
+        _invariants(getattr(holder, attribute), holder, attribute, variant, scope, exclude_globals, found)
+
+    hoisted = []
+    names = {}
+
+    # Sorting is stable, so expressions of the same size stay in the order they were found
+    found.sort(key=lambda item: size(item[0]))
+
+    for node, holder, attribute in found:
+        k = key(node)
+
+        if k not in names:
+            names[k] = temporaries.new()
+            annotation = scope.type_of(node)
+            scope.variables[names[k]] = annotation
+            hoisted.append(hr.Assign(loop.lineno, hr.Name(loop.lineno, names[k]), node, annotation))
+
+        _replace(holder, attribute, hr.Name(node.lineno, names[k]))
+
+    return hoisted
+
+
+def hoist_loop_invariants(statements: list, scope: Scope, temporaries: Temporaries) -> list:
+    result = []
+
+    for statement in statements:
+        if type(statement) in (hr.While, hr.For):
+            result += _hoist(statement, scope, temporaries)
+
+        if type(statement) in (hr.If, hr.While):
+            statement.body = hoist_loop_invariants(statement.body, scope, temporaries)
+            if statement.orelse:
+                statement.orelse = hoist_loop_invariants(statement.orelse, scope, temporaries)
+        elif type(statement) == hr.For:
+            statement.body = hoist_loop_invariants(statement.body, scope, temporaries)
+
+        result.append(statement)
+
+    return result
+
+
+# Apply a pass to the top level statements and the body of every function. Top level statements are split into runs by
+# the functions between them
+def _transform(module: hr.Module, top: Scope, scopes: list, transform, temporaries: Temporaries):
+    body = []
+    run = []
+
+    for node in module.body:
+        if type(node) == hr.FunctionDef:
+            body += transform(run, top, temporaries)
+            run = []
+            body.append(node)
+        else:
+            run.append(node)
+
+    module.body = body + transform(run, top, temporaries)
+
+    for func, scope in scopes:
+        func.body = transform(func.body, scope, temporaries)
+
+
+
+# Run the optimisation passes over a module in place, returns the module
+def optimise(module: hr.Module, simplification: bool = True, loop_invariants: bool = True, common_subexpressions: bool = True) -> hr.Module:
+    temporaries = Temporaries(module, "_cse")
+    invariants = Temporaries(module, "_inv")
+
+    statements = [node for node in module.body if type(node) != hr.FunctionDef]
+    functions = [node for node in module.body if type(node) == hr.FunctionDef]
+
+    global_variables = declarations(statements)
+    global_names = set(global_variables)
+    return_types = {func.name: func.return_type for func in functions}
+
+    # Top level code only has globals, which can always be dropped, so its reads are not counted
+    top = Scope(global_variables, global_names, return_types)
+
+    scopes = []
+
+    for func in functions:
+        variables = dict(global_variables)
+        variables.update({a.name: a.annotation for a in func.args})
+        variables.update(declarations(func.body))
+
+        scope = Scope(variables, global_names, return_types)
+        scope.count_reads(func.body)
+        scopes.append((func, scope))
+
+    if simplification:
+        simplify_statements(statements, top)
+        for func, scope in scopes:
+            simplify_statements(func.body, scope)
+
+    # Before common subexpressions, whose new variables are assigned in the loop and would stop expressions using them
+    # being hoisted
+    if loop_invariants:
+        _transform(module, top, scopes, hoist_loop_invariants, invariants)
+
+    if common_subexpressions:
+        _transform(module, top, scopes, eliminate_common_subexpressions, temporaries)
+
+    return module
@@ -0,0 +1,114 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import hr
+import ir
+from compiler import _Compiler
+from stream import InstructionStream
+from symbols import Symbols
+
+# Parallel compilation of functions across a process pool.
+#
+# Once the global variables are known, each FunctionDef only depends on itself, the globals and the argument counts of the
+# functions it calls. Every function (and every run of top level statements) is compiled as an independent block starting
+# at location 0. Functions are farmed out to worker processes, then the blocks are concatenated in module order with
+# their jumps moved to their final location, and the Call locations are filled in from function_locations.
+#
+# The output is identical to compile() with the same reuse_slots and features. Symbol processing of function bodies happens in the workers, so only the top
+# level statements are processed up front.
+
+# State shared by every task in a worker, sent once per process by the pool initializer
+_worker_table = None
+_worker_options = None
+
+
+def _init_worker(top_level: dict, arg_counts: dict, extra_instructions: dict, extra_functions: dict, reuse_slots: bool):
+    global _worker_table, _worker_options
+
+    _worker_table = Symbols()
+    _worker_table.top_level = top_level
+    _worker_table.arg_counts = arg_counts
+    _worker_options = extra_instructions, extra_functions, reuse_slots
+
+
+# Compile a single function into a block starting at location 0, returns the block, its unresolved calls, its stack
+# analysis and its purity
+def _compile_function(func: hr.FunctionDef):
+    _worker_table.add_function(func)
+
+    c = _Compiler(_worker_table, *_worker_options)
+    c.walk(func)
+
+    _worker_table.remove_function(func.name)
+
+    return c.instructions, c.calls, c.stack_depths[func.name], c.call_depths[func.name], c.local_purity[func.name]
+
+
+def compile_parallel(module: hr.Module, extra_instructions: dict, extra_functions: dict, processes: int | None = None, chunksize: int = 8,
+                     reuse_slots: bool = False, features=None):
+    table = Symbols()
+    table.add_statements(list(filter(lambda x : isinstance(x, hr.Statement), module.body)))
+
+    functions = list(filter(lambda x : isinstance(x, hr.FunctionDef), module.body))
+
+    for func in functions:
+        table.arg_counts[func.name] = len(func.args)
+
+    worker_state = (table.top_level, table.arg_counts, extra_instructions, extra_functions, reuse_slots)
+
+    if processes == 1:
+        _init_worker(*worker_state)
+        function_blocks = list(map(_compile_function, functions))
+    else:
+        with ProcessPoolExecutor(processes or os.cpu_count(), initializer=_init_worker, initargs=worker_state) as pool:
+            function_blocks = list(pool.map(_compile_function, functions, chunksize=chunksize))
+
+    # Link the blocks together in module order
+    program = InstructionStream()
+    function_locations = {}
+    calls = []
+
+    global_var_count = len(table.top_level)
+
+    if global_var_count != 0:
+        program.emit(ir.GlobalAlloc, global_var_count)
+
+    def append_block(block: InstructionStream, block_calls: list):
+        base = len(program)
+        program.extend(block, base)
+        calls.extend((base + index, name) for index, name in block_calls)
+
+    blocks = iter(function_blocks)
+    c = _Compiler(table, extra_instructions, extra_functions, reuse_slots)
+
+    for node in module.body:
+        if type(node) == hr.FunctionDef:
+            block, block_calls, stack_depth, call_depths, local_purity = next(blocks)
+
+            function_locations[node.name] = len(program)
+            append_block(block, block_calls)
+
+            c.stack_depths[node.name] = stack_depth
+            c.call_depths[node.name] = call_depths
+            c.local_purity[node.name] = local_purity
+        else:
+            c.walk(node)
+            c.analyse_top_level()
+            append_block(c.instructions, c.calls)
+            c.instructions = InstructionStream()
+            c.calls = []
+
+    for index, name in calls:
+        program.patch(index, "location", function_locations[name])
+
+    c.stack_depths.setdefault(None, 0)
+    c.function_locations = function_locations
+    c.record_stack_depths(program)
+    c.record_purity(program, module)
+    program.global_types = c.global_types()
+    program.function_locations = function_locations
+
+    if features is not None:
+        features.validate(program)
+
+    return program
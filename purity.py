@@ -0,0 +1,61 @@
+import ir
+from stream import InstructionStream
+
+# Purity analysis of user defined functions.
+#
+# A function is pure if its return value only depends on its arguments and calling it has no effect other than returning
+# that value. Such a call can be skipped when the same arguments have been seen before, and the earlier result used (see
+# Interpreter memoization).
+#
+# The analysis works on the compiled code of each function. A function is pure if it
+# - does not read or write globals or memory blocks (reads are excluded too, since they can change between calls)
+# - does not use built in instructions or functions, which may do anything
+# - only calls pure functions
+# The last rule is solved as a fixed point over the call graph, starting from every function that passes the first two
+# rules being pure, so recursive functions can be pure.
+
+# Instructions that make a function impure wherever they appear
+impure_instructions = {
+    ir.OpStackPushGlobal.opcode,
+    ir.OpStackPopGlobal.opcode,
+    ir.GlobalAlloc.opcode,
+    ir.BuiltInInstruction.opcode,
+    ir.BuiltInFunction.opcode,
+    ir.MemoryLoad.opcode,
+    ir.MemoryStore.opcode,
+    ir.MemoryBulk.opcode,
+}
+
+FOR_RANGE = (ir.ForRangeInit.opcode, ir.ForRangeNext.opcode)
+
+
+# Whether the code in [start, end) has no effects of its own, ignoring what the functions it calls do
+def region_is_pure(stream: InstructionStream, start: int, end: int) -> bool:
+    for index in range(start, end):
+        op = stream.opcodes[index]
+
+        if op in impure_instructions:
+            return False
+
+        if op in FOR_RANGE and stream.operand(index, "scope") == ir.SCOPE_GLOBAL:
+            return False
+
+    return True
+
+
+# Names of the pure functions. local_purity maps each function to region_is_pure of its body, call_depths maps it to the
+# (depth, callee) of each of its calls (see stackdepth.py)
+def pure_functions(local_purity: dict, call_depths: dict) -> set:
+    pure = {name for name, is_pure in local_purity.items() if is_pure}
+
+    changed = True
+
+    while changed:
+        changed = False
+
+        for name in list(pure):
+            if any(callee not in pure for _, callee in call_depths.get(name, [])):
+                pure.remove(name)
+                changed = True
+
+    return pure
@@ -0,0 +1,138 @@
+import ir
+from stream import InstructionStream
+
+# Frame slot allocation for local variables.
+#
+# Symbols gives every local its own frame slot for the whole function. Here the live range of each local is worked out
+# over the compiled code of a function, and locals whose live ranges never overlap are given the same slot (graph
+# colouring, as in register allocation). This shrinks the LocalAlloc of the function.
+#
+# Liveness is worked out per instruction with the usual backwards dataflow, using ints as bit sets of local offsets.
+
+PUSH_LOCAL = ir.OpStackPushLocal.opcode
+POP_LOCAL = ir.OpStackPopLocal.opcode
+LOCAL_ALLOC = ir.LocalAlloc.opcode
+RETURN = ir.Return.opcode
+JUMP = ir.Jump.opcode
+CONDITIONAL_JUMPS = (ir.JumpIfTrue.opcode, ir.JumpIfFalse.opcode, ir.ForRangeInit.opcode, ir.ForRangeNext.opcode)
+FOR_RANGE_INIT = ir.ForRangeInit.opcode
+FOR_RANGE_NEXT = ir.ForRangeNext.opcode
+
+
+# Successors of each instruction in [start, end), as stream indices. base is the location of stream index 0
+def successors(stream: InstructionStream, start: int, end: int, base: int = 0) -> list[list[int]]:
+    result = []
+
+    for i in range(start, end):
+        op = stream.opcodes[i]
+
+        if op == RETURN:
+            result.append([])
+        elif op == JUMP:
+            result.append([stream.operands[stream.starts[i]] - base])
+        elif op in CONDITIONAL_JUMPS:
+            result.append([i + 1, stream.operand(i, "location") - base])
+        else:
+            result.append([i + 1])
+
+    return [[s for s in succ if start <= s < end] for succ in result]
+
+
+# Offset of the local variable an instruction reads or writes, if any
+def local_operand(stream: InstructionStream, index: int) -> int | None:
+    op = stream.opcodes[index]
+
+    if op in (PUSH_LOCAL, POP_LOCAL):
+        return stream.operands[stream.starts[index]]
+
+    if op in (FOR_RANGE_INIT, FOR_RANGE_NEXT) and stream.operand(index, "scope") == ir.SCOPE_LOCAL:
+        return stream.operand(index, "offset")
+
+    return None
+
+
+# Returns the sets of locals live after and before each instruction in [start, end)
+def liveness(stream: InstructionStream, start: int, end: int, base: int = 0) -> tuple[list[int], list[int]]:
+    succ = successors(stream, start, end, base)
+
+    uses = []
+    defs = []
+
+    for i in range(start, end):
+        local = local_operand(stream, i)
+        bit = 1 << local if local is not None else 0
+        op = stream.opcodes[i]
+        # ForRangeNext reads the counter but only writes it on the path back into the loop, so it does not kill it
+        uses.append(bit if op in (PUSH_LOCAL, FOR_RANGE_NEXT) else 0)
+        defs.append(bit if op in (POP_LOCAL, FOR_RANGE_INIT) else 0)
+
+    live_in = [0] * (end - start)
+    out = [0] * (end - start)
+
+    changed = True
+
+    while changed:
+        changed = False
+
+        for i in reversed(range(end - start)):
+            o = 0
+            for s in succ[i]:
+                o |= live_in[s - start]
+
+            n = uses[i] | (o & ~defs[i])
+
+            if o != out[i] or n != live_in[i]:
+                out[i] = o
+                live_in[i] = n
+                changed = True
+
+    return out, live_in
+
+
+# Reassign the local offsets of the function occupying [start, end) so that locals with disjoint live ranges share a
+# slot. The first instruction must be the function's LocalAlloc. Returns old offset -> new slot
+def allocate_slots(stream: InstructionStream, start: int, end: int, base: int = 0) -> dict[int, int]:
+    if stream.opcodes[start] != LOCAL_ALLOC:
+        raise Exception(f"Function at {start + base} does not start with LocalAlloc")
+
+    local_count = stream.operands[stream.starts[start]]
+
+    out, live_in = liveness(stream, start, end, base)
+
+    interference = [0] * local_count
+
+    def interfere(v: int, live: int):
+        interference[v] |= live & ~(1 << v)
+        for u in range(local_count):
+            if live >> u & 1 and u != v:
+                interference[u] |= 1 << v
+
+    # Locals read before they are written on some path are live on entry, and all hold a value at the same time
+    for v in range(local_count):
+        if live_in[0] >> v & 1:
+            interfere(v, live_in[0])
+
+    # A local written while another is live cannot share its slot
+    for i in range(start, end):
+        local = local_operand(stream, i)
+        if local is not None and stream.opcodes[i] != PUSH_LOCAL:
+            interfere(local, out[i - start])
+
+    # Greedy colouring in order of declaration
+    slots = {}
+
+    for v in range(local_count):
+        taken = {slots[u] for u in slots if interference[v] >> u & 1}
+        slot = 0
+        while slot in taken:
+            slot += 1
+        slots[v] = slot
+
+    for i in range(start, end):
+        local = local_operand(stream, i)
+        if local is not None:
+            stream.patch(i, "offset", slots[local])
+
+    stream.patch(start, "variable_count", max(slots.values()) + 1 if slots else 0)
+
+    return slots
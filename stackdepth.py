@@ -0,0 +1,173 @@
+import ir
+from stream import InstructionStream
+
+# Static op stack depth analysis.
+#
+# The depth of the op stack before every instruction is worked out by abstract interpretation of the stack effect of each
+# instruction, following every jump. The analysis rejects code where two paths reach the same instruction with different
+# depths, where the stack would underflow, or where a Return does not leave exactly the return value on the stack.
+#
+# The maximum depth of each function (and of the top level code) is recorded in the compiled output, so that an engine
+# can preallocate a fixed-size op stack and use an integer stack pointer. Depths are relative to the depth when the
+# function was called, since the op stack is shared across calls; program_bound adds up depths along call chains.
+
+# (pops, pushes) of each instruction, by opcode. Built ins and bulk memory operations pop their args operand and are
+# handled separately
+_effects = {
+    ir.OpStackPushLocal: (0, 1),
+    ir.OpStackPopLocal: (1, 0),
+    ir.OpStackPushArg: (0, 1),
+    ir.OpStackPopArg: (1, 0),
+    ir.OpStackPushLiteral: (0, 1),
+    ir.OpStackPopToCallStack: (1, 0),
+    ir.OpStackPushGlobal: (0, 1),
+    ir.OpStackPopGlobal: (1, 0),
+    ir.OpStackPop: (1, 0),
+    ir.OpStackDuplicate: (1, 2),
+    ir.Jump: (0, 0),
+    ir.JumpIfTrue: (1, 0),
+    ir.JumpIfFalse: (1, 0),
+    ir.ConvertIntToFloat: (1, 1),
+    ir.ConvertFloatToInt: (1, 1),
+    ir.Call: (0, 1),
+    ir.Return: (1, 0),
+    ir.LocalAlloc: (0, 0),
+    ir.GlobalAlloc: (0, 0),
+    ir.Equal: (2, 1),
+    ir.NotEqual: (2, 1),
+    ir.LessThan: (2, 1),
+    ir.GreaterThan: (2, 1),
+    ir.LessThanEqualTo: (2, 1),
+    ir.GreaterThanEqualTo: (2, 1),
+    ir.Add: (2, 1),
+    ir.Sub: (2, 1),
+    ir.Multiply: (2, 1),
+    ir.UnaryNegative: (1, 1),
+    ir.UnaryPositive: (1, 1),
+    ir.OnesComplement: (1, 1),
+    ir.LogicalNot: (1, 1),
+    ir.Ternary: (3, 1),
+    ir.Assert: (1, 0),
+    ir.Finish: (0, 0),
+    ir.ForRangeInit: (0, 0),
+    ir.ForRangeNext: (0, 0),
+    ir.MemoryLoad: (1, 1),
+    ir.MemoryStore: (2, 0),
+}
+
+stack_effects = [None] * len(ir.opcodes)
+
+for _instruction, _effect in _effects.items():
+    stack_effects[_instruction.opcode] = _effect
+
+BUILT_IN_INSTRUCTION = ir.BuiltInInstruction.opcode
+BUILT_IN_FUNCTION = ir.BuiltInFunction.opcode
+MEMORY_BULK = ir.MemoryBulk.opcode
+CALL = ir.Call.opcode
+RETURN = ir.Return.opcode
+
+
+def stack_effect(stream: InstructionStream, index: int) -> tuple[int, int]:
+    op = stream.opcodes[index]
+
+    if op == BUILT_IN_INSTRUCTION:
+        return stream.operand(index, "args"), 0
+
+    if op == BUILT_IN_FUNCTION or op == MEMORY_BULK:
+        return stream.operand(index, "args"), 1
+
+    return stack_effects[op]
+
+
+# Successor indices of an instruction. base is the location of stream index 0
+def successors(stream: InstructionStream, index: int, base: int = 0) -> list[int]:
+    cls = stream.type(index)
+
+    if cls is ir.Return or cls is ir.Finish:
+        return []
+
+    if cls is ir.Jump:
+        return [stream.operand(index, "location") - base]
+
+    # Calls return to the next instruction
+    if cls.locations and cls is not ir.Call:
+        return [index + 1, stream.operand(index, "location") - base]
+
+    return [index + 1]
+
+
+# Analyse the code in [start, end), entered at start with an empty stack. The region must leave the stack empty when it
+# falls off the end, and every Return must leave exactly the return value. Jumps may only target the region or its end.
+# Returns the maximum depth and a list of (depth, index) for every Call, the depth being the depth below the callee
+def analyse_region(stream: InstructionStream, start: int, end: int, base: int = 0) -> tuple[int, list]:
+    depths = {start: 0}
+    worklist = [start]
+    max_depth = 0
+    calls = []
+
+    def reach(index: int, depth: int, source: int):
+        if index == end:
+            if depth != 0:
+                raise Exception(f"Op stack is unbalanced, {depth} values are left at location {end + base} (from location {source + base})")
+            return
+
+        if not start <= index < end:
+            raise Exception(f"Jump at location {source + base} leaves its code block")
+
+        if index in depths:
+            if depths[index] != depth:
+                raise Exception(f"Op stack is unbalanced at location {index + base}, reached with depth {depths[index]} and {depth}")
+            return
+
+        depths[index] = depth
+        worklist.append(index)
+
+    while worklist:
+        index = worklist.pop()
+        depth = depths[index]
+
+        pops, pushes = stack_effect(stream, index)
+
+        if pops > depth:
+            raise Exception(f"Op stack underflow at location {index + base}")
+
+        if stream.opcodes[index] == RETURN and depth != 1:
+            raise Exception(f"Return at location {index + base} leaves {depth} values on the op stack, expected 1")
+
+        if stream.opcodes[index] == CALL:
+            calls.append((depth, index))
+
+        depth = depth - pops + pushes
+        max_depth = max(max_depth, depth)
+
+        for successor in successors(stream, index, base):
+            reach(successor, depth, index)
+
+    return max_depth, calls
+
+
+# Maximum depth of the whole op stack, following calls. stack_depths maps each function (None for the top level code) to
+# its own maximum depth, call_depths maps it to a list of (depth, callee). Returns None if the call graph is recursive.
+# Works with an explicit stack since machine generated call chains can be deeper than Python's recursion limit
+def program_bound(stack_depths: dict, call_depths: dict, root=None) -> int | None:
+    bounds = {}
+    active = {root}
+    stack = [(root, iter(call_depths.get(root, [])))]
+
+    while stack:
+        name, sites = stack[-1]
+
+        for depth, callee in sites:
+            if callee in active:
+                return None
+
+            if callee not in bounds:
+                active.add(callee)
+                stack.append((callee, iter(call_depths.get(callee, []))))
+                break
+        else:
+            stack.pop()
+            active.remove(name)
+            bounds[name] = max([stack_depths[name]] + [depth + bounds[callee] for depth, callee in call_depths.get(name, [])])
+
+    return bounds[root]
@@ -0,0 +1,205 @@
+from array import array
+
+import ir
+
+# Struct-of-arrays container for compiled code.
+#
+# Rather than holding one ir.Instruction object per instruction, the stream keeps three parallel typed arrays:
+# - opcodes: the opcode of each instruction (see ir.opcodes)
+# - starts: the index of the first operand of each instruction in operands
+# - operands: every operand of every instruction, flattened
+# Integer operands are stored directly. A location of None (a jump that has not been patched yet) is stored as -1. Operands
+# listed in the instruction's `pooled` fields (literals, built in names) are stored as an index into the constant pool.
+
+NONE_OPERAND = -1
+
+class InstructionStream:
+    def __init__(self):
+        self.opcodes = array("B")
+        self.starts = array("I")
+        self.operands = array("q")
+        self.constants = []
+        self.constant_indices = {}
+        # Filled in by the compiler (see stackdepth.py): maximum op stack depth of each function (None for top level code),
+        # and of the whole program following calls (None if it is recursive)
+        self.stack_depths = {}
+        self.max_stack_depth = None
+        # Annotation ("int" or "float") of each global variable, by offset
+        self.global_types = []
+        # Location -> arg count of each pure function (see purity.py)
+        self.pure_functions = {}
+        # Name -> location of each function
+        self.function_locations = {}
+        # Set by verifier.verify, and cleared by any change to the code
+        self.verified = False
+        # Number of memory blocks addressed by MemoryLoad and MemoryStore in verified code, set by verifier.verify
+        self.memory_blocks = 0
+
+    @classmethod
+    def from_instructions(cls, instructions: list[ir.Instruction]):
+        stream = cls()
+        for instruction in instructions:
+            stream.append(instruction)
+        return stream
+
+    def constant(self, value):
+        # Key on the type and repr so that 1, 1.0 and -0.0 stay distinct
+        key = (type(value), repr(value))
+
+        index = self.constant_indices.get(key)
+
+        if index is None:
+            index = len(self.constants)
+            self.constants.append(value)
+            self.constant_indices[key] = index
+
+        return index
+
+    def encode(self, instruction: type, field: str, value):
+        if field in instruction.pooled:
+            return self.constant(value)
+        if value is None:
+            return NONE_OPERAND
+        return value
+
+    def decode(self, instruction: type, field: str, operand: int):
+        if field in instruction.pooled:
+            return self.constants[operand]
+        if operand == NONE_OPERAND and field in instruction.locations:
+            return None
+        return operand
+
+    # Append an instruction given its class and operands, returns the index of the new instruction
+    def emit(self, instruction: type, *operands):
+        if len(operands) != len(instruction.fields):
+            raise Exception(f"{instruction.__name__} expects {len(instruction.fields)} operands, found {len(operands)}")
+
+        index = len(self.opcodes)
+
+        self.verified = False
+        self.opcodes.append(instruction.opcode)
+        self.starts.append(len(self.operands))
+
+        for field, value in zip(instruction.fields, operands):
+            self.operands.append(self.encode(instruction, field, value))
+
+        return index
+
+    # Append an ir.Instruction object, returns the index of the new instruction
+    def append(self, instruction: ir.Instruction):
+        cls = type(instruction)
+        return self.emit(cls, *[getattr(instruction, field) for field in cls.fields])
+
+    # Append the instructions [start, end) (by default all) of another stream, re-interning its pooled operands into this
+    # stream's constant pool. Code locations (other than unpatched ones) are moved by shift, i.e. when a block compiled at
+    # location 0 is appended
+    def extend(self, other: "InstructionStream", shift: int = 0, start: int = 0, end: int | None = None):
+        self.verified = False
+
+        for i in range(start, len(other) if end is None else end):
+            cls = other.type(i)
+            first = other.starts[i]
+
+            self.opcodes.append(cls.opcode)
+            self.starts.append(len(self.operands))
+
+            for j, field in enumerate(cls.fields):
+                operand = other.operands[first + j]
+                if field in cls.pooled:
+                    operand = self.constant(other.constants[operand])
+                elif field in cls.locations and operand != NONE_OPERAND:
+                    operand += shift
+                self.operands.append(operand)
+
+    def type(self, index: int) -> type:
+        return ir.opcodes[self.opcodes[index]]
+
+    def operand(self, index: int, field: str):
+        cls = self.type(index)
+        return self.decode(cls, field, self.operands[self.starts[index] + cls.fields.index(field)])
+
+    # Overwrite a single operand of an existing instruction, i.e. to fill in the location of a forward jump
+    def patch(self, index: int, field: str, value):
+        cls = self.type(index)
+        self.verified = False
+        self.operands[self.starts[index] + cls.fields.index(field)] = self.encode(cls, field, value)
+
+    # Decoded operands of an instruction, in field order
+    def operands_of(self, index: int) -> tuple:
+        cls = self.type(index)
+        start = self.starts[index]
+        return tuple(self.decode(cls, field, self.operands[start + j]) for j, field in enumerate(cls.fields))
+
+    def materialize(self, index: int) -> ir.Instruction:
+        cls = self.type(index)
+        instruction = cls.__new__(cls)
+        for field in cls.fields:
+            setattr(instruction, field, self.operand(index, field))
+        return instruction
+
+    def to_instructions(self) -> list[ir.Instruction]:
+        return [self.materialize(i) for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [InstructionView(self, i) for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("instruction index out of range")
+
+        return InstructionView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield InstructionView(self, i)
+
+    # Two streams are equal if they hold the same instructions with the same operands, regardless of constant pool layout
+    def __eq__(self, other):
+        if not isinstance(other, InstructionStream):
+            return NotImplemented
+
+        if self.opcodes != other.opcodes:
+            return False
+
+        for i in range(len(self)):
+            a = self.operands_of(i)
+            b = other.operands_of(i)
+            if [(type(v), v) for v in a] != [(type(v), v) for v in b]:
+                return False
+
+        return True
+
+    def __repr__(self):
+        return "[" + ", ".join(repr(view) for view in self) + "]"
+
+
+
+# Lightweight read only view of a single instruction in a stream. Operands are decoded on access.
+class InstructionView:
+    __slots__ = ("stream", "index")
+
+    def __init__(self, stream: InstructionStream, index: int):
+        self.stream = stream
+        self.index = index
+
+    @property
+    def type(self) -> type:
+        return self.stream.type(self.index)
+
+    def __getattr__(self, field):
+        cls = self.stream.type(self.index)
+        if field not in cls.fields:
+            raise AttributeError(f"{cls.__name__} has no operand '{field}'")
+        return self.stream.operand(self.index, field)
+
+    def materialize(self) -> ir.Instruction:
+        return self.stream.materialize(self.index)
+
+    def __repr__(self):
+        return repr(self.materialize())
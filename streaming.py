@@ -0,0 +1,248 @@
+import ast
+import io
+import pickle
+import tokenize
+
+import hr
+import ir
+import memory
+import purity
+import stackdepth
+from compiler import _Compiler
+from stream import InstructionStream
+from symbols import Symbols
+
+# Streaming, function-at-a-time compilation.
+#
+# compile() needs the whole HR tree, the whole symbol table and every instruction in memory at once. Here the source is
+# split into top level statements as it is read, and each FunctionDef (or group of consecutive statements) is converted to
+# HR, added to the symbol table, compiled and handed to a sink before the next one is read. Peak memory is proportional to
+# the largest function rather than the whole module.
+#
+# Calls to functions that have already been placed are resolved straight away. Forward calls are recorded in a small
+# relocation table and patched through the sink once the whole module has been read, as is the GlobalAlloc count.
+#
+# Differences from compile():
+# - Globals must be declared before any function that uses them
+# - GlobalAlloc is always emitted as the first instruction (even if it allocates nothing) since the global count is not
+#   known until the end
+
+# Collects the chunks into a single InstructionStream
+class ListSink:
+    def __init__(self):
+        self.stream = InstructionStream()
+
+    def write(self, chunk: InstructionStream):
+        self.stream.extend(chunk)
+
+    def patch(self, index: int, field: str, value):
+        self.stream.patch(index, field, value)
+
+    # Attributes of the whole program, i.e. stack_depths
+    def metadata(self, **attributes):
+        for name, value in attributes.items():
+            setattr(self.stream, name, value)
+
+    def close(self):
+        pass
+
+
+# Writes each chunk to a file as soon as it arrives. Patches are written as a trailer and applied by FileSink.load
+class FileSink:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.patches = []
+
+    def write(self, chunk: InstructionStream):
+        pickle.dump(("chunk", chunk), self.file)
+
+    def patch(self, index: int, field: str, value):
+        self.patches.append((index, field, value))
+
+    def metadata(self, **attributes):
+        pickle.dump(("metadata", attributes), self.file)
+
+    def close(self):
+        pickle.dump(("patches", self.patches), self.file)
+        self.file.close()
+
+    @staticmethod
+    def load(path: str) -> InstructionStream:
+        sink = ListSink()
+
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    kind, record = pickle.load(f)
+                except EOFError:
+                    break
+
+                if kind == "chunk":
+                    sink.write(record)
+                elif kind == "metadata":
+                    sink.metadata(**record)
+                else:
+                    for patch in record:
+                        sink.patch(*patch)
+
+        return sink.stream
+
+
+
+class _StreamingCompiler(_Compiler):
+    def __init__(self, table: Symbols, built_in_instructions: dict, built_in_functions: dict, reuse_slots: bool = False):
+        super().__init__(table, built_in_instructions, built_in_functions, reuse_slots)
+        # (name, arg count, lineno) of calls to functions that had not been seen when the call was compiled
+        self.forward_calls = []
+
+    def visit_Call(self, node):
+        if node.func in self.table.arg_counts or node.func in self.bi_instructions or node.func in self.bi_functions or node.func in memory.operations:
+            super().visit_Call(node)
+        else:
+            self.forward_calls.append((node.func, len(node.args), node.lineno))
+            self.emit_user_call(node)
+
+    # Take the instructions emitted so far as a chunk, the next chunk starts where this one ends
+    def take_chunk(self):
+        chunk = self.instructions
+        self.base += len(chunk)
+        self.instructions = InstructionStream()
+        self.function_ranges = {}
+        return chunk
+
+
+
+# Split source lines into top level statements as they are read. Yields (first line number, source) pairs.
+# else/elif/except/finally at column 0 continue the previous statement.
+def top_level_statements(readline):
+    lines = []
+    first_line = 1
+    complete = False
+    depth = 0
+
+    def reader():
+        line = readline()
+        lines.append(line)
+        return line
+
+    for token in tokenize.generate_tokens(reader):
+        if token.type in (tokenize.NL, tokenize.COMMENT, tokenize.ENCODING):
+            continue
+        elif token.type == tokenize.NEWLINE:
+            complete = complete or depth == 0
+        elif token.type == tokenize.INDENT:
+            # The NEWLINE before an indented block ends a compound statement header, not the statement
+            depth += 1
+            complete = False
+        elif token.type == tokenize.DEDENT:
+            depth -= 1
+            complete = complete or depth == 0
+        elif token.type == tokenize.ENDMARKER:
+            break
+        elif complete:
+            if token.type == tokenize.NAME and token.string in ("else", "elif", "except", "finally"):
+                complete = False
+                continue
+
+            line = token.start[0]
+            yield first_line, "".join(lines[:line - first_line])
+            del lines[:line - first_line]
+            first_line = line
+            complete = False
+
+    source = "".join(lines)
+    if source.strip():
+        yield first_line, source
+
+
+def _hr_statements(readline):
+    constructor = hr.HRConstructor()
+
+    for first_line, source in top_level_statements(readline):
+        module = ast.parse(source)
+        ast.increment_lineno(module, first_line - 1)
+
+        for node in module.body:
+            statement = constructor.visit(node)
+            if not isinstance(statement, hr.Statement) and type(statement) != hr.FunctionDef:
+                raise Exception(f"Top level module statements must be functions or statements, found {statement}")
+            yield statement
+
+
+def compile_stream(source: str | io.TextIOBase, sink, extra_instructions: dict, extra_functions: dict, group_size: int = 256,
+                   reuse_slots: bool = False, features=None):
+    if isinstance(source, str):
+        source = io.StringIO(source)
+
+    table = Symbols()
+    c = _StreamingCompiler(table, extra_instructions, extra_functions, reuse_slots)
+
+    # Absolute index of every unresolved Call and the function it refers to
+    relocations = []
+    global_alloc = c.instructions.emit(ir.GlobalAlloc, None)
+
+    def flush():
+        chunk = c.take_chunk()
+        base = c.base - len(chunk)
+
+        for index, name in c.calls:
+            if name in c.function_locations:
+                chunk.patch(index, "location", c.function_locations[name])
+            else:
+                relocations.append((base + index, name))
+
+        c.calls = []
+
+        # Chunks are checked before they are written, as the sink may not keep them
+        if features is not None:
+            features.validate(chunk, base=base)
+
+        if len(chunk) != 0:
+            sink.write(chunk)
+
+    group = []
+
+    def compile_group():
+        table.add_statements(group)
+        c.traverse(group)
+        c.analyse_top_level()
+        group.clear()
+        flush()
+
+    for statement in _hr_statements(source.readline):
+        if type(statement) == hr.FunctionDef:
+            if group:
+                compile_group()
+
+            table.add_function(statement)
+            c.walk(statement)
+            table.remove_function(statement.name)
+            flush()
+        else:
+            group.append(statement)
+            if len(group) >= group_size:
+                compile_group()
+
+    if group:
+        compile_group()
+
+    for name, arg_count, lineno in c.forward_calls:
+        if name not in table.arg_counts:
+            raise Exception(f"Function '{name}' is called but never defined. (lineno: {lineno})")
+        if table.count_args(name) != arg_count:
+            raise Exception(f"User defined function '{name}' expects {table.count_args(name)} args, found {arg_count}. (lineno: {lineno})")
+
+    for index, name in relocations:
+        sink.patch(index, "location", c.function_locations[name])
+
+    sink.patch(global_alloc, "variable_count", len(table.top_level))
+
+    c.stack_depths.setdefault(None, 0)
+    pure = purity.pure_functions(c.local_purity, c.call_depths)
+    sink.metadata(stack_depths=c.stack_depths, max_stack_depth=stackdepth.program_bound(c.stack_depths, c.call_depths), global_types=c.global_types(),
+                  pure_functions={c.function_locations[name]: table.count_args(name) for name in pure}, function_locations=dict(c.function_locations))
+
+    sink.close()
+
+    return sink
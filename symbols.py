@@ -18,6 +18,42 @@ class Symbol:
 
 
 
+# Finds whether the statements of a loop body might assign to a variable, see hidden_counter
+class _AssignmentFinder(hr.Walker):
+    def __init__(self, id: str, is_global: bool):
+        self.id = id
+        self.is_global = is_global
+        self.found = False
+
+    def visit_Assign(self, node):
+        if isinstance(node.lhs, hr.Name) and node.lhs.id == self.id:
+            self.found = True
+        self.generic_walk(node)
+
+    def visit_For(self, node):
+        if isinstance(node.assignable, hr.Name) and node.assignable.id == self.id:
+            self.found = True
+        self.generic_walk(node)
+
+    # Any function can assign to a global
+    def visit_Call(self, node):
+        if self.is_global:
+            self.found = True
+        self.generic_walk(node)
+
+
+# A for loop counts its iterations in its target, unless the body might assign to the target, in which case assigning
+# to it would change the iterations (Python's loops carry on from the next value of the range regardless). Such loops
+# count in a hidden variable instead, declared next to the target, and copy it into the target at the start of each
+# iteration. Returns the name of the hidden variable, which can not clash with a Python identifier, or None
+def hidden_counter(node: hr.For, is_global: bool) -> str | None:
+    finder = _AssignmentFinder(node.assignable.id, is_global)
+    finder.traverse(node.body)
+
+    return f"{node.assignable.id}:{node.lineno}" if finder.found else None
+
+
+
 class ExtractVariables(hr.Walker):
     def __init__(self, is_top_level: bool, globals):
         self.is_top_level = is_top_level
@@ -72,6 +108,7 @@ class ExtractVariables(hr.Walker):
         self.walk(node.rhs)
 
         if isinstance(node.lhs, hr.Subscript):
+            self.walk(node.lhs.index)
             return
 
         if node.lhs.id in self.declared:
@@ -84,7 +121,30 @@ class ExtractVariables(hr.Walker):
 
 
 
-        self.declared[node.lhs.id] = Symbol(node.lhs.id, node.annotation, self.is_top_level, False, self.global_offset if self.is_top_level else self.local_offset)
+        self.declare(node.lhs.id, node.annotation)
+
+    def visit_For(self, node):
+        if isinstance(node.assignable, hr.Name):
+            # Loop counters are declared by the loop if they have not been already
+            if node.assignable.id not in self.declared:
+                self.declare(node.assignable.id, "int")
+
+            # The loop itself reads the counter
+            self.all[node.assignable.id] = self.declared[node.assignable.id]
+
+            counter = hidden_counter(node, self.declared[node.assignable.id].is_global)
+
+            if counter is not None:
+                if counter not in self.declared:
+                    self.declare(counter, "int")
+                self.all[counter] = self.declared[counter]
+        else:
+            self.walk(node.assignable)
+
+        self.traverse(node.body)
+
+    def declare(self, identifier: str, annotation: str):
+        self.declared[identifier] = Symbol(identifier, annotation, self.is_top_level, False, self.global_offset if self.is_top_level else self.local_offset)
 
         if self.is_top_level:
             self.global_offset += 1
@@ -97,26 +157,53 @@ class ExtractVariables(hr.Walker):
 
 
 class Symbols:
-    def __init__(self, module: hr.Module):
+    # If module is None the table starts empty and is filled in with add_statements and add_function (see streaming.py)
+    def __init__(self, module: hr.Module | None = None):
         self.module = module
         self.functions = {}
+        # Number of arguments of every function seen so far. Kept separately from functions so that entries in functions
+        # can be dropped once a function has been compiled
+        self.arg_counts = {}
+        # Local variable symbols of each function in frame order, filled in on first use
+        self.frame_layouts = {}
 
+        self.top = ExtractVariables(True, {})
+        self.top_level = self.top.declared
 
-        top = Symbols.process(list(filter(lambda x : isinstance(x, hr.Statement), self.module.body)), True)
-        self.top_level = top.declared
-
+        if module is None:
+            return
 
+        self.add_statements(list(filter(lambda x : isinstance(x, hr.Statement), self.module.body)))
 
         for func in filter(lambda x : isinstance(x, hr.FunctionDef), self.module.body):
-            self.functions[func.name] = Symbols.process(func, False, top.declared).all, func
+            self.add_function(func)
             #print(func.name + ": " + str(Symbols.process(func, False, top.declared).results()))
 
+    # Declare the global variables of some top level statements. Can be called repeatedly, offsets carry on from the last call
+    def add_statements(self, statements: list[hr.Statement]):
+        for s in statements:
+            self.top.walk(s)
+
+    def add_function(self, func: hr.FunctionDef):
+        self.functions[func.name] = Symbols.process(func, False, self.top_level).all, func
+        self.arg_counts[func.name] = len(func.args)
+        self.frame_layouts.pop(func.name, None)
+
+    def remove_function(self, name: str):
+        del self.functions[name]
+        self.frame_layouts.pop(name, None)
 
     def count_args(self, func):
-        return len(self.functions[func][1].args)
+        return self.arg_counts[func]
+
+    def frame_layout(self, func):
+        if func not in self.frame_layouts:
+            local_symbols = filter(lambda x : x.is_global == False and x.is_arg == False, self.functions[func][0].values())
+            self.frame_layouts[func] = sorted(local_symbols, key=lambda x : x.stack_offset)
+        return self.frame_layouts[func]
 
     def count_locals(self, func):
-        return len(list(filter(lambda x : x.is_global == False and x.is_arg == False, self.functions[func][0].values())))
+        return len(self.frame_layout(func))
 
     def process(statements, is_top_level: bool, globals = {}):
 
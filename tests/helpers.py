@@ -0,0 +1,21 @@
+import ast
+
+import hr
+from compiler import compile
+from symbols import Symbols
+
+BUILT_INS = {"finish": 0, "print": 1}
+
+
+def parse(source: str) -> hr.Module:
+    return hr.ast_to_hr(ast.parse(source))
+
+
+def compile_source(source: str, **options):
+    module = parse(source)
+    return compile(module, Symbols(module), BUILT_INS, {}, **options)
+
+
+# Values printed by a run, in order
+def printed(capsys) -> list[str]:
+    return [line.removeprefix("Print function: ") for line in capsys.readouterr().out.splitlines()]
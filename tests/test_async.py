@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import interpreter
+from compiler import compile
+from symbols import Symbols
+
+from helpers import BUILT_INS, parse, printed
+
+SOURCE = """
+total: int = 0
+for i in range(0, 20):
+    total = total + sensor(i) + double(i)
+print(total)
+finish()
+"""
+
+EXPECTED = [str(sum(i * 10 + 2 * i for i in range(20)))]
+
+
+def compile_program():
+    module = parse(SOURCE)
+    return compile(module, Symbols(module), BUILT_INS, {"sensor": 1, "double": 1})
+
+
+def double(x):
+    return 2 * x
+
+
+async def sensor(x):
+    await asyncio.sleep(0)
+    return x * 10
+
+
+@pytest.mark.parametrize("options", [{}, {"tracing": True, "hot_loop_threshold": 2}])
+def test_run_async(capsys, options):
+    program = compile_program()
+    vms = [interpreter.Interpreter(built_ins={"sensor": sensor, "double": double}, **options) for _ in range(3)]
+
+    async def main():
+        await asyncio.gather(*(vm.run_async(program) for vm in vms))
+
+    asyncio.run(main())
+    assert printed(capsys) == EXPECTED * 3
+
+
+def test_synchronous_built_ins_in_run_async(capsys):
+    vm = interpreter.Interpreter(built_ins={"sensor": lambda x: x * 10, "double": double})
+    asyncio.run(vm.run_async(compile_program()))
+
+    assert printed(capsys) == EXPECTED
+
+
+def test_run_rejects_awaitables():
+    vm = interpreter.Interpreter(built_ins={"sensor": sensor, "double": double})
+
+    with pytest.raises(Exception, match="A built in returned an awaitable, use run_async"):
+        vm.run(compile_program())
+
+
+def test_failed_awaitable():
+    async def broken(x):
+        raise ValueError(f"sensor {x} is offline")
+
+    vm = interpreter.Interpreter(built_ins={"sensor": broken, "double": double})
+
+    with pytest.raises(ValueError, match="sensor 0 is offline"):
+        asyncio.run(vm.run_async(compile_program()))
@@ -0,0 +1,41 @@
+import interpreter
+
+from helpers import compile_source, printed
+
+# unused is dead, helper is only called by a dead function, and cold is called once outside the loop
+SOURCE = """
+print(cold(1))
+t: int = 0
+for i in range(0, 5):
+    t = t + hot(i)
+print(t)
+finish()
+def unused(a: int) -> int:
+    return helper(a)
+def cold(a: int) -> int:
+    return a + 1
+def helper(a: int) -> int:
+    return a * 3
+def hot(a: int) -> int:
+    return leaf(a) + 1
+def leaf(a: int) -> int:
+    return a * a
+"""
+
+
+def test_layout(capsys):
+    plain = compile_source(SOURCE)
+    laid_out = compile_source(SOURCE, layout=True)
+
+    assert list(laid_out.function_locations) == ["hot", "leaf", "cold"]
+
+    interpreter.Interpreter().run(plain)
+    expected = printed(capsys)
+    interpreter.Interpreter().run(laid_out)
+    assert printed(capsys) == expected == ["2", "35"]
+
+
+def test_layout_with_profile():
+    program = compile_source(SOURCE, layout=True, profile={"cold": 1000, "hot": 5, "leaf": 5})
+
+    assert list(program.function_locations) == ["cold", "hot", "leaf"]
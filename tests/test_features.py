@@ -0,0 +1,37 @@
+import features
+import lazy
+import linker
+import verifier
+from features import Features
+
+from helpers import compile_source, parse
+
+# No built_ins, so the only Finish instructions are the ones the tools add
+ARITHMETIC = Features("operand_stack", "arithmetic", "globals")
+
+SOURCE = """
+x: int = 2
+y: int = x * 3
+"""
+
+
+def test_link_ends_with_finish_without_built_ins():
+    unit = linker.compile_unit(parse(SOURCE), {}, {}, features=ARITHMETIC)
+    program = linker.link([unit], features=ARITHMETIC)
+
+    assert program.type(len(program) - 1).__name__ == "Finish"
+
+
+def test_lazy_stubs_without_built_ins():
+    source = SOURCE + "def f(a: int) -> int:\n    return a\n"
+    lazy.compile_lazy(parse(source), {}, {}, features=Features("operand_stack", "arithmetic", "globals", "subroutines"))
+
+
+def test_verified_program_runs_without_built_ins():
+    program = compile_source(SOURCE, features=ARITHMETIC)
+    verifier.verify(program)
+
+    vm = features.build_interpreter(ARITHMETIC)()
+    vm.run(program)
+
+    assert [vm.globals[0], vm.globals[1]] == [2, 6]
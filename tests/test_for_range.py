@@ -0,0 +1,64 @@
+import pytest
+
+import features
+import interpreter
+from features import Features
+
+from helpers import compile_source, printed
+
+# Assignments to the loop variable do not change the iterations, and an empty range leaves the variable as it is
+SOURCE = """
+n: int = 0
+for i in range(0, 5):
+    i = i + 100
+    n = n + 1
+print(n)
+print(i)
+for i in range(5, 0):
+    n = n + 1
+print(i)
+print(nested(0))
+print(empty(7))
+finish()
+def nested(a: int) -> int:
+    t: int = 0
+    for k in range(0, 4):
+        for k in range(0, 2):
+            t = t + 1
+    return t + k + a
+def empty(a: int) -> int:
+    k: int = a
+    for k in range(3, 3):
+        a = a + 1
+    return k + a
+"""
+
+# What Python prints for SOURCE
+EXPECTED = ["5", "104", "104", "9", "14"]
+
+
+@pytest.mark.parametrize("options", [{}, {"tracing": True, "hot_loop_threshold": 1}, {"verify": True}])
+def test_loop_variable(capsys, options):
+    interpreter.Interpreter(**options).run(compile_source(SOURCE))
+    assert printed(capsys) == EXPECTED
+
+
+def test_loop_variable_specialised(capsys):
+    interpreter_class = features.build_interpreter(Features.all())
+    interpreter_class().run(compile_source(SOURCE))
+    assert printed(capsys) == EXPECTED
+
+
+def test_empty_range_in_trace(capsys):
+    source = """
+t: int = 0
+j: int = 42
+for i in range(0, 20):
+    for j in range(0, 0):
+        t = t + 1
+    t = t + j
+print(t)
+finish()
+"""
+    interpreter.Interpreter(tracing=True, hot_loop_threshold=2).run(compile_source(source))
+    assert printed(capsys) == ["840"]
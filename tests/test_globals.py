@@ -0,0 +1,56 @@
+import pytest
+
+import features
+import interpreter
+from compiler import compile
+from features import Features
+from symbols import Symbols
+
+from helpers import BUILT_INS, parse
+
+# scale returns an int for the first few iterations and then a float, so the store is first rejected inside a trace
+SOURCE = """
+n: int = 0
+y: float = 0.5
+for i in range(0, 10):
+    n = scale(i)
+y = scale(3)
+print(y)
+finish()
+"""
+
+
+def compile_program():
+    module = parse(SOURCE)
+    return compile(module, Symbols(module), BUILT_INS, {"scale": 1})
+
+
+def scale(i: int):
+    return i if i < 5 else i * 0.5
+
+
+@pytest.mark.parametrize("options", [{}, {"tracing": True, "hot_loop_threshold": 1}])
+def test_float_store_into_int_global(options):
+    vm = interpreter.Interpreter(built_ins={"scale": scale}, **options)
+
+    with pytest.raises(Exception, match=r"Assignment to global 0 can not store float values in an int global"):
+        vm.run(compile_program())
+
+    assert vm.globals[0] == 4
+
+
+def test_float_store_into_int_global_specialised():
+    vm = features.build_interpreter(Features.all())(built_ins={"scale": scale})
+
+    with pytest.raises(Exception, match=r"Assignment to global 0 can not store float values in an int global"):
+        vm.run(compile_program())
+
+
+def test_segment_store():
+    segment = interpreter.GlobalSegment(["int", "float"])
+    segment[1] = 3
+
+    with pytest.raises(Exception, match=r"Assignment to global 0 can not store float values in an int global"):
+        segment[0] = 1.5
+
+    assert segment[1] == 3.0
@@ -0,0 +1,40 @@
+import image
+import interpreter
+
+from helpers import compile_source, printed
+
+SOURCE = """
+print(double(4))
+finish()
+def double(a: int) -> int:
+    return a * 2
+def unused(a: int) -> int:
+    return a
+"""
+
+
+def test_function_names_are_written(tmp_path):
+    program = compile_source(SOURCE)
+    path = str(tmp_path / "program.img")
+    image.write_image(program, path)
+
+    stream = image.load_image(path)
+
+    assert {name: entry.location for name, entry in stream.functions.items()} == program.function_locations
+    stream.close()
+
+
+def test_verification_is_opt_in(tmp_path, capsys):
+    path = str(tmp_path / "program.img")
+    image.write_image(compile_source(SOURCE), path)
+
+    lazy = image.load_image(path)
+    verified = image.load_image(path, verify=True)
+
+    assert not lazy.verified and verified.verified
+
+    for stream in (lazy, verified):
+        interpreter.Interpreter().run(stream)
+        stream.close()
+
+    assert printed(capsys) == ["8", "8"]
@@ -0,0 +1,67 @@
+import pytest
+
+import interpreter
+import linker
+import verifier
+
+from helpers import BUILT_INS, parse, printed
+
+# base is private to the library and is still 0 if the user unit's top level code runs first
+LIBRARY = """
+base: int = 100
+print(base)
+def square(a: int) -> int:
+    return a * a
+if base > 50:
+    base = base + 1
+def offset(a: int) -> int:
+    return square(a) + base
+"""
+
+USER = """
+x: int = 0
+for i in range(0, 4):
+    x = x + offset(i)
+print(x)
+def twice(a: int) -> int:
+    return offset(a) * 2
+print(twice(3))
+"""
+
+
+def units() -> tuple:
+    return linker.compile_unit(parse(LIBRARY), BUILT_INS, {}), linker.compile_unit(parse(USER), BUILT_INS, {}, {"offset": 1})
+
+
+@pytest.mark.parametrize("library_first, expected", [(True, ["100", "418", "220"]), (False, ["14", "18", "100"])])
+def test_link_order(capsys, library_first, expected):
+    library, user = units()
+    program = linker.link([library, user] if library_first else [user, library])
+
+    verifier.verify(program)
+    interpreter.Interpreter().run(program)
+
+    assert printed(capsys) == expected
+    assert set(program.function_locations) == {"square", "offset", "twice"}
+
+
+def test_saved_units(capsys, tmp_path):
+    library, user = units()
+    library.save(str(tmp_path / "library.o"))
+    user.save(str(tmp_path / "user.o"))
+
+    program = linker.link([linker.ObjectUnit.load(str(tmp_path / "library.o")), linker.ObjectUnit.load(str(tmp_path / "user.o"))])
+    interpreter.Interpreter().run(program)
+
+    assert printed(capsys) == ["100", "418", "220"]
+
+
+def test_link_errors():
+    library, user = units()
+
+    with pytest.raises(Exception, match="Undefined reference to function 'offset'"):
+        linker.link([user])
+    with pytest.raises(Exception, match="Function 'square' is defined in more than one unit"):
+        linker.link([library, library, user])
+    with pytest.raises(Exception, match="Function 'offset' takes 1 args, but was imported with 2"):
+        linker.link([library, linker.compile_unit(parse("print(offset(1, 2))\n"), BUILT_INS, {}, {"offset": 2})])
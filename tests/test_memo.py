@@ -0,0 +1,88 @@
+import pytest
+
+import interpreter
+from interpreter import MemoCache
+
+from helpers import compile_source, printed
+
+SOURCE = """
+g: int = 3
+print(fib(24))
+print(uses_global(2))
+print(fib(20) + wrap(5))
+finish()
+def fib(n: int) -> int:
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+def wrap(n: int) -> int:
+    return fib(n) * 2
+def uses_global(n: int) -> int:
+    return n + g
+def printer(n: int) -> int:
+    print(n)
+    return wrap(n)
+"""
+
+EXPECTED = ["46368", "5", "6775"]
+
+
+def test_pure_functions():
+    program = compile_source(SOURCE)
+    locations = program.function_locations
+
+    assert program.pure_functions == {locations["fib"]: 1, locations["wrap"]: 1}
+
+
+@pytest.mark.parametrize("memoize", [True, MemoCache(3, "fifo"), MemoCache(None)])
+@pytest.mark.parametrize("tracing", [False, True])
+def test_memoized_output(capsys, memoize, tracing):
+    vm = interpreter.Interpreter(memoize=memoize, tracing=tracing, hot_loop_threshold=2)
+    vm.run(compile_source(SOURCE))
+
+    assert printed(capsys) == EXPECTED
+    assert vm.memo.hits > 0
+
+
+# half(1) and half(1.0) are different calls, and the results of one program are never used for another
+def test_keys(capsys):
+    cache = MemoCache()
+    first = compile_source("""
+print(half(1))
+print(half(1.0))
+print(half(1))
+finish()
+def half(x: float) -> float:
+    return x * 0.5
+""")
+    second = compile_source("""
+print(half(1))
+finish()
+def half(x: float) -> float:
+    return x * 2.0
+""")
+
+    interpreter.Interpreter(memoize=cache).run(first)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    interpreter.Interpreter(memoize=cache).run(second)
+    assert printed(capsys) == ["0.5", "0.5", "0.5", "2.0"]
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_eviction():
+    for policy, kept in [("lru", ["a", "c"]), ("fifo", ["b", "c"])]:
+        cache = MemoCache(2, policy)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        cache.get("a")
+        cache.store("c", 3)
+
+        assert list(cache.entries) == kept
+
+
+def test_bad_options():
+    with pytest.raises(Exception, match="Unknown memo cache policy 'random'"):
+        MemoCache(policy="random")
+    with pytest.raises(Exception, match="Memo cache size must be positive, found 0"):
+        MemoCache(0)
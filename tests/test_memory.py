@@ -0,0 +1,89 @@
+from array import array
+
+import pytest
+
+import interpreter
+import memory
+from streaming import compile_stream, ListSink
+
+from helpers import BUILT_INS, compile_source, printed
+
+BULK = """
+n: int = 4
+mem_fill(mem[0], n, 3)
+print(mem_sum(mem[0], n))
+print(mem_find(mem[0], n, 3))
+finish()
+"""
+
+
+def test_streaming_compiles_bulk_operations(capsys):
+    stream = compile_stream(BULK, ListSink(), BUILT_INS, {}).stream
+
+    assert stream == compile_source(BULK)
+
+    interpreter.Interpreter(memory=[8]).run(stream)
+    assert printed(capsys) == ["12", "0"]
+
+
+FLOAT_STORE = """
+y: float = 1.5
+mem1[0] = y
+mem[0] = y
+finish()
+"""
+
+
+def test_float_store_into_int_block():
+    program = compile_source(FLOAT_STORE)
+    vm = interpreter.Interpreter(memory=[4, array("d", [0.0] * 4)])
+
+    with pytest.raises(Exception, match=r"Assignment to mem\[0\] can not store float values in an int memory block"):
+        vm.run(program)
+
+    assert vm.memory.blocks[1][0] == 1.5
+
+
+# Every bulk operation on mem (int) and mem1 (float), then loads and stores
+OPERATIONS = """
+n: int = 4
+mem_fill(mem[0], n, 2)
+mem[1] = 5
+print(mem_copy(mem[4], mem[0], n))
+print(mem_sum(mem[2], 4))
+mem_fill(mem1[0], 8, 0.5)
+print(mem_axpy(mem1[2], 3.0, mem[0], 2))
+print(mem_dot(mem1[0], mem[0], 4))
+print(mem_find(mem[0], 8, 5))
+print(mem_find(mem1[0], 8, 7.0))
+print(mem1[3] + mem[5])
+finish()
+"""
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_bulk_operations(capsys, monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(memory, "numpy", None)
+    elif memory.numpy is None:
+        pytest.skip("NumPy is not installed")
+
+    vm = interpreter.Interpreter(memory=[8, array("d", [0.0] * 8)])
+    vm.run(compile_source(OPERATIONS))
+
+    assert printed(capsys) == ["4", "11", "2", "47.5", "1", "-1", "20.5"]
+    assert list(vm.memory.blocks[0]) == [2, 5, 2, 2, 2, 5, 2, 2]
+    assert list(vm.memory.blocks[1]) == [0.5, 0.5, 6.5, 15.5, 0.5, 0.5, 0.5, 0.5]
+
+
+@pytest.mark.parametrize("source, message", [
+    ("print(mem_sum(mem[6], 4))\nfinish()\n", r"Range mem\[6:10\] is outside the block, which holds 8 words"),
+    ("print(mem_sum(mem2[0], 1))\nfinish()\n", "Memory block mem2 does not exist, there are 2 blocks"),
+    ("mem[8] = 1\nfinish()\n", r"Memory access mem\[8\] is outside the block, which holds 8 words"),
+    ("mem_fill(mem[0], 2, 1.5)\nfinish()\n", "mem_fill can not store float values in an int memory block"),
+])
+def test_memory_errors(source, message):
+    vm = interpreter.Interpreter(memory=[8, array("d", [0.0] * 8)])
+
+    with pytest.raises(Exception, match=message):
+        vm.run(compile_source(source))
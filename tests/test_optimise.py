@@ -0,0 +1,57 @@
+import pytest
+
+import interpreter
+
+from helpers import compile_source, printed
+
+# Simplifiable identities, repeated subexpressions and loop invariants, in top level code and functions
+SOURCE = """
+g: int = 4
+q: float = 1.5
+print(r(3, 5, 2))
+print(s(7))
+print(q * 1 + 0)
+print(g * 0 + g - g)
+h: int = g * g + g * g * 2
+print(h)
+t: int = 0
+for i in range(0, 6):
+    t = t + g * h + i
+print(t)
+finish()
+def r(a: int, b: int, c: int) -> int:
+    x: int = a * b + a * b * c
+    y: int = x - 0 + 1 * x
+    if not not (a < b):
+        y = y + 1
+    z: int = not not a
+    w: int = -(-a) + ~~b
+    v: int = (a + b) * (a + b) + (a + b)
+    return x + y + z + w + v + c * 0
+def s(n: int) -> int:
+    total: int = 0
+    k: int = 0
+    while k < n:
+        total = total + (n * n + 1) * k
+        g = g + 1
+        k = k + 1
+    return total + g * 2
+"""
+
+
+def run(program, capsys) -> list[str]:
+    interpreter.Interpreter().run(program)
+    return printed(capsys)
+
+
+def test_optimised_output_matches(capsys):
+    plain = compile_source(SOURCE)
+    optimised = compile_source(SOURCE, optimise=True)
+
+    assert run(optimised, capsys) == run(plain, capsys)
+    assert len(optimised) < len(plain)
+
+
+@pytest.mark.parametrize("options", [{"optimise": True}, {"layout": True}, {"optimise": True, "layout": True, "reuse_slots": True}])
+def test_options_match(capsys, options):
+    assert run(compile_source(SOURCE, **options), capsys) == run(compile_source(SOURCE), capsys)
@@ -0,0 +1,78 @@
+import pytest
+
+import interpreter
+from lazy import compile_lazy
+from parallel import compile_parallel
+from streaming import compile_stream, FileSink, ListSink
+
+from helpers import BUILT_INS, compile_source, parse, printed
+
+# Globals, nested loops, recursion, calls in both directions and a function that is never called
+SOURCE = """
+x: int = 0
+z: float = 1.5 * 2.0
+for i in range(0, 10):
+    x = x + f(i, 2)
+print(x)
+print(z)
+print(fib(15))
+finish()
+def f(a: int, b: int) -> int:
+    y: int = a * b
+    while y > 5:
+        y = y - 1
+    return y + g(a)
+def unused(a: int) -> int:
+    return a * 3
+def g(a: int) -> int:
+    t: int = 0
+    for k in range(0, 4):
+        t = t + k * a
+    return t
+def fib(n: int) -> int:
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+"""
+
+EXPECTED = ["311", "3.0", "610"]
+
+
+def run(program, capsys, **options) -> list[str]:
+    interpreter.Interpreter(**options).run(program)
+    return printed(capsys)
+
+
+def test_compile(capsys):
+    assert run(compile_source(SOURCE), capsys) == EXPECTED
+
+
+def test_streaming_matches_compile(capsys, tmp_path):
+    program = compile_source(SOURCE)
+    streamed = compile_stream(SOURCE, ListSink(), BUILT_INS, {}, group_size=2).stream
+
+    assert streamed == program
+    assert streamed.function_locations == program.function_locations
+    assert run(streamed, capsys) == EXPECTED
+
+    path = str(tmp_path / "program")
+    compile_stream(SOURCE, FileSink(path), BUILT_INS, {})
+    assert FileSink.load(path) == program
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_parallel_matches_compile(capsys, processes):
+    program = compile_source(SOURCE)
+    compiled = compile_parallel(parse(SOURCE), BUILT_INS, {}, processes=processes, chunksize=1)
+
+    assert compiled == program
+    assert run(compiled, capsys) == EXPECTED
+
+
+@pytest.mark.parametrize("options", [{}, {"tracing": True, "hot_loop_threshold": 2}, {"verify": True}])
+def test_lazy_matches_compile(capsys, options):
+    program = compile_lazy(parse(SOURCE), BUILT_INS, {})
+
+    assert run(program, capsys, **options) == EXPECTED
+    # unused was never called, so is still a stub, unless the verifier compiled every function first
+    assert ("unused" in program.function_locations) == options.get("verify", False)
@@ -0,0 +1,43 @@
+import ir
+import interpreter
+
+from helpers import compile_source, printed
+
+# a and b are dead once c and d are written, and the loop counter is live across the whole loop
+SOURCE = """
+print(f(3))
+print(g(4))
+finish()
+def f(n: int) -> int:
+    a: int = n + 1
+    b: int = a * 2
+    c: int = b + 3
+    d: int = c * c
+    return d
+def g(n: int) -> int:
+    t: int = 0
+    u: int = n * 2
+    for i in range(0, 3):
+        v: int = i + u
+        t = t + v
+    w: int = t + 1
+    return w
+"""
+
+
+def frame_sizes(program) -> dict:
+    return {name: program.operand(location, "variable_count") for name, location in program.function_locations.items()}
+
+
+def test_reused_slots(capsys):
+    plain = compile_source(SOURCE)
+    reused = compile_source(SOURCE, reuse_slots=True)
+
+    assert reused.opcodes[reused.function_locations["f"]] == ir.LocalAlloc.opcode
+    assert frame_sizes(plain) == {"f": 4, "g": 5}
+    assert frame_sizes(reused) == {"f": 1, "g": 4}
+
+    interpreter.Interpreter(verify=True).run(plain)
+    expected = printed(capsys)
+    interpreter.Interpreter(verify=True).run(reused)
+    assert printed(capsys) == expected == ["121", "28"]
@@ -0,0 +1,54 @@
+import pytest
+
+import ir
+import stackdepth
+from stream import InstructionStream
+
+from helpers import compile_source
+
+# f holds a and b + while g runs, so the deepest op stack is 2 below g's own 2
+CALLS = """
+x: int = 1 + 2 * 3
+print(f(x, 4))
+finish()
+def f(a: int, b: int) -> int:
+    return a * (b + g(a))
+def g(a: int) -> int:
+    return a + 1
+"""
+
+RECURSIVE = """
+print(fib(5))
+finish()
+def fib(n: int) -> int:
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+"""
+
+
+def test_depths():
+    program = compile_source(CALLS)
+
+    assert program.stack_depths == {None: 3, "f": 3, "g": 2}
+    assert program.max_stack_depth == 4
+
+
+def test_recursion_has_no_bound():
+    program = compile_source(RECURSIVE)
+
+    assert program.stack_depths == {None: 1, "fib": 3}
+    assert program.max_stack_depth is None
+
+
+@pytest.mark.parametrize("instructions, message", [
+    ([ir.OpStackPop()], "Op stack underflow at location 0"),
+    ([ir.OpStackPushLiteral(1)], "Op stack is unbalanced, 1 values are left at location 1"),
+    ([ir.OpStackPushLiteral(1), ir.OpStackPushLiteral(1), ir.JumpIfTrue(4), ir.OpStackPushLiteral(2), ir.OpStackPop()],
+     "Op stack is unbalanced at location 4, reached with depth"),
+])
+def test_rejected_code(instructions, message):
+    stream = InstructionStream.from_instructions(instructions)
+
+    with pytest.raises(Exception, match=message):
+        stackdepth.analyse_region(stream, 0, len(stream))
@@ -0,0 +1,45 @@
+import pytest
+
+import interpreter
+import ir
+import verifier
+from stream import InstructionStream
+
+from helpers import compile_source
+
+
+def test_globals_without_global_alloc():
+    stream = InstructionStream.from_instructions([ir.OpStackPushGlobal(0), ir.OpStackPop()])
+
+    with pytest.raises(Exception, match="uses global 0, but the program allocates 0"):
+        verifier.verify(stream)
+
+
+def test_unknown_bulk_operation():
+    stream = InstructionStream.from_instructions([ir.OpStackPushLiteral(0), ir.MemoryBulk("mem_nothing", 1), ir.OpStackPop()])
+
+    with pytest.raises(Exception, match="unknown operation 'mem_nothing'"):
+        verifier.verify(stream)
+
+
+def test_verified_memory_blocks_are_checked_once():
+    program = compile_source("mem3[0] = mem[1]\n")
+    verifier.verify(program)
+
+    assert program.memory_blocks == 4
+
+    with pytest.raises(Exception, match="Memory block mem3 does not exist, there are 2 blocks"):
+        interpreter.Interpreter(memory=[4, 4]).run(program)
+
+    vm = interpreter.Interpreter(memory=[4, 4, 4, 4])
+    vm.memory.blocks[0][1] = 7
+    vm.run(program)
+
+    assert vm.memory.blocks[3][0] == 7
+
+
+def test_unverified_memory_blocks_are_checked():
+    program = InstructionStream.from_instructions([ir.OpStackPushLiteral(0), ir.MemoryLoad(3), ir.OpStackPop()])
+
+    with pytest.raises(Exception, match="Memory block mem3 does not exist, there are 1 blocks"):
+        interpreter.Interpreter(memory=[4]).run(program)
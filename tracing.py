@@ -0,0 +1,350 @@
+import inspect
+import math
+
+import ir
+import interpreter
+from stream import InstructionStream
+
+# Trace recording JIT for hot loops.
+#
+# The interpreter counts the backward jumps to each location. Once a loop header has been jumped to hot_loop_threshold
+# times, the interpreter records the locations it executes until control comes back to the header. The recorded trace
+# is a single path through the loop body, with calls followed into the callee, and is compiled into a Python function
+# that runs iterations of that path until it leaves it.
+#
+# Every conditional jump in the trace becomes a guard that checks the direction taken while recording. When a guard
+# fails the trace function puts the op stack back in the state the interpreter expects and returns the location to
+# resume at along with the base pointer and None, so the interpreter carries on from there. The trace works on the same op
+# stack, call stack and globals as the interpreter, so calls inlined into the trace push and pop real frames.
+#
+# Within the trace, values on the op stack are held in Python locals. Each push assigns a new temporary, and the op
+# stack itself is only touched when the trace starts with values on it or when it exits.
+#
+# Recording is abandoned if the trace gets too long, returns out of the function the loop is in, or reaches an
+# instruction that cannot be traced, such as a built in that is a coroutine. After max_aborts attempts the loop is no longer recorded.
+#
+# Any other built in may still return an awaitable. The trace checks the result of every built in call, and if it is
+# awaitable leaves the trace at the instruction after the call, returning the awaitable as the third value. The
+# interpreter then waits for it as if it had called the built in itself.
+
+# Code for the instructions that pop their operands and push a single result, by opcode
+templates = {
+    ir.Equal.opcode: "1 if {a} == {b} else 0",
+    ir.NotEqual.opcode: "1 if {a} != {b} else 0",
+    ir.LessThan.opcode: "1 if {a} < {b} else 0",
+    ir.GreaterThan.opcode: "1 if {a} > {b} else 0",
+    ir.LessThanEqualTo.opcode: "1 if {a} <= {b} else 0",
+    ir.GreaterThanEqualTo.opcode: "1 if {a} >= {b} else 0",
+    ir.Add.opcode: "{a} + {b}",
+    ir.Sub.opcode: "{a} - {b}",
+    ir.Multiply.opcode: "{a} * {b}",
+    ir.UnaryNegative.opcode: "-{a}",
+    ir.UnaryPositive.opcode: "{a}",
+    ir.OnesComplement.opcode: "~{a}",
+    ir.LogicalNot.opcode: "1 if {a} == 0 else 0",
+}
+
+# Instructions that can appear in a trace, besides the ones in templates
+traceable = {
+    ir.Call.opcode,
+    ir.LocalAlloc.opcode,
+    ir.Return.opcode,
+    ir.OpStackPushLocal.opcode,
+    ir.OpStackPopLocal.opcode,
+    ir.OpStackPushArg.opcode,
+    ir.OpStackPopArg.opcode,
+    ir.OpStackPushGlobal.opcode,
+    ir.OpStackPopGlobal.opcode,
+    ir.OpStackPushLiteral.opcode,
+    ir.OpStackPopToCallStack.opcode,
+    ir.OpStackPop.opcode,
+    ir.OpStackDuplicate.opcode,
+    ir.BuiltInInstruction.opcode,
+    ir.BuiltInFunction.opcode,
+    ir.Jump.opcode,
+    ir.JumpIfTrue.opcode,
+    ir.JumpIfFalse.opcode,
+    ir.ForRangeInit.opcode,
+    ir.ForRangeNext.opcode,
+} | set(templates)
+
+
+class TraceJIT:
+    # built_ins is the interpreter's registry, traces cannot wait for the built ins that are coroutines
+    def __init__(self, built_ins: dict, hot_loop_threshold: int = 50, max_trace_length: int = 2000, max_aborts: int = 3):
+        self.built_ins = built_ins
+        self.hot_loop_threshold = hot_loop_threshold
+        self.max_trace_length = max_trace_length
+        self.max_aborts = max_aborts
+
+        # Backward jumps seen by each loop header
+        self.counters = {}
+        # Compiled trace function and generated source of each traced loop header
+        self.traces = {}
+        self.sources = {}
+        # Abandoned recordings of each loop header, and the headers that are no longer recorded
+        self.aborts = {}
+        self.blacklist = set()
+
+    # Count a backward jump to location, returns True if recording should start
+    def is_hot(self, location: int) -> bool:
+        if location in self.blacklist:
+            return False
+
+        count = self.counters.get(location, 0) + 1
+        self.counters[location] = count
+
+        return count >= self.hot_loop_threshold
+
+    # Whether the instruction at index can be recorded, depth is the number of calls entered since recording started
+    def traceable(self, stream: InstructionStream, index: int, depth: int) -> bool:
+        op = stream.opcodes[index]
+
+        if op == ir.Return.opcode:
+            return depth > 0
+
+        if op == ir.BuiltInInstruction.opcode or op == ir.BuiltInFunction.opcode:
+            name = stream.operand(index, "name")
+            return name != "finish" and not inspect.iscoroutinefunction(self.built_ins.get(name))
+
+        return op in traceable
+
+    # Recording can be abandoned because of the path taken in one iteration (e.g. the last iteration of a loop in a
+    # function returns), so the loop is counted again from zero before the next attempt
+    def abort(self, location: int):
+        self.counters[location] = 0
+        self.aborts[location] = self.aborts.get(location, 0) + 1
+
+        if self.aborts[location] >= self.max_aborts:
+            self.blacklist.add(location)
+
+    # Compile the recorded trace, a list of locations starting with the loop header
+    def compile(self, stream: InstructionStream, trace: list[int]):
+        header = trace[0]
+
+        source, constants = _TraceCompiler(stream, trace).generate()
+
+        namespace = {
+            "LinkAddress": interpreter.LinkAddress,
+            "BasePointer": interpreter.BasePointer,
+            "LocalVariable": interpreter.LocalVariable,
+            "Argument": interpreter.Argument,
+            "check_global_store": interpreter.check_global_store,
+            "isawaitable": inspect.isawaitable,
+        }
+        namespace.update(constants)
+
+        exec(compile(source, f"<trace {header}>", "exec"), namespace)
+
+        self.traces[header] = namespace[f"trace_{header}"]
+        self.sources[header] = source
+
+
+
+class _TraceCompiler:
+    def __init__(self, stream: InstructionStream, trace: list[int]):
+        self.stream = stream
+        self.trace = trace
+
+        # Names (or literal code) of the values pushed in the trace and not yet popped, bottom first
+        self.stack = []
+        self.temporaries = 0
+
+        self.lines = []
+        self.prologue = []
+        # Names bound in the prologue, e.g. global views and built ins
+        self.bound = {}
+        # Constants the generated code refers to by name
+        self.constants = {}
+
+    def emit(self, line: str):
+        self.lines.append("        " + line)
+
+    def temporary(self) -> str:
+        self.temporaries += 1
+        return f"t{self.temporaries}"
+
+    def push(self, code: str):
+        name = self.temporary()
+        self.emit(f"{name} = {code}")
+        self.stack.append(name)
+
+    # Name of the popped value. Values pushed before the trace started are popped off the real op stack
+    def pop(self) -> str:
+        if self.stack:
+            return self.stack.pop()
+
+        name = self.temporary()
+        self.emit(f"{name} = op_stack.pop()")
+        return name
+
+    def bind(self, name: str, code: str) -> str:
+        if name not in self.bound:
+            self.bound[name] = code
+            self.prologue.append(f"    {name} = {code}")
+        return name
+
+    def literal(self, value) -> str:
+        if type(value) == int or (type(value) == float and math.isfinite(value)):
+            return repr(value)
+
+        name = f"k{len(self.constants)}"
+        self.constants[name] = value
+        return name
+
+    def global_variable(self, offset: int) -> str:
+        return f"{self.bind(f'g{offset}', f'global_views[{offset}]')}[{offset}]"
+
+    # Code to access the counter of a ForRange instruction
+    def counter(self, index: int) -> str:
+        scope = self.stream.operand(index, "scope")
+        offset = self.stream.operand(index, "offset")
+
+        if scope == ir.SCOPE_LOCAL:
+            return f"call_stack[bp+{offset + 1}]"
+        elif scope == ir.SCOPE_ARG:
+            return f"call_stack[bp-{2 + offset}].inner"
+        else:
+            return self.global_variable(offset)
+
+    # Leave the trace, putting the values held in temporaries back on the op stack
+    def exit(self, location: int, indent: str = "    ", pending: str = "None"):
+        if self.stack:
+            self.emit(f"{indent}op_stack.extend(({', '.join(self.stack)},))")
+        self.emit(f"{indent}return {location}, bp, {pending}")
+
+    def guard(self, condition: str, location: int):
+        self.emit(f"if {condition}:")
+        self.exit(location)
+
+    def generate(self) -> tuple[str, dict]:
+        trace = self.trace
+
+        for i, index in enumerate(trace):
+            following = trace[i + 1] if i + 1 < len(trace) else trace[0]
+            self.instruction(index, following)
+
+        # Values left on the op stack at the end of an iteration stay there for the next one
+        if self.stack:
+            self.emit(f"op_stack.extend(({', '.join(self.stack)},))")
+            self.stack = []
+
+        header = trace[0]
+
+        source = "\n".join(
+            [f"def trace_{header}(op_stack, call_stack, global_views, built_ins, bp):"]
+            + self.prologue
+            + ["    while True:"]
+            + self.lines
+        ) + "\n"
+
+        return source, self.constants
+
+    # Generate the code for the instruction at index, following is the location executed after it in the trace
+    def instruction(self, index: int, following: int):
+        stream = self.stream
+        op = stream.opcodes[index]
+        operand = stream.operands[stream.starts[index]] if ir.opcodes[op].fields else None
+
+        if op in templates:
+            if op in (ir.UnaryNegative.opcode, ir.UnaryPositive.opcode, ir.OnesComplement.opcode, ir.LogicalNot.opcode):
+                self.push(templates[op].format(a=self.pop()))
+            else:
+                b = self.pop()
+                a = self.pop()
+                self.push(templates[op].format(a=a, b=b))
+        elif op == ir.OpStackPushLocal.opcode:
+            self.push(f"call_stack[bp+{operand + 1}]")
+        elif op == ir.OpStackPopLocal.opcode:
+            self.emit(f"call_stack[bp+{operand + 1}] = {self.pop()}")
+        elif op == ir.OpStackPushArg.opcode:
+            self.push(f"call_stack[bp-{2 + operand}].inner")
+        elif op == ir.OpStackPopArg.opcode:
+            self.emit(f"call_stack[bp-{2 + operand}].inner = {self.pop()}")
+        elif op == ir.OpStackPushGlobal.opcode:
+            self.push(self.global_variable(operand))
+        elif op == ir.OpStackPopGlobal.opcode:
+            value = self.pop()
+            self.emit(f"if type({value}) is float:")
+            self.emit(f"    check_global_store(global_views, {operand}, {value})")
+            self.emit(f"{self.global_variable(operand)} = {value}")
+        elif op == ir.OpStackPushLiteral.opcode:
+            # Literals are immutable so need no temporary
+            self.stack.append(self.literal(stream.operand(index, "value")))
+        elif op == ir.OpStackPopToCallStack.opcode:
+            self.emit(f"call_stack.append(Argument({self.pop()}))")
+        elif op == ir.OpStackPop.opcode:
+            if self.stack:
+                self.stack.pop()
+            else:
+                self.emit("op_stack.pop()")
+        elif op == ir.OpStackDuplicate.opcode:
+            value = self.pop()
+            self.stack += [value, value]
+        elif op == ir.BuiltInInstruction.opcode:
+            name = stream.operand(index, "name")
+            args = [self.pop() for _ in range(stream.operand(index, "args"))]
+            function = self.bind(f"built_in_{name}", f"built_ins[{name!r}]")
+            result = self.temporary()
+            self.emit(f"{result} = {function}({', '.join(reversed(args))})")
+            self.emit(f"if {result} is not None and isawaitable({result}):")
+            self.exit(index + 1, pending=result)
+        elif op == ir.BuiltInFunction.opcode:
+            name = stream.operand(index, "name")
+            args = [self.pop() for _ in range(stream.operand(index, "args"))]
+            function = self.bind(f"built_in_{name}", f"built_ins[{name!r}]")
+            result = self.temporary()
+            self.emit(f"{result} = {function}({', '.join(reversed(args))})")
+            # The interpreter pushes the result once it has been awaited
+            self.emit(f"if isawaitable({result}):")
+            self.exit(index + 1, pending=result)
+            self.stack.append(result)
+        elif op == ir.Call.opcode:
+            self.emit(f"call_stack.append(LinkAddress({index + 1}))")
+        elif op == ir.LocalAlloc.opcode:
+            self.emit("call_stack.append(BasePointer(bp))")
+            self.emit("bp = len(call_stack) - 1")
+            if operand != 0:
+                self.emit(f"call_stack.extend([LocalVariable(None) for _ in range({operand})])")
+        elif op == ir.Return.opcode:
+            self.emit("del call_stack[bp+1:]")
+            self.emit("bp = call_stack.pop().inner")
+            self.emit("call_stack.pop()")
+            if operand != 0:
+                self.emit(f"del call_stack[-{operand}:]")
+        elif op == ir.Jump.opcode:
+            pass
+        elif op in (ir.JumpIfTrue.opcode, ir.JumpIfFalse.opcode):
+            location = operand
+            value = self.pop()
+
+            if location != index + 1:
+                jumps_if_true = op == ir.JumpIfTrue.opcode
+                jumped = following == location
+                # Leave the trace if the value would send control the other way
+                leaves_if_true = jumps_if_true != jumped
+                self.guard(f"{value} != 0" if leaves_if_true else f"{value} == 0", index + 1 if jumped else location)
+        elif op == ir.ForRangeInit.opcode:
+            # The start, stop and step are constants, so whether the loop is skipped was settled while recording. A skipped
+            # loop leaves its counter as it is
+            if following == index + 1:
+                self.emit(f"{self.counter(index)} = {stream.operand(index, 'start')}")
+        elif op == ir.ForRangeNext.opcode:
+            stop = stream.operand(index, "stop")
+            step = stream.operand(index, "step")
+            location = stream.operand(index, "location")
+
+            value = self.temporary()
+            self.emit(f"{value} = {self.counter(index)} + {step}")
+
+            continues = f"{value} < {stop}" if step > 0 else f"{value} > {stop}"
+
+            if following == location:
+                self.guard(f"not ({continues})", index + 1)
+                self.emit(f"{self.counter(index)} = {value}")
+            else:
+                self.emit(f"if {continues}:")
+                self.emit(f"    {self.counter(index)} = {value}")
+                self.exit(location, "    ")
+        else:
+            raise Exception(f"Cannot trace {ir.opcodes[op].__name__} at location {index}")
@@ -0,0 +1,212 @@
+import ir
+import memory
+import stackdepth
+from stream import InstructionStream, NONE_OPERAND
+
+# Load time verification of compiled programs.
+#
+# verify checks once, before a program runs, the things the run loop would otherwise have to check on every instruction
+# (or does not check at all):
+# - every opcode is known and every pooled operand is in the constant pool
+# - every jump targets an instruction, or the end of the program
+# - every Call targets a LocalAlloc, i.e. the start of a function
+# - the op stack depth is the same on every path to an instruction, never underflows, is 0 when top level code ends and
+#   is exactly the return value at every Return (see stackdepth.py)
+# - local and arg offsets are within the LocalAlloc and the arg count of the function, global offsets are within the
+#   GlobalAlloc (none without one), and top level code does not use locals or args or Return
+# - every MemoryBulk is a known operation with the right number of args. The blocks of bulk operations are values on the
+#   op stack, which Memory checks as they run
+#
+# Code is analysed from its entry points (location 0 and every Call target) following jumps, so unreachable code is not
+# checked. Function arg counts are taken from their Return instructions, which must all agree.
+#
+# verify appends a Finish to a program that does not end with one, so that a verified program can not run off the end,
+# and records the number of memory blocks addressed by its MemoryLoad and MemoryStore instructions in memory_blocks. The
+# interpreter runs verified programs without checking pc against the length of the program on every instruction, and
+# checks once that it has memory_blocks blocks instead of checking the block of every memory access.
+
+JUMPS = (ir.Jump.opcode, ir.JumpIfTrue.opcode, ir.JumpIfFalse.opcode, ir.ForRangeInit.opcode, ir.ForRangeNext.opcode)
+LOCAL_OFFSETS = (ir.OpStackPushLocal.opcode, ir.OpStackPopLocal.opcode)
+ARG_OFFSETS = (ir.OpStackPushArg.opcode, ir.OpStackPopArg.opcode)
+GLOBAL_OFFSETS = (ir.OpStackPushGlobal.opcode, ir.OpStackPopGlobal.opcode)
+FOR_RANGE = (ir.ForRangeInit.opcode, ir.ForRangeNext.opcode)
+MEMORY_ACCESS = (ir.MemoryLoad.opcode, ir.MemoryStore.opcode)
+
+
+def _check_encoding(stream: InstructionStream):
+    operand_count = len(stream.operands)
+
+    for index in range(len(stream)):
+        op = stream.opcodes[index]
+
+        if op >= len(ir.opcodes):
+            raise Exception(f"Unknown opcode {op} at location {index}")
+
+        cls = ir.opcodes[op]
+        start = stream.starts[index]
+
+        if start + len(cls.fields) > operand_count:
+            raise Exception(f"{cls.__name__} at location {index} is missing operands")
+
+        for j, field in enumerate(cls.fields):
+            operand = stream.operands[start + j]
+
+            if field in cls.pooled and not 0 <= operand < len(stream.constants):
+                raise Exception(f"{cls.__name__} at location {index} refers to constant {operand}, which is not in the constant pool")
+
+            if field in cls.locations and not 0 <= operand <= len(stream):
+                raise Exception(f"{cls.__name__} at location {index} jumps to {'an unpatched location' if operand == NONE_OPERAND else operand}, outside the program")
+
+
+# Check the code reachable from entry. For a function, locals is its LocalAlloc count, otherwise None. Returns the arg
+# count of the function's Returns, the Call targets found and the memory blocks addressed
+def _check_code(stream: InstructionStream, entry: int, locals: int | None, global_count: int, name: str) -> tuple[int | None, set, set]:
+    length = len(stream)
+    depths = {entry: 0}
+    worklist = [entry]
+    arg_count = None
+    calls = set()
+    blocks = set()
+
+    def reach(index: int, depth: int, source: int):
+        if index == length:
+            if locals is not None:
+                raise Exception(f"{name} runs off the end of the program (from location {source})")
+            if depth != 0:
+                raise Exception(f"Op stack is unbalanced, {depth} values are left at the end of the program (from location {source})")
+            return
+
+        if index in depths:
+            if depths[index] != depth:
+                raise Exception(f"Op stack is unbalanced at location {index}, reached with depth {depths[index]} and {depth}")
+            return
+
+        depths[index] = depth
+        worklist.append(index)
+
+    while worklist:
+        index = worklist.pop()
+        depth = depths[index]
+        op = stream.opcodes[index]
+        cls = ir.opcodes[op]
+
+        pops, pushes = stackdepth.stack_effect(stream, index)
+
+        if pops > depth:
+            raise Exception(f"Op stack underflow at location {index} in {name}")
+
+        if op == ir.Call.opcode:
+            target = stream.operand(index, "location")
+            if target == length or stream.opcodes[target] != ir.LocalAlloc.opcode:
+                raise Exception(f"Call at location {index} targets location {target}, which is not the start of a function")
+            calls.add(target)
+
+        elif op == ir.LocalAlloc.opcode and index != entry:
+            raise Exception(f"{name} runs into the function at location {index}")
+
+        elif op == ir.Return.opcode:
+            if locals is None:
+                raise Exception(f"Return at location {index} is outside of a function")
+            if depth != 1:
+                raise Exception(f"Return at location {index} leaves {depth} values on the op stack, expected 1")
+
+            count = stream.operand(index, "arg_count")
+            if arg_count is not None and count != arg_count:
+                raise Exception(f"Returns of {name} disagree on the arg count, {arg_count} and {count} (location {index})")
+            arg_count = count
+
+        offset = stream.operands[stream.starts[index]] if cls.fields else None
+        scope = None
+
+        if op in FOR_RANGE:
+            scope = stream.operand(index, "scope")
+            offset = stream.operand(index, "offset")
+
+        if op in LOCAL_OFFSETS or scope == ir.SCOPE_LOCAL:
+            if locals is None:
+                raise Exception(f"{cls.__name__} at location {index} uses a local outside of a function")
+            if not 0 <= offset < locals:
+                raise Exception(f"{cls.__name__} at location {index} uses local {offset}, but {name} allocates {locals}")
+
+        if op in ARG_OFFSETS or scope == ir.SCOPE_ARG:
+            if locals is None:
+                raise Exception(f"{cls.__name__} at location {index} uses an arg outside of a function")
+            if offset < 0:
+                raise Exception(f"{cls.__name__} at location {index} uses arg {offset}")
+
+        if (op in GLOBAL_OFFSETS or scope == ir.SCOPE_GLOBAL) and not 0 <= offset < global_count:
+            raise Exception(f"{cls.__name__} at location {index} uses global {offset}, but the program allocates {global_count}")
+
+        if op in MEMORY_ACCESS:
+            if offset < 0:
+                raise Exception(f"{cls.__name__} at location {index} uses memory block {offset}")
+            blocks.add(offset)
+
+        if op == ir.MemoryBulk.opcode:
+            operation = stream.operand(index, "operation")
+
+            if operation not in memory.operations:
+                raise Exception(f"MemoryBulk at location {index} runs unknown operation {operation!r}")
+
+            kinds = memory.operations[operation]
+
+            if stream.operand(index, "args") != len(kinds) + kinds.count("range"):
+                raise Exception(f"MemoryBulk at location {index} passes {stream.operand(index, 'args')} args to {operation}, expected {len(kinds) + kinds.count('range')}")
+
+        depth = depth - pops + pushes
+
+        if op == ir.BuiltInInstruction.opcode and stream.operand(index, "name") == "finish":
+            continue
+
+        for successor in stackdepth.successors(stream, index):
+            reach(successor, depth, index)
+
+    # Arg offsets can only be checked once the arg count is known
+    if arg_count is not None:
+        for index in depths:
+            op = stream.opcodes[index]
+            if op in ARG_OFFSETS or (op in FOR_RANGE and stream.operand(index, "scope") == ir.SCOPE_ARG):
+                offset = stream.operand(index, "offset")
+                if offset >= arg_count:
+                    raise Exception(f"{ir.opcodes[op].__name__} at location {index} uses arg {offset}, but {name} takes {arg_count}")
+
+    return arg_count, calls, blocks
+
+
+# Raise if the program is not valid, otherwise mark it as verified
+def verify(stream: InstructionStream):
+    _check_encoding(stream)
+
+    # A program without a GlobalAlloc has no globals
+    global_count = 0
+
+    for index in range(len(stream)):
+        if stream.opcodes[index] == ir.GlobalAlloc.opcode:
+            global_count = stream.operand(index, "variable_count")
+
+    pending = []
+    checked = set()
+    blocks = set()
+
+    if len(stream) != 0:
+        _, calls, used = _check_code(stream, 0, None, global_count, "Top level code")
+        pending += calls
+        blocks |= used
+
+    while pending:
+        entry = pending.pop()
+
+        if entry in checked:
+            continue
+
+        checked.add(entry)
+
+        _, calls, used = _check_code(stream, entry, stream.operand(entry, "variable_count"), global_count, f"Function at location {entry}")
+        pending += calls
+        blocks |= used
+
+    if len(stream) == 0 or stream.opcodes[-1] != ir.Finish.opcode:
+        stream.emit(ir.Finish)
+
+    stream.memory_blocks = max(blocks) + 1 if blocks else 0
+    stream.verified = True